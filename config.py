@@ -4,6 +4,15 @@ Loads configuration from a YAML file into a dictionary
 Usage:
     from config import GRAPH
     from config import GLOBAL
+    from config import QUEUE
+    from config import SPOOL
+    from config import DIGEST
+    from config import SQL
+    from config import RECENT
+    from config import RETENTION
+    from config import CHAT
+    from config import REQUEST
+    from config import SCHEDULER
 
 Authentication:
     N/A - Just needs to be able to read the YAML file
@@ -28,6 +37,19 @@ import yaml
 GRAPH = {}
 GLOBAL = {}
 SMTP = {}
+TEAMS = {}
+QUEUE = {}
+SPOOL = {}
+DIGEST = {}
+SQL = {}
+RECENT = {}
+RETENTION = {}
+CHAT = {}
+REQUEST = {}
+SCHEDULER = {}
+
+# Plugins that have been loaded (populated by the web service)
+plugin_list = []
 
 
 # Open the YAML file, and store in the 'config' variable
@@ -51,4 +73,16 @@ except Exception as e:
 GLOBAL = config['global']
 GRAPH = config['graph']
 SMTP = config['smtp']
+TEAMS = config['teams']
 PLUGINS = config['plugins']
+
+# Optional sections; Defaults are used if these are missing
+QUEUE = config.get('queue', {})
+SPOOL = config.get('spool', {})
+DIGEST = config.get('digest', {})
+SQL = config.get('sql', {})
+RECENT = config.get('recent', {})
+RETENTION = config.get('retention', {})
+CHAT = config.get('chat', {})
+REQUEST = config.get('request', {})
+SCHEDULER = config.get('scheduler', {})
@@ -3,6 +3,9 @@ Connects to Microsoft Identity Services and authenticates an app and a user
 
 Usage:
     Import the azureauth module in your application
+    Run login() at startup
+        This gets a token from the token cache, without a user,
+        and only falls back to client_auth() if that fails
     Run azureauth.client_auth() to get a client code
         This will require a user to authenticate
         Take the resulting code (in the returned URL)
@@ -22,9 +25,14 @@ Restrictions:
     Requires an application to be registered in Identity Services
         Needs an App ID, Tenant ID, and Client Secret
         Needs a Callback URL configured (localhost is ok)
+    The token is refreshed by the scheduler, 5 minutes before it expires
+        A failed refresh is retried with backoff (see scheduler.py)
+    The MSAL token cache is kept on disk, encrypted (see tokencache.py)
+        After a restart, a token is refreshed from the cache,
+        so a user only needs to log in if the cache can't be used
 
 To Do:
-    Retry token refresh if it fails
+    None
 
 Author:
     Luke Robertson - October 2022
@@ -33,12 +41,17 @@ Author:
 
 import webbrowser
 from msal import ConfidentialClientApplication
-import threading
 from config import TEAMS
-from config import plugin_list
+from core import tokenstore
+from core import tokencache
+from core import scheduler
 import termcolor
 
 
+# Refresh the token this many seconds before it expires
+REFRESH_MARGIN = 300
+
+
 class AzureAuth:
     def __init__(self):
         # Application info and required permissions
@@ -53,12 +66,77 @@ class AzureAuth:
         # The login URL for client authentication
         login_url = 'https://login.microsoftonline.com/' + TENANT
 
+        # The token cache from the last run (if there is one)
+        # Encrypted with 'cache_key', or the client secret if not set
+        self.cache = tokencache.TokenCache(
+            TEAMS.get('token_cache', tokencache.CACHE_FILE),
+            TEAMS.get('cache_key') or CLIENT_SECRET
+        )
+        self.cache.load()
+
+        # Older versions kept the token (and refresh token) in token.txt
+        tokenstore.remove_token_file()
+
         self.app = ConfidentialClientApplication(
             client_id=APPLICATION_ID,
             client_credential=CLIENT_SECRET,
-            authority=login_url
+            authority=login_url,
+            token_cache=self.cache
         )
 
+        # The latest refresh token, used by the scheduled refresh
+        self.refresh_value = None
+
+    # Get a token without a user if possible, or ask a user to log in
+    def login(self):
+        '''
+        Returns True if a token was found in the cache
+        Returns False if a user needs to log in (the browser is opened)
+        '''
+        access_token = self.silent_auth()
+        if access_token is not None:
+            print(termcolor.colored(
+                'Graph API token loaded from the token cache',
+                "green"))
+            self.accept(access_token)
+            return True
+
+        print(termcolor.colored(
+            'No usable token in the cache, a user needs to log in',
+            "yellow"))
+        self.client_auth()
+        return False
+
+    # Get a token from the cache, refreshing it if it's close to expiry
+    def silent_auth(self, force_refresh=False):
+        '''
+        Optionally, takes force_refresh to get a new token,
+            even if the cached one is still valid
+        Returns the token, or None if the cache can't be used
+        '''
+        accounts = self.app.get_accounts(username=TEAMS['user'])
+        for account in accounts:
+            try:
+                access_token = self.app.acquire_token_silent(
+                    scopes=self.SCOPES,
+                    account=account,
+                    force_refresh=force_refresh
+                )
+            except Exception as e:
+                print(termcolor.colored(
+                    'Could not get a token from the token cache',
+                    "red"))
+                print(e)
+                continue
+
+            if access_token and 'access_token' in access_token:
+                return access_token
+
+            if access_token:
+                print(access_token.get('error_description'))
+
+        return None
+
     # This generates the URL that user would use to authenticate and
     # authorize the app based on the requested permissions
     # We use the webbrowser module to pop up a request for the user
@@ -82,60 +160,80 @@ class AzureAuth:
             scopes=self.SCOPES
         )
 
-        self.save_token(access_token)
-        self.schedule_refresh(
-            access_token['expires_in'],
-            access_token['refresh_token']
-        )
+        if 'error' in access_token:
+            print(termcolor.colored(
+                'An error occurred while trying to get the token',
+                "red"))
+            print(access_token.get('error_description'))
+            return False
+
+        self.accept(access_token)
+        return True
 
     # Refresh the token to Graph API
-    def refresh_token(self, token):
-        '''Takes a token and refreshes it'''
+    # Run by the scheduler; Returns False if it failed, so it's retried
+    def refresh_token(self, token=None):
+        '''
+        Takes a refresh token,
+            or uses the token cache (or the latest refresh token)
+        '''
         # Using the MSAL library
-        access_token = self.app.acquire_token_by_refresh_token(
-            refresh_token=token,
-            scopes=self.SCOPES
-        )
+        access_token = None
+        if token is None:
+            access_token = self.silent_auth(force_refresh=True)
+
+        if access_token is None and not (token or self.refresh_value):
+            print(termcolor.colored(
+                'There is no token to refresh, a user needs to log in',
+                "red"))
+            return False
+
+        if access_token is None:
+            access_token = self.app.acquire_token_by_refresh_token(
+                refresh_token=token or self.refresh_value,
+                scopes=self.SCOPES
+            )
 
         if 'error' in access_token:
             print(termcolor.colored(
                 'An error occurred while trying to refresh the token',
                 "red"))
-            print(access_token['error_description'])
+            print(access_token.get('error_description'))
+            return False
 
-        else:
-            print(termcolor.colored(
-                'Graph API token refresh successful',
-                "green"))
-            self.save_token(access_token)
-            self.schedule_refresh(access_token['expires_in'],
-                                  access_token['refresh_token'])
+        print(termcolor.colored(
+            'Graph API token refresh successful',
+            "green"))
+        self.accept(access_token)
+        return True
 
-        # Take this opportunity to refresh the config for each plugin
-        for plugin in plugin_list:
-            print(termcolor.colored(
-                f"Refreshing plugin config: {plugin}",
-                "yellow"))
-            plugin['handler'].refresh()
+    # Use a new token, keep the cache, and schedule the next refresh
+    def accept(self, access_token):
+        self.save_token(access_token)
+        self.cache.save()
+        self.schedule_refresh(
+            access_token['expires_in'],
+            access_token.get('refresh_token')
+        )
 
-    # Save the token to a file
+    # Save the token
     def save_token(self, access_token):
-        '''Saves the given access token to token.txt'''
-        # Change single quotes to double quotes (valid JSON)
-        temp = str(access_token).replace("'", "\"")
-
-        # Write the token information to a file (overwrite previous contents)
-        with open("token.txt", "w") as file:
-            file.write(temp)
+        '''
+        Makes the given access token available to all threads
+        Nothing is written in clear text; For the next cold start,
+            the token comes from the encrypted token cache
+        '''
+        tokenstore.set_token(access_token)
 
     # Schedule a token refresh, 5 minutes before the current one expires
     def schedule_refresh(self, expiry, token):
         '''Schedules a refresh of the token
-        takes the expiry time in seconds, and the refresh token'''
-        print(termcolor.colored('starting token refresh thread', "green"))
-        start_time = threading.Timer(
-            (expiry - 300),
-            self.refresh_token,
-            [token]
-        )
-        start_time.start()
+        takes the expiry time in seconds, and the refresh token
+        There's only ever one refresh job, however often this is called'''
+        if token:
+            self.refresh_value = token
+        delay = max(expiry - REFRESH_MARGIN, 0)
+        print(termcolor.colored(
+            f"Token refresh scheduled in {delay} seconds",
+            "green"))
+        scheduler.jobs.add('token-refresh', self.refresh_token, delay=delay)
@@ -0,0 +1,100 @@
+"""
+Encodes and decodes JSON for webhooks
+The codec can be changed in config.yaml, to use a faster JSON library
+
+Usage:
+    import 'codec' into the application
+    Call codec.json.loads() with bytes (or a memoryview) to parse a body
+    Call codec.json.dumps() to encode an object; Returns a string
+    get_codec() returns the codec named in the 'request' section of
+        config.yaml ('auto', 'orjson', or 'json')
+
+Authentication:
+    N/A
+
+Restrictions:
+    'orjson' requires the orjson module (pip install orjson)
+        'auto' uses orjson if it's installed, or the standard json module
+    orjson parses a memoryview without copying it;
+        The standard json module needs the bytes first
+    Both raise ValueError for invalid JSON
+
+To Do:
+    None
+"""
+
+
+import json as std_json
+import termcolor
+from config import REQUEST
+
+# Optional; Only used if it's installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Default, used if the 'request' section of config.yaml is missing
+JSON_CODEC = 'auto'
+
+
+class JsonCodec():
+    # The name used in config.yaml
+    name = 'json'
+
+    # Parse JSON from bytes, a memoryview, or a string
+    def loads(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return std_json.loads(data)
+
+    # Encode an object as JSON (a string)
+    def dumps(self, value):
+        return std_json.dumps(value)
+
+
+class OrjsonCodec(JsonCodec):
+    name = 'orjson'
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    # orjson returns bytes; Anything it can't encode uses str()
+    def dumps(self, value):
+        return orjson.dumps(value, default=str).decode()
+
+
+# Codecs that can be selected in config.yaml
+CODECS = {
+    JsonCodec.name: JsonCodec,
+    OrjsonCodec.name: OrjsonCodec,
+}
+
+
+# Get the codec selected in config.yaml
+def get_codec(name):
+    '''
+    Takes the codec name ('auto', 'orjson', or 'json')
+    Returns a codec object
+    '''
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+
+    if name == 'orjson' and orjson is None:
+        print(termcolor.colored(
+            "The orjson module isn't installed, using 'json'",
+            "yellow"))
+        name = 'json'
+
+    if name not in CODECS:
+        print(termcolor.colored(
+            f"Unknown JSON codec '{name}', using 'json'",
+            "red"))
+        name = 'json'
+
+    return CODECS[name]()
+
+
+# The shared codec
+json = get_codec(REQUEST.get('json_codec', JSON_CODEC))
@@ -1,4 +1,3 @@
-
 """
 Verifies and decrypts Resource Data sent from the Graph API
 Used when people write to the chat bot
@@ -6,8 +5,12 @@ Used when people write to the chat bot
 Usage:
     import this module into the application
     Call rsa_decrypt() to decrypt the symmetric key
+        Pass the notification's 'encryptionCertificateId',
+        so the matching key is used
     Call validate() to validate the signature
     Call aes_decrypt() to decrypt the message body
+    Or, call decrypt_content() to do all three for a notification
+    Use crypto.keys (a KeyManager) to get the certificate for subscribing
 
 Authentication:
     Requires the private key in a PEM file
@@ -16,6 +19,11 @@ Authentication:
 
 Restrictions:
     pip install pycryptodome
+    Keys are parsed once, and only reloaded when their files change
+        Files are checked at most every 'key_check_interval' seconds
+    Several keys can be configured (the 'keys' list in the 'graph' section
+        of config.yaml), so old and new keys overlap during rotation
+        The first key is used for new subscriptions
 
 To Do:
     None
@@ -29,35 +37,184 @@ from Crypto.Cipher import PKCS1_OAEP, AES
 from Crypto.PublicKey import RSA
 from Crypto.Util.Padding import unpad
 from base64 import b64decode, b64encode
+from config import GRAPH
+import os
+import time
+import threading
+import termcolor
 import hmac
 import hashlib
 import json
 
 
 PRIV_KEY = 'core\\private.pem'
+PUB_KEY = 'core\\public.pem'
+
+# Default seconds between checks for changed key files
+KEY_CHECK_INTERVAL = 30
+
+
+class KeyPair():
+    '''
+    One parsed key pair, and the cipher that uses it
+    The cipher has no per-message state, so threads can share it
+    '''
+    def __init__(self, key_id, certificate_file, private_file):
+        self.id = str(key_id)
+        self.certificate_file = certificate_file
+        self.private_file = private_file
+        self.mtimes = self.file_times()
+
+        # The certificate, as Graph wants it (no header or footer)
+        with open(certificate_file, 'r') as file:
+            certificate = file.read()
+        self.certificate = ''.join(
+            line for line in certificate.strip().splitlines()
+            if not line.startswith('-----')
+        )
+
+        # Imports the private key into an 'RsaKey' object
+        # The 'PRIVATE KEY' tags need to exist in the file
+        # Assumes no passphrase is needed
+        with open(private_file, 'r') as file:
+            rsa_key = RSA.import_key(file.read())
+        self.modulus = rsa_key.size_in_bytes()
+        self.cipher = PKCS1_OAEP.new(rsa_key)
+
+    # Get the modified time of each file (None if it's missing)
+    def file_times(self):
+        times = []
+        for path in (self.certificate_file, self.private_file):
+            try:
+                times.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                times.append(None)
+        return tuple(times)
+
+    # Check if the files have changed since they were loaded
+    def changed(self):
+        return self.file_times() != self.mtimes
+
+
+class KeyManager():
+    # Initialise with a list of keys; Each has an id, and two file names
+    def __init__(self, key_list, check_interval=KEY_CHECK_INTERVAL):
+        self.key_list = key_list
+        self.check_interval = check_interval
+        self.keys = {}
+        self.first = None
+        self.checked = 0.0
+        self.lock = threading.Lock()
+        self.stats = {'loads': 0, 'errors': 0, 'unknown': 0}
+
+    # Load (or reload) any keys that are new or have changed
+    def load(self):
+        with self.lock:
+            self.checked = time.monotonic()
+            for entry in self.key_list:
+                key_id = str(entry['id'])
+                current = self.keys.get(key_id)
+                if current is not None and not current.changed():
+                    continue
+
+                try:
+                    self.keys[key_id] = KeyPair(
+                        key_id,
+                        entry['certificate'],
+                        entry['private_key']
+                    )
+                    self.stats['loads'] += 1
+
+                # Keep the old copy of the key if the new files are bad
+                #   (eg, they're part way through being replaced)
+                except (OSError, ValueError, IndexError, TypeError) as e:
+                    self.stats['errors'] += 1
+                    print(termcolor.colored(
+                        f"Could not load encryption key {key_id}: {e}",
+                        "red"))
+
+            if self.key_list:
+                self.first = str(self.key_list[0]['id'])
+
+    # Reload keys if it's time to check the files again
+    def refresh(self):
+        if time.monotonic() - self.checked >= self.check_interval:
+            self.load()
+
+    # Get the key pair for an 'encryptionCertificateId'
+    def get(self, key_id=None):
+        '''
+        Takes the certificate ID from a notification
+            If it's missing, the first key is used
+        Returns a KeyPair, or None if there is no such key
+        '''
+        self.refresh()
+        key_id = self.first if key_id is None else str(key_id)
+        key = self.keys.get(key_id)
+
+        # A new key may have just been added; Check the files once more
+        if key is None:
+            self.load()
+            key = self.keys.get(key_id)
+            if key is None:
+                with self.lock:
+                    self.stats['unknown'] += 1
+        return key
+
+    # Get the key to use for new subscriptions
+    def current(self):
+        return self.get()
+
+    # Report the loaded keys
+    def status(self):
+        '''Returns a dictionary of key IDs and counters'''
+        with self.lock:
+            return {
+                'keys': list(self.keys),
+                'current': self.first,
+                **self.stats,
+            }
+
+
+# Get the key list from config.yaml
+# Older configs just have 'key_id', with the key files in the core folder
+def key_list(config):
+    if 'keys' in config:
+        return config['keys']
+
+    return [{
+        'id': config.get('key_id', ''),
+        'certificate': PUB_KEY,
+        'private_key': PRIV_KEY,
+    }]
+
+
+# The shared key manager; Keys are loaded when first used
+keys = KeyManager(
+    key_list(GRAPH),
+    GRAPH.get('key_check_interval', KEY_CHECK_INTERVAL)
+)
 
 
 # Decrypt the encrypted symmetric key
-def rsa_decrypt(encrypted_symmetric_key):
+def rsa_decrypt(encrypted_symmetric_key, key_id=None):
     '''
     Decrypts the encrypted session key, as sent from Graph API
-    Takes the encrypted key as an argument
-    Returns the decrypted key
+    Takes the encrypted key as an argument,
+        and the 'encryptionCertificateId' from the notification
+    Returns the decrypted key, or None if there's no matching key
     '''
-    # Read the private key as raw text
-    # the 'PRIVATE KEY' tags need to exist in the file
-    with open(PRIV_KEY, 'r') as file:
-        private_key = file.read()
-
-    # Imports the private key into an 'RsaKey' object
-    # Assumes no passphrase is needed
-    rsa_key = RSA.import_key(private_key)
-    rsa_modulus = rsa_key.n.bit_length() / 8
+    key = keys.get(key_id)
+    if key is None:
+        print(termcolor.colored(
+            f"No encryption key with ID {key_id}",
+            "red"))
+        return None
 
     # PKCS#1 OAEP is an asymmetric cipher based on RSA with OAEP Padding
     # This can only handle messages smaller than the RSA modulus
-    # Create a cipher object that encrypts/decrypts based on the RSA key
-    rsa_cipher = PKCS1_OAEP.new(rsa_key)
+    rsa_modulus = key.modulus
+    rsa_cipher = key.cipher
 
     # The symmetric key and data from the Graph API is Base64 encoded
     # This decodes both into raw bytes
@@ -126,10 +283,12 @@ def validate(decrypted_symmetric_key, data, signature):
     local_hash = b64encode(local_hash).decode()
 
     # Check if the signatures match
-    if local_hash == signature:
-        return True
-    else:
-        return False
+    # compare_digest() takes the same time wherever they differ,
+    #   so the signature can't be guessed a byte at a time
+    return hmac.compare_digest(
+        local_hash.encode(),
+        str(signature).encode()
+    )
 
 
 # Decrypt the body of the message
@@ -156,3 +315,29 @@ def aes_decrypt(decrypted_symmetric_key, data):
     decrypted_payload = json.loads(decrypted_payload)
 
     return decrypted_payload
+
+
+# Decrypt and validate the encrypted content of a notification
+def decrypt_content(encrypted_content):
+    '''
+    Takes the 'encryptedContent' from one notification item
+    Returns the decrypted message in JSON form,
+        or None if it can't be decrypted, or fails validation
+    This only uses module state, so it can run in a process pool
+    '''
+    decrypted_symmetric_key = rsa_decrypt(
+        encrypted_content['dataKey'],
+        encrypted_content.get('encryptionCertificateId')
+    )
+    if decrypted_symmetric_key is None:
+        return None
+
+    # Validate the signature - Tamper prevention
+    if not validate(
+        decrypted_symmetric_key,
+        encrypted_content['data'],
+        encrypted_content['dataSignature']
+    ):
+        return None
+
+    return aes_decrypt(decrypted_symmetric_key, encrypted_content['data'])
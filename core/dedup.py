@@ -0,0 +1,119 @@
+"""
+Detects duplicate events, so they're only handled once
+Some senders (eg, Mist) occasionally send the same webhook twice,
+    and Log Insight may fire the same alert again
+
+Usage:
+    import 'dedup' into a plugin, or use the PluginTemplate class
+    Create a DedupCache object, with a time to live and a maximum size
+    Call event_key() to get a stable hash of an event's fields
+    Call seen() with the key; It returns True if this is a duplicate
+    Call forget() to remove a key, if the item wasn't handled after all
+    Call status() to get hit and miss counts
+
+Authentication:
+    N/A
+
+Restrictions:
+    Keys are 16-byte hashes, so memory use is bounded by 'max_entries'
+    Events are duplicates if their key was seen within 'ttl' seconds
+    When the cache is full, the least recently seen key is removed
+
+To Do:
+    None
+"""
+
+
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+# Defaults
+DEDUP_TTL = 60
+DEDUP_MAX_ENTRIES = 10000
+
+
+# Get a stable hash of an event
+def event_key(event, fields=None, exclude=()):
+    '''
+    Takes an event, and an optional list of fields to use
+        If no fields are given, all fields are used except 'exclude'
+    Returns a 16-byte hash, which is the same whatever the key order
+    '''
+    if fields:
+        selected = {field: event.get(field) for field in fields}
+    else:
+        selected = {
+            field: value for field, value in event.items()
+            if field not in exclude
+        }
+
+    data = json.dumps(selected, sort_keys=True, default=str)
+    return hashlib.blake2b(data.encode(), digest_size=16).digest()
+
+
+class DedupCache():
+    # Initialise an empty cache
+    def __init__(self, ttl=DEDUP_TTL, max_entries=DEDUP_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        # Key -> expiry time, least recently seen first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evicted': 0,
+        }
+
+    # Check if a key has been seen recently, and remember it
+    def seen(self, key):
+        '''
+        Returns True if the key was seen within the TTL (a duplicate)
+        Returns False, and remembers the key, if it's new
+        '''
+        now = time.monotonic()
+
+        with self.lock:
+            expiry = self.entries.get(key)
+            if expiry is not None and expiry > now:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return True
+
+            self.entries[key] = now + self.ttl
+            self.entries.move_to_end(key)
+            self.stats['misses'] += 1
+
+            # Remove expired keys from the front,
+            #   then the least recently seen if still over the limit
+            while self.entries:
+                oldest, expiry = next(iter(self.entries.items()))
+                if expiry > now and len(self.entries) <= self.max_entries:
+                    break
+                del self.entries[oldest]
+                if expiry > now:
+                    self.stats['evicted'] += 1
+
+        return False
+
+    # Remove a key, so the next copy isn't treated as a duplicate
+    def forget(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    # Report cache statistics
+    def status(self):
+        '''Returns a dictionary of hit, miss, and eviction counts'''
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+
+        stats['max_entries'] = self.max_entries
+        stats['ttl'] = self.ttl
+        return stats
@@ -0,0 +1,238 @@
+"""
+Combines bursts of alerts into a single Teams message (a digest)
+When a site has an outage, many similar alerts arrive within seconds
+    Rather than send each one, they're held briefly and sent together
+
+Usage:
+    import 'digest' into a plugin
+    Call digest.alerts.submit() with the message, level, site and type
+        Returns True if the message is held for a digest
+        Returns False if the caller should send the message itself
+    The web service calls digest.alerts.start() to run the flush thread
+        Until this is started, submit() always returns False
+
+Authentication:
+    N/A
+
+Restrictions:
+    Alerts are grouped by site and event type
+    A group is sent once no new alerts have arrived for 'window' seconds,
+        or once the first alert has been held for 'max_hold' seconds,
+        or once the group has 'max_size' alerts
+    Only levels listed in 'levels' are held
+    Event types listed in 'immediate' are never held
+    Held alerts are in memory only, so are lost if the service stops
+    If a digest can't be sent, its alerts are held again, and sent with
+        the next digest for that group; After 'DIGEST_RETRIES' failures
+        they're dropped (and logged)
+
+To Do:
+    None
+"""
+
+
+import time
+import threading
+import termcolor
+from config import DIGEST
+from core import teamschat
+
+
+# How many times to try sending a digest before dropping it
+DIGEST_RETRIES = 3
+
+
+class Digest():
+    # Initialise the digest from the 'digest' section of config.yaml
+    def __init__(self, config):
+        self.enabled = config.get('enabled', False)
+        self.window = config.get('window', 30)
+        self.max_hold = config.get('max_hold', 120)
+        self.max_size = config.get('max_size', 50)
+        self.levels = set(config.get('levels', [2]))
+        self.immediate = set(config.get('immediate') or [])
+
+        # Groups of held alerts, keyed by (site, type)
+        self.groups = {}
+        self.condition = threading.Condition()
+        self.thread = None
+
+        self.stats = {
+            'held': 0,
+            'bypassed': 0,
+            'digests': 0,
+            'errors': 0,
+            'dropped': 0,
+        }
+
+    # Start the thread that sends digests when they're due
+    def start(self):
+        if not self.enabled or self.thread is not None:
+            return
+
+        self.thread = threading.Thread(
+            target=self.run,
+            name='digest',
+            daemon=True
+        )
+        self.thread.start()
+
+    # Hold a message for a digest, if it should be
+    def submit(self, message, level, site, type, immediate=False):
+        '''
+        Takes a message, its level, the site, and the event type
+        Returns True if the message is held for a digest
+        Returns False if the caller should send it now
+        '''
+        if (
+            self.thread is None or
+            immediate or
+            level not in self.levels or
+            type in self.immediate
+        ):
+            with self.condition:
+                self.stats['bypassed'] += 1
+            return False
+
+        full = None
+        key = (site, type)
+        now = time.monotonic()
+
+        with self.condition:
+            group = self.groups.get(key)
+            if group is None:
+                group = {'first': now, 'last': now, 'messages': []}
+                self.groups[key] = group
+
+            group['messages'].append(message)
+            group['last'] = now
+            self.stats['held'] += 1
+
+            # Send straight away if the group is full
+            if len(group['messages']) >= self.max_size:
+                full = self.groups.pop(key)
+            else:
+                self.condition.notify()
+
+        if full:
+            self.deliver(key, full)
+
+        return True
+
+    # Thread; Send digests as they become due
+    def run(self):
+        while True:
+            due = []
+            with self.condition:
+                now = time.monotonic()
+
+                # With nothing held, wait until something is submitted
+                wait = None
+
+                for key, group in list(self.groups.items()):
+                    send_at = min(
+                        group['last'] + self.window,
+                        group['first'] + self.max_hold
+                    )
+                    if send_at <= now:
+                        due.append((key, self.groups.pop(key)))
+                    elif wait is None or send_at - now < wait:
+                        wait = send_at - now
+
+                if not due:
+                    self.condition.wait(wait)
+
+            # Send outside the lock, as the Graph API may be slow
+            for key, group in due:
+                self.deliver(key, group)
+
+    # Send a group, and hold it again if it can't be sent
+    # An error sending one digest must not stop the thread
+    def deliver(self, key, group):
+        try:
+            sent = self.send(key, group)
+
+        except Exception as e:
+            sent = False
+            print(termcolor.colored(
+                f"Error sending a digest for {key[0]} ({key[1]}): {e}",
+                "red"))
+
+        if not sent:
+            self.retry(key, group)
+
+    # Hold a group that couldn't be sent, to try again with the next digest
+    def retry(self, key, group):
+        site, type = key
+        count = len(group['messages'])
+        group['attempts'] = group.get('attempts', 0) + 1
+
+        with self.condition:
+            self.stats['errors'] += 1
+
+            if group['attempts'] >= DIGEST_RETRIES:
+                self.stats['dropped'] += count
+                print(termcolor.colored(
+                    f"Dropping a digest of {count} alerts for {site} "
+                    f"({type}), after {group['attempts']} failed attempts",
+                    "red"))
+                return
+
+            print(termcolor.colored(
+                f"Could not send a digest of {count} alerts for {site} "
+                f"({type}); Trying again in {self.window} seconds",
+                "red"))
+
+            # Join any alerts that arrived in the meantime,
+            #   or wait another 'window' before trying again
+            current = self.groups.get(key)
+            if current is not None:
+                current['messages'][:0] = group['messages']
+                current['attempts'] = group['attempts']
+            else:
+                now = time.monotonic()
+                group['first'] = now
+                group['last'] = now
+                self.groups[key] = group
+            self.condition.notify()
+
+    # Send a group of alerts as one message
+    # Returns True if it was sent
+    def send(self, key, group):
+        site, type = key
+        messages = group['messages']
+
+        with self.condition:
+            self.stats['digests'] += 1
+
+        # A single alert doesn't need a digest header
+        if len(messages) == 1:
+            return bool(teamschat.send_chat(messages[0]))
+
+        held = round(time.monotonic() - group['first'])
+        header = f"<b>{len(messages)} alerts</b> in the \
+            <span style=\"color:Lime\"><b>{site}</b></span> site \
+            (<span style=\"color:Orange\"><b>{type}</b></span>) \
+            in the last {held} seconds:<br>"
+
+        print(termcolor.colored(
+            f"Sending a digest of {len(messages)} alerts for {site} ({type})",
+            "cyan"))
+        return bool(teamschat.send_chat(header + '<br>'.join(messages)))
+
+    # Report digest statistics
+    def status(self):
+        '''Returns a dictionary of digest statistics'''
+        with self.condition:
+            stats = dict(self.stats)
+            stats['groups'] = len(self.groups)
+            stats['waiting'] = sum(
+                len(group['messages']) for group in self.groups.values()
+            )
+
+        stats['enabled'] = self.thread is not None
+        return stats
+
+
+# The shared digest, used by all plugins
+alerts = Digest(DIGEST)
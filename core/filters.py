@@ -0,0 +1,231 @@
+"""
+Filters out events that match configured keywords or patterns
+
+Usage:
+    import 'filters' into a plugin, or use the PluginTemplate class
+    Create an EventFilter object from the plugin's 'filter' config list
+        This compiles all filters once, not per event
+    Call check() with a parsed event; It returns the filter that matched,
+        or None if the event should be kept
+    Call status() to get the hit count for each filter
+
+    Each entry in the 'filter' list may be:
+        A string - Filter events containing this text in any field
+        A dictionary, with:
+            field - One of 'site', 'device', 'type', 'text', or 'any'
+            match - Plain text to look for, or
+            regex - A regular expression to search for
+
+Authentication:
+    N/A
+
+Restrictions:
+    Matching is case sensitive
+    The regexes for a field are combined into one, so each event is only
+        searched once per field
+        A regex that can't be combined (eg, it uses a numbered
+        backreference like \\1, or an inline flag) is searched on its own
+    Each plugin maps the logical fields (site, device, etc) to the keys
+        in its own events (see PluginTemplate.FILTER_FIELDS)
+
+To Do:
+    None
+"""
+
+
+import re
+import threading
+import termcolor
+from core import matcher
+
+
+# Logical fields that filters can be scoped to
+FIELDS = ('site', 'device', 'type', 'text', 'any')
+
+# Numbered backreferences (\1) and conditionals ((?(1)...)) refer to
+#   groups by position, which changes when regexes are combined
+NUMBERED_REFERENCE = re.compile(r'\\[1-9]|\(\?\(\d')
+
+
+class EventFilter():
+    # Compile the list of filters
+    def __init__(self, entries, fields):
+        '''
+        Takes the 'filter' list from a plugin's config,
+            and a dictionary mapping each logical field to event keys
+        '''
+        self.fields = fields
+        self.filters = []
+        self.hits = []
+        self.lock = threading.Lock()
+
+        # Group the filters by field, then by type
+        keywords = {}
+        patterns = {}
+        for entry in entries:
+            if isinstance(entry, dict):
+                field = entry.get('field', 'any')
+                if field not in FIELDS:
+                    print(termcolor.colored(
+                        f"Unknown filter field '{field}', "
+                        f"filtering on any field instead",
+                        "yellow"))
+                    field = 'any'
+
+                if 'regex' in entry:
+                    try:
+                        re.compile(entry['regex'])
+                    except re.error as err:
+                        print(termcolor.colored(
+                            f"Invalid filter regex '{entry['regex']}', "
+                            f"ignoring it",
+                            "red"))
+                        print(err)
+                        continue
+                    patterns.setdefault(field, []).append(
+                        (len(self.filters), entry['regex'])
+                    )
+                    label = f"{field} ~ {entry['regex']}"
+
+                else:
+                    keywords.setdefault(field, {})[str(entry['match'])] = \
+                        len(self.filters)
+                    label = f"{field}: {entry['match']}"
+
+            # A plain string filters on any field
+            else:
+                keywords.setdefault('any', {})[str(entry)] = len(self.filters)
+                label = str(entry)
+
+            self.filters.append(label)
+            self.hits.append(0)
+
+        # For each field, compile a keyword matcher, and one combined regex
+        # Each regex is a named group, so we know which one matched
+        self.compiled = []
+        for field in FIELDS:
+            if field not in keywords and field not in patterns:
+                continue
+
+            keyword_matcher = None
+            if field in keywords:
+                keyword_matcher = matcher.Matcher(keywords[field])
+
+            regex = None
+            separate = []
+            if field in patterns:
+                regex, separate = self.combine(field, patterns[field])
+
+            self.compiled.append((
+                field, keyword_matcher, keywords.get(field, {}),
+                regex, separate
+            ))
+
+    # Combine a field's regexes into one, where they can be
+    def combine(self, field, patterns):
+        '''
+        Takes the field, and a list of (filter number, regex)
+        Returns the combined regex (or None),
+            and a list of (filter number, compiled regex) to search alone
+        '''
+        combined = []
+        separate = []
+        for number, pattern in patterns:
+            if NUMBERED_REFERENCE.search(pattern) is None:
+                try:
+                    re.compile(f"(?P<filter{number}>{pattern})")
+                    combined.append((number, pattern))
+                    continue
+                except re.error:
+                    pass
+
+            print(termcolor.colored(
+                f"Filter regex '{pattern}' can't be combined with others; "
+                f"It will be searched on its own",
+                "yellow"))
+            separate.append((number, pattern))
+
+        regex = None
+        if combined:
+            try:
+                regex = re.compile('|'.join(
+                    f"(?P<filter{number}>{pattern})"
+                    for number, pattern in combined
+                ))
+
+            # They may clash with each other (eg, the same group name)
+            except re.error as err:
+                print(termcolor.colored(
+                    f"The '{field}' filter regexes can't be combined ({err}); "
+                    f"Each will be searched on its own",
+                    "yellow"))
+                separate = combined + separate
+
+        return regex, [
+            (number, re.compile(pattern)) for number, pattern in separate
+        ]
+
+    # Get the text for a logical field from an event
+    def field_text(self, event, field):
+        if field == 'any':
+            keys = event.keys()
+        else:
+            keys = self.fields.get(field, ())
+
+        values = []
+        for key in keys:
+            value = event.get(key)
+            if value is None:
+                continue
+            elif isinstance(value, str):
+                values.append(value)
+            elif isinstance(value, list):
+                values.extend(str(item) for item in value)
+            else:
+                values.append(str(value))
+
+        return '\n'.join(values)
+
+    # Check an event against the filters
+    def check(self, event):
+        '''
+        Takes a parsed event
+        Returns the filter that matched, or None if nothing matched
+        '''
+        for field, keyword_matcher, keywords, regex, separate in \
+                self.compiled:
+            text = self.field_text(event, field)
+
+            if keyword_matcher:
+                keyword = keyword_matcher.first(text)
+                if keyword is not None:
+                    return self.hit(keywords[keyword])
+
+            if regex:
+                match = regex.search(text)
+                if match:
+                    for name, value in match.groupdict().items():
+                        if name.startswith('filter') and value is not None:
+                            return self.hit(int(name[6:]))
+
+            for number, pattern in separate:
+                if pattern.search(text):
+                    return self.hit(number)
+
+        return None
+
+    # Count a hit against a filter
+    def hit(self, number):
+        with self.lock:
+            self.hits[number] += 1
+
+        return self.filters[number]
+
+    # Report the hit count for each filter
+    def status(self):
+        '''Returns a list of filters, and how many events each has hit'''
+        with self.lock:
+            return [
+                {'filter': label, 'hits': hits}
+                for label, hits in zip(self.filters, self.hits)
+            ]
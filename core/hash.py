@@ -1,16 +1,30 @@
-
 """
 Creates a HMAC hash, to verify the sender of the webhook
 
 Usage:
     import this module into the application
+    Create a Verifier with the auth header and the plugin's secrets,
+        and call verify() with each webhook
+        (the plugin template does this)
+    Call release() if a verified webhook couldn't be accepted
+        (eg, the queue was full), so the sender's retry isn't
+        rejected as a replay
+    auth_message() checks a single webhook, without a Verifier
 
 Authentication:
     Webhooks can be sent with a secret, which authenticates the source
     No authentication required to access functions in this module
 
 Restrictions:
-    None
+    A HMAC context is prepared for each secret once, and copied for
+        each webhook, so the key isn't processed every time
+    Several secrets can be active at once, so a secret can be changed
+        on the sender without rejecting webhooks in the meantime
+    Signatures are compared in constant time
+    The replay cache is optional (set 'replay_window' in the plugin config)
+        It remembers each signature for the window, and rejects repeats
+        If 'timestamp_header' is set, webhooks with a timestamp outside
+        the window are rejected too
 
 To Do:
     None
@@ -21,7 +35,110 @@ Author:
 
 
 import hmac
-import hashlib
+import time
+from core import dedup
+
+
+class Verifier():
+    # Prepare a HMAC context for each secret
+    def __init__(self, header, secrets, replay_window=0,
+                 timestamp_header=None):
+        '''
+        Takes the header that holds the signature, and a secret
+            (or a list of secrets)
+        Optionally, takes the replay window in seconds,
+            and the header that holds the sender's timestamp
+        '''
+        if isinstance(secrets, str):
+            secrets = [secrets]
+
+        self.header = header
+        self.contexts = [
+            hmac.new(str(secret).encode(), digestmod='sha256')
+            for secret in secrets
+            if secret
+        ]
+
+        self.replay_window = replay_window
+        self.timestamp_header = timestamp_header
+        self.replay = None
+        if replay_window:
+            self.replay = dedup.DedupCache(
+                ttl=replay_window,
+                max_entries=dedup.DEDUP_MAX_ENTRIES
+            )
+
+    # Check the signature of a message body
+    def check(self, data, signature):
+        '''
+        Takes the message body (bytes, or a memoryview),
+            and the signature the sender calculated (hex)
+        Returns True if any active secret gives the same signature
+        '''
+        try:
+            signature = signature.strip().lower().encode('ascii')
+        except (AttributeError, UnicodeError):
+            return False
+
+        for context in self.contexts:
+            local = context.copy()
+            local.update(data)
+            if hmac.compare_digest(local.hexdigest().encode(), signature):
+                return True
+
+        return False
+
+    # Check if a webhook has been seen before, or is too old
+    def replayed(self, webhook, signature):
+        if self.replay is None:
+            return False
+
+        if self.timestamp_header:
+            try:
+                sent = float(webhook.headers[self.timestamp_header])
+            except (KeyError, TypeError, ValueError):
+                return True
+            if abs(time.time() - sent) > self.replay_window:
+                return True
+
+        return self.replay.seen(signature)
+
+    # Authenticate a webhook
+    def verify(self, webhook):
+        '''
+        Takes the webhook (a Flask request)
+        Returns 'success', 'fail', 'unauthenticated' (no signature sent),
+            or 'replayed'
+        '''
+        if self.header not in webhook.headers:
+            return ('unauthenticated')
+
+        signature = webhook.headers[self.header]
+        if not self.check(webhook.get_data(), signature):
+            return ('fail')
+
+        if self.replayed(webhook, signature):
+            return ('replayed')
+
+        return ('success')
+
+    # Forget a webhook's signature, so a retry isn't seen as a replay
+    def release(self, webhook):
+        '''
+        Takes a webhook that passed verify(), but wasn't accepted
+        '''
+        if self.replay is None or self.header not in webhook.headers:
+            return
+
+        self.replay.forget(webhook.headers[self.header])
+
+    # Report replay cache statistics
+    def status(self):
+        '''Returns a dictionary with the number of active secrets'''
+        stats = {'secrets': len(self.contexts)}
+        if self.replay is not None:
+            stats['replay'] = self.replay.status()
+        return stats
 
 
 # Authenticate if a message was genuine
@@ -32,25 +149,6 @@ def auth_message(header, secret, webhook):
     Takes a secret, and the webook sent by Mist
     Creates a hash of the secret and webhook body (HMAC SHA256)
     and compares the result
+    Plugins should keep a Verifier instead, so the secret is prepared once
     '''
-
-    # Check that Mist sent the signature in the header
-    if header in webhook.headers:
-        # Get the message body
-        data = webhook.get_data()
-
-        # Get the hash that Mist has sent
-        mist_hash = webhook.headers[header]
-
-        # Generate our own hash
-        hash = hmac.new(secret.encode(), data, hashlib.sha256).hexdigest()
-
-        # Compare the Mist hash with our hash
-        if mist_hash == hash:
-            return ('success')
-        else:
-            return ('fail')
-
-    # If Mist didn't send the signature, report it
-    else:
-        return ('unauthenticated')
+    return Verifier(header, secret).verify(webhook)
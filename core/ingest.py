@@ -0,0 +1,528 @@
+"""
+Queues incoming webhooks, so the web service can respond straight away
+Worker threads take webhooks off the queue and pass them to the plugins
+
+Usage:
+    import 'ingest' into the application
+    Create an EventQueue object, and call start() to run the workers
+    Wrap each request in a Webhook, so the body is read once
+        Authentication, the spool, and the plugin all share it
+    Call put() with the plugin entry, the webhook body, and the source IP
+        Pass the raw body too, so the spool doesn't encode it again
+        put() returns False if the webhook could not be queued
+    Optionally, pass a Spool object, so webhooks are written to disk
+        before they're queued, and marked as done once handled
+    Call replay() with records from the spool, before serving traffic
+        They're queued by a background thread, so startup doesn't wait
+        for room in the queue
+        Pass a 'ready' function, so replayed webhooks wait until
+        it returns True (eg, until there's a Teams token)
+    Call status() to get queue statistics
+
+Authentication:
+    N/A - Webhooks should be authenticated before they are queued
+
+Restrictions:
+    Without a spool, the queue is in memory only
+        Webhooks that are queued but not processed are lost on restart
+    A spooled webhook is marked as done once the plugin has tried to send
+        its alerts to Teams, and its SQL rows are finished with
+        Plugins return these from handle_event(); If a plugin returns
+        nothing, the webhook is marked as done when the handler returns
+    Alerts that weren't sent are spooled on their own, and sent again
+        after 'retry_delay' seconds (doubling each time, up to 'retries'
+        times); Alerts that were sent aren't sent again
+        If they still can't be sent, they're kept in the spool,
+        and sent again at the next start
+    Rows that fail are not written again, as the database rejected them
+        (or they were lost while it was down, with no overflow file)
+    If the handler raises an error, the webhook is queued again in the
+        same way; Events that the plugin's dedup cache saw the first time
+        are then dropped as duplicates
+    Alerts held for a digest are only in memory
+        The webhook is marked as done when the alert is held, so a crash
+        before the digest is sent loses those alerts
+
+To Do:
+    None
+"""
+
+
+import time
+import heapq
+import queue
+import itertools
+import threading
+import termcolor
+from config import QUEUE
+from core import codec, teamschat
+
+
+# Defaults, used if the 'queue' section of config.yaml is missing
+QUEUE_SIZE = 1000
+QUEUE_WORKERS = 4
+QUEUE_OVERFLOW = 'reject'
+QUEUE_BLOCK_TIMEOUT = 2
+QUEUE_RETRIES = 3
+QUEUE_RETRY_DELAY = 30
+
+# Seconds between checks for 'ready', while replayed webhooks wait
+READY_POLL = 1
+
+OVERFLOW_POLICIES = ('reject', 'drop_oldest', 'block')
+
+
+class Webhook():
+    '''
+    A webhook, with its body read into one buffer
+    Has the same 'headers' and 'get_data()' as a Flask request,
+        so plugins can authenticate it in the same way
+    '''
+    __slots__ = ('headers', 'raw', 'src', 'body')
+
+    def __init__(self, headers, raw, src):
+        self.headers = headers
+        self.raw = raw
+        self.src = src
+        self.body = None
+
+    # The raw body, without copying it (for the HMAC)
+    def get_data(self):
+        return memoryview(self.raw)
+
+    # Parse the body (once); Raises ValueError if it's not valid JSON
+    def parse(self):
+        if self.body is None:
+            self.body = codec.json.loads(self.raw)
+        return self.body
+
+
+class EventQueue():
+    # Initialise the queue and statistics
+    def __init__(self, size=None, workers=None, overflow=None,
+                 block_timeout=None, spool=None, ready=None):
+        self.size = size or QUEUE.get('size', QUEUE_SIZE)
+        self.worker_count = workers or QUEUE.get('workers', QUEUE_WORKERS)
+        self.overflow = overflow or QUEUE.get('overflow', QUEUE_OVERFLOW)
+        self.block_timeout = block_timeout or \
+            QUEUE.get('block_timeout', QUEUE_BLOCK_TIMEOUT)
+        self.retry_limit = QUEUE.get('retries', QUEUE_RETRIES)
+        self.retry_delay = QUEUE.get('retry_delay', QUEUE_RETRY_DELAY)
+
+        if self.overflow not in OVERFLOW_POLICIES:
+            print(termcolor.colored(
+                f"Unknown queue overflow policy '{self.overflow}', "
+                f"using '{QUEUE_OVERFLOW}'",
+                "red"))
+            self.overflow = QUEUE_OVERFLOW
+
+        self.queue = queue.Queue(maxsize=self.size)
+        self.workers = []
+        self.spool = spool
+        self.ready = ready
+
+        # Webhooks and alerts to try again, as (due time, number, item)
+        # The number keeps items with the same due time in order
+        self.retries = []
+        self.retry_numbers = itertools.count()
+        self.retry_condition = threading.Condition()
+
+        # Counters, protected by a lock as workers update them too
+        self.lock = threading.Lock()
+        self.stats = {
+            'accepted': 0,
+            'rejected': 0,
+            'dropped': 0,
+            'processed': 0,
+            'failed': 0,
+            'undelivered': 0,
+            'unwritten': 0,
+            'retried': 0,
+            'resent': 0,
+            'abandoned': 0,
+            'busy': 0,
+            'high_water': 0,
+        }
+
+    # Start the worker threads
+    def start(self):
+        '''Starts the worker threads that drain the queue'''
+        for number in range(self.worker_count):
+            worker = threading.Thread(
+                target=self.worker,
+                name=f"ingest-worker-{number}",
+                daemon=True
+            )
+            worker.start()
+            self.workers.append(worker)
+
+        retrier = threading.Thread(
+            target=self.retrier,
+            name='ingest-retry',
+            daemon=True
+        )
+        retrier.start()
+
+        print(termcolor.colored(
+            f"Started {self.worker_count} webhook workers "
+            f"(queue size {self.size}, overflow '{self.overflow}')",
+            "green"))
+
+    # Add a webhook to the queue
+    def put(self, plugin, raw_response, src, raw=None):
+        '''
+        Queues a webhook for a plugin to handle
+        Takes the plugin entry, the webhook body, and the source IP
+        Optionally, takes the raw body (bytes), for the spool
+        Returns True if queued, False if the queue is full
+        '''
+        # Write to the spool first, so the webhook survives a restart
+        record = None
+        if self.spool:
+            record = self.spool.append(
+                plugin['route'], src, raw_response, raw
+            )
+
+        item = (plugin, raw_response, src, record, False, 0)
+
+        try:
+            if self.overflow == 'block':
+                self.queue.put(item, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(item)
+
+        except queue.Full:
+            if self.overflow != 'drop_oldest' or not self.drop_oldest(item):
+                # The sender will retry, so there's nothing to replay
+                self.ack(record)
+                self.count('rejected')
+                return False
+
+        self.count('accepted')
+        return True
+
+    # Queue webhooks that were in the spool when the service stopped
+    def replay(self, records, plugins):
+        '''
+        Takes a list of spool records, and the list of loaded plugins
+        Starts a thread to queue them, as the queue may not have room
+            until the workers have a token (which may need the web
+            service running, for a user to log in)
+        '''
+        if not records:
+            return
+
+        thread = threading.Thread(
+            target=self.replay_records,
+            args=(records, plugins),
+            name='ingest-replay',
+            daemon=True
+        )
+        thread.start()
+
+    # Thread; Queue spooled webhooks, waiting for room if needed
+    # Records of alerts that weren't sent are sent again
+    def replay_records(self, records, plugins):
+        for record in records:
+            for plugin in plugins:
+                if plugin['route'] != record['route']:
+                    continue
+
+                if 'messages' in record:
+                    self.schedule({
+                        'plugin': plugin,
+                        'messages': record['messages'],
+                        'record': record['id'],
+                        'attempt': 0,
+                    }, delay=0)
+
+                else:
+                    self.queue.put((
+                        plugin, record['body'], record['src'], record['id'],
+                        True, 0
+                    ))
+                    self.count('accepted')
+                break
+
+            # The plugin may have been removed since the record was written
+            else:
+                print(termcolor.colored(
+                    f"No plugin for /{record['route']}, "
+                    f"discarding spooled webhook",
+                    "red"))
+                self.ack(record['id'])
+
+    # Make room in the queue by discarding the oldest webhook
+    def drop_oldest(self, item):
+        '''
+        Discards the oldest webhook, and queues the new one in its place
+        Returns False if there's still no room (other threads got there first)
+        '''
+        try:
+            dropped = self.queue.get_nowait()
+            self.queue.task_done()
+            self.ack(dropped[3])
+            self.count('dropped')
+            print(termcolor.colored(
+                f"Webhook queue full, dropped a webhook for "
+                f"{dropped[0]['name']}",
+                "red"))
+        except queue.Empty:
+            pass
+
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            return False
+
+        return True
+
+    # Worker thread; Take webhooks off the queue and handle them
+    def worker(self):
+        while True:
+            plugin, raw_response, src, record, replayed, attempt = \
+                self.queue.get()
+
+            # Replayed webhooks were accepted before the restart;
+            #   Wait until their alerts can be delivered
+            if replayed:
+                self.wait_ready()
+
+            self.count('busy')
+
+            try:
+                result = plugin['handler'].handle_event(
+                    raw_response=raw_response,
+                    src=src
+                )
+
+            # Try again later; The webhook stays in the spool meanwhile
+            except Exception as e:
+                self.count('failed')
+                print(termcolor.colored(
+                    f"Error handling a webhook for {plugin['name']}",
+                    "red"))
+                print(e)
+                self.schedule({
+                    'plugin': plugin,
+                    'body': raw_response,
+                    'src': src,
+                    'record': record,
+                    'attempt': attempt,
+                })
+
+            # Mark as done once the alerts are sent, and the rows are
+            #   finished; Alerts that weren't sent are tried again
+            else:
+                self.count('processed')
+                self.settle(plugin, record, result)
+
+            finally:
+                self.count('busy', -1)
+                self.queue.task_done()
+
+    # Mark a spooled webhook as done, once everything it started is done
+    def settle(self, plugin, record, result):
+        '''
+        Takes the plugin entry, the spool record,
+            and the result from handle_event()
+        The result is a tuple: A list of messages that weren't sent to
+            Teams, and a list of Futures for the SQL writes
+            None means there was nothing to send or write
+        '''
+        unsent, writes = result if result is not None else ([], [])
+
+        # Spool the alerts that weren't sent on their own,
+        #   so the webhook can be marked as done without losing them
+        keep = False
+        if unsent:
+            self.count('undelivered')
+            print(termcolor.colored(
+                f"{len(unsent)} alerts for {plugin['name']} weren't sent "
+                f"to Teams; Trying again in {self.retry_delay} seconds",
+                "red"))
+
+            resend = None
+            if self.spool:
+                try:
+                    resend = self.spool.append_messages(
+                        plugin['route'], unsent)
+
+                # Keep the whole webhook in the spool instead
+                except OSError as e:
+                    print(termcolor.colored(
+                        "Could not spool the alerts", "red"))
+                    print(e)
+                    keep = True
+
+            self.schedule({
+                'plugin': plugin,
+                'messages': unsent,
+                'record': resend,
+                'attempt': 0,
+            })
+
+        if not writes:
+            if not keep:
+                self.ack(record)
+            return
+
+        # Ack once the last write finishes
+        # A row that failed won't succeed if it's written again
+        state = {'waiting': len(writes), 'failed': 0}
+        lock = threading.Lock()
+
+        def finished(future):
+            with lock:
+                state['waiting'] -= 1
+                state['failed'] += future.result() is not True
+                if state['waiting']:
+                    return
+
+            if state['failed']:
+                self.count('unwritten', state['failed'])
+                print(termcolor.colored(
+                    f"{state['failed']} rows for {plugin['name']} "
+                    f"weren't written to the database",
+                    "red"))
+
+            if not keep:
+                self.ack(record)
+
+        for write in writes:
+            write.add_done_callback(finished)
+
+    # Schedule a webhook, or alerts, to be tried again
+    def schedule(self, item, delay=None):
+        '''
+        Takes a dictionary with the plugin entry, the spool record,
+            the number of attempts so far, and either the webhook
+            ('body' and 'src') or the Teams 'messages' to send
+        The delay doubles with each attempt, unless one is given
+        After 'retries' attempts, the item is left in the spool,
+            to be replayed at the next start
+        '''
+        attempt = item['attempt']
+        if attempt >= self.retry_limit:
+            self.count('abandoned')
+            what = 'alerts' if 'messages' in item else 'a webhook'
+            kept = '; Keeping it in the spool' \
+                if item['record'] is not None else ''
+            print(termcolor.colored(
+                f"Giving up on {what} for {item['plugin']['name']} "
+                f"after {attempt} retries{kept}",
+                "red"))
+            return
+
+        if delay is None:
+            delay = self.retry_delay * 2 ** attempt
+
+        with self.retry_condition:
+            heapq.heappush(self.retries, (
+                time.monotonic() + delay, next(self.retry_numbers), item
+            ))
+            self.retry_condition.notify()
+
+    # Thread; Try webhooks and alerts again once they're due
+    def retrier(self):
+        while True:
+            with self.retry_condition:
+                now = time.monotonic()
+                if not self.retries or self.retries[0][0] > now:
+                    wait = self.retries[0][0] - now if self.retries else None
+                    self.retry_condition.wait(wait)
+                    continue
+
+                due, number, item = heapq.heappop(self.retries)
+
+            self.count('retried')
+            if 'messages' in item:
+                self.resend(item)
+            else:
+                self.requeue(item)
+
+    # Queue a webhook again, after the handler failed
+    def requeue(self, item):
+        try:
+            self.queue.put_nowait((
+                item['plugin'], item['body'], item['src'], item['record'],
+                True, item['attempt'] + 1
+            ))
+
+        # Try again later, without using up an attempt
+        except queue.Full:
+            self.schedule(item)
+
+    # Send alerts to Teams again
+    def resend(self, item):
+        '''
+        Sends each message again; Only those that fail are kept
+        Once they're all sent, the spool record is marked as done
+        '''
+        self.wait_ready()
+
+        unsent = [
+            message for message in item['messages']
+            if not teamschat.send_chat(message)
+        ]
+        self.count('resent', len(item['messages']) - len(unsent))
+        if not unsent:
+            self.ack(item['record'])
+            return
+
+        # Replace the spool record, so sent alerts aren't sent again
+        if len(unsent) < len(item['messages']) and self.spool:
+            try:
+                record = self.spool.append_messages(
+                    item['plugin']['route'], unsent)
+            except OSError as e:
+                print(termcolor.colored(
+                    "Could not spool the alerts", "red"))
+                print(e)
+            else:
+                self.ack(item['record'])
+                item['record'] = record
+
+        item['messages'] = unsent
+        item['attempt'] += 1
+        self.schedule(item)
+
+    # Wait until the 'ready' function returns True
+    def wait_ready(self):
+        if self.ready is None or self.ready():
+            return
+
+        print(termcolor.colored(
+            "Replayed webhooks are waiting for a Teams token",
+            "yellow"))
+        while not self.ready():
+            time.sleep(READY_POLL)
+
+    # Mark a spooled webhook as done
+    def ack(self, record):
+        if self.spool and record is not None:
+            self.spool.ack(record)
+
+    # Update a counter
+    def count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+
+            depth = self.queue.qsize()
+            if depth > self.stats['high_water']:
+                self.stats['high_water'] = depth
+
+    # Report queue statistics
+    def status(self):
+        '''Returns a dictionary of queue statistics'''
+        with self.lock:
+            stats = dict(self.stats)
+
+        stats['depth'] = self.queue.qsize()
+        stats['size'] = self.size
+        stats['overflow'] = self.overflow
+        stats['workers'] = sum(
+            1 for worker in self.workers if worker.is_alive()
+        )
+
+        return stats
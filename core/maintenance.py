@@ -0,0 +1,377 @@
+"""
+Background maintenance for the event tables
+Rolls raw events up into hourly counts, and purges old raw events
+
+Usage:
+    import 'maintenance' into the application
+    The web service calls maintenance.job.start() to run the thread
+        The scheduler wakes it every 'interval' seconds (see the
+        'retention' section of config.yaml)
+    Call counts() to get event counts over a long time range
+        Roll-ups are used for hours that have been rolled up,
+        and raw events for the hours since
+    Call status() to get the watermarks and counters
+
+Authentication:
+    Requires permission to read, write, and delete rows
+
+Restrictions:
+    Hours are rolled up in chunks, each in its own transaction
+        The watermark (the end of the last hour rolled up) is saved in the
+        same transaction, so an interrupted run resumes where it stopped
+        Each chunk replaces its hours in the roll-up table,
+        so running it again gives the same result
+    Hours are only rolled up once they're 'delay_hours' old,
+        to allow for events that arrive late
+    Rows written later than that (eg, from the SQL overflow after an
+        outage) move the watermark back (see rewind()), so their hours
+        are rolled up again before they're purged
+        Rows older than the retention period aren't counted,
+        as their hours may already be partly purged
+    Raw events are only purged once they're older than 'days',
+        and have been rolled up
+    Purging is done 'batch_size' rows at a time, so SQL Server doesn't
+        escalate to a table lock
+    The work runs in its own thread, as the first roll-up or a large purge
+        can take a long time; The scheduler only wakes the thread, so
+        other jobs (eg, the token refresh) are never held up
+    If a table fails (for any error), the thread is woken again sooner
+        (see scheduler.py)
+
+To Do:
+    None
+"""
+
+
+import threading
+import termcolor
+from datetime import datetime, timedelta
+from config import RETENTION
+from core import schema, scheduler
+
+
+# Defaults, used if the 'retention' section of config.yaml is missing
+RETENTION_DAYS = 90
+INTERVAL = 3600
+BATCH_SIZE = 1000
+DELAY_HOURS = 2
+CHUNK_HOURS = 24
+
+
+# Round a time down to the start of the hour
+def hour_start(value):
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+# Read a timestamp from the database (SQLite returns text)
+def to_datetime(value):
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+class Maintenance():
+    # Initialise the job, with the 'retention' section of config.yaml
+    def __init__(self, config):
+        self.enabled = config.get('enabled', True)
+        self.days = config.get('days', RETENTION_DAYS)
+        self.interval = config.get('interval', INTERVAL)
+        self.batch_size = config.get('batch_size', BATCH_SIZE)
+        self.delay = timedelta(hours=config.get('delay_hours', DELAY_HOURS))
+
+        self.pool = None
+        self.thread = None
+        self.wake = threading.Event()
+        self.failed = False
+        self.lock = threading.Lock()
+
+        self.stats = {
+            'runs': 0,
+            'hours_rolled': 0,
+            'purged': 0,
+            'errors': 0,
+            'last_run': None,
+        }
+
+    # Start the maintenance thread, and wake it every 'interval' seconds
+    def start(self, pool):
+        if not self.enabled or self.thread is not None:
+            return
+
+        self.pool = pool
+        self.thread = threading.Thread(
+            target=self.run,
+            name='maintenance',
+            daemon=True
+        )
+        self.thread.start()
+        scheduler.jobs.add('maintenance', self.trigger,
+                           interval=self.interval)
+
+    # Scheduled job; Wake the maintenance thread, without waiting for it
+    def trigger(self):
+        '''
+        Returns False if the last run failed,
+            so the scheduler wakes the thread again sooner
+        '''
+        self.wake.set()
+        return not self.failed
+
+    # Thread; Run maintenance each time it's woken
+    # An unexpected error must not stop the thread
+    def run(self):
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            try:
+                self.failed = not self.run_once()
+            except Exception as e:
+                self.failed = True
+                self.count('errors')
+                print(termcolor.colored("Maintenance failed", "red"))
+                print(e)
+
+    # Roll up and purge each table
+    def run_once(self):
+        '''Returns False if any table failed'''
+        failed = False
+        for table in schema.TABLES:
+            try:
+                self.rollup(table)
+                self.purge(table)
+
+            # Any error, not just a database error (eg, a bad watermark)
+            except Exception as e:
+                print(termcolor.colored(
+                    f"Maintenance of {table} failed; Will try again later",
+                    "red"))
+                print(e)
+                self.count('errors')
+                failed = True
+
+        with self.lock:
+            self.stats['runs'] += 1
+            self.stats['last_run'] = datetime.now().isoformat(
+                timespec='seconds'
+            )
+
+        return not failed
+
+    # Roll up the hours since the watermark
+    def rollup(self, table):
+        backend = self.pool.backend
+        rollup = schema.ROLLUPS[table]
+        keys = [
+            column for column, type, nullable in schema.rollup_columns(table)
+            if column not in ('hour', 'events')
+        ]
+        end = hour_start(datetime.now() - self.delay)
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            start = saved = self.watermark(cursor, table)
+
+            # Start from the oldest event, the first time
+            if start is None:
+                cursor.execute(f"SELECT MIN(ts) FROM {table}")
+                oldest = cursor.fetchone()[0]
+                if oldest is None:
+                    return
+                start = hour_start(to_datetime(oldest))
+
+            hour = backend.hour_expression('ts')
+            while start < end:
+                chunk_end = min(start + timedelta(hours=CHUNK_HOURS), end)
+
+                # Replace these hours in the roll-up, and move the watermark,
+                #   in one transaction
+                cursor.execute(
+                    f"DELETE FROM {rollup} WHERE hour >= ? AND hour < ?",
+                    (start, chunk_end)
+                )
+                cursor.execute(
+                    f"INSERT INTO {rollup} (hour, {', '.join(keys)}, events) "
+                    f"SELECT {hour}, "
+                    + ', '.join(f"COALESCE({key}, '')" for key in keys) +
+                    f", COUNT(*) FROM {table} WHERE ts >= ? AND ts < ? "
+                    f"GROUP BY {hour}, {', '.join(keys)}",
+                    (start, chunk_end)
+                )
+
+                # Late rows moved the watermark back in the meantime;
+                #   Start again from there
+                if not self.set_watermark(cursor, table, chunk_end, saved):
+                    conn.rollback()
+                    start = saved = self.watermark(cursor, table)
+                    continue
+
+                conn.commit()
+
+                with self.lock:
+                    self.stats['hours_rolled'] += int(
+                        (chunk_end - start).total_seconds() // 3600
+                    )
+                start = saved = chunk_end
+
+    # Delete raw events that are old, and have been rolled up
+    def purge(self, table):
+        backend = self.pool.backend
+        cutoff = datetime.now() - timedelta(days=self.days)
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            watermark = self.watermark(cursor, table)
+            if watermark is None:
+                return
+            cutoff = min(cutoff, watermark)
+
+            # Delete in small batches, each in its own transaction
+            statement = backend.purge_statement(table, self.batch_size)
+            while True:
+                cursor.execute(statement, (cutoff,))
+                deleted = cursor.rowcount
+                conn.commit()
+
+                if deleted > 0:
+                    with self.lock:
+                        self.stats['purged'] += deleted
+                if deleted < self.batch_size:
+                    break
+
+    # Get the end of the last hour rolled up for a table
+    def watermark(self, cursor, table):
+        cursor.execute(
+            "SELECT value FROM watermarks WHERE name = ?",
+            (schema.ROLLUPS[table],)
+        )
+        row = cursor.fetchone()
+        return to_datetime(row[0]) if row else None
+
+    # Save the watermark (committed with the roll-up)
+    def set_watermark(self, cursor, table, value, previous=None):
+        '''
+        Takes the new value, and the value it had when it was read
+        Returns False if it has changed since then (see rewind())
+        '''
+        if previous is not None:
+            cursor.execute(
+                "UPDATE watermarks SET value = ? "
+                "WHERE name = ? AND value = ?",
+                (value, schema.ROLLUPS[table], previous)
+            )
+            return cursor.rowcount > 0
+
+        cursor.execute(
+            "UPDATE watermarks SET value = ? WHERE name = ?",
+            (value, schema.ROLLUPS[table])
+        )
+        if cursor.rowcount == 0:
+            cursor.execute(
+                "INSERT INTO watermarks (name, value) VALUES (?, ?)",
+                (schema.ROLLUPS[table], value)
+            )
+        return True
+
+    # Move a watermark back, so rows that were written late are rolled up
+    def rewind(self, cursor, table, oldest):
+        '''
+        Takes a cursor, the table, and the oldest timestamp of the rows
+        Call in the same transaction that writes the rows
+        The watermark is never moved back into the hours that may have
+            been purged already
+        '''
+        if table not in schema.ROLLUPS or oldest is None:
+            return
+
+        limit = hour_start(
+            datetime.now() - timedelta(days=self.days)
+        ) + timedelta(hours=1)
+        value = max(hour_start(to_datetime(oldest)), limit)
+
+        cursor.execute(
+            "UPDATE watermarks SET value = ? WHERE name = ? AND value > ?",
+            (value, schema.ROLLUPS[table], value)
+        )
+
+    # Update a counter
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    # Report maintenance statistics
+    def status(self):
+        '''Returns a dictionary of counters'''
+        with self.lock:
+            stats = dict(self.stats)
+
+        stats['enabled'] = self.thread is not None
+        stats['last_failed'] = self.failed
+        stats['retention_days'] = self.days
+        return stats
+
+
+# Count events over a time range, by event type
+def counts(pool, since, site=None, device=None, event=None):
+    '''
+    Takes the SQL pool, the start time,
+        and optionally a site, device, or event type to match
+    Uses the roll-ups up to each table's watermark, and raw events after
+    Returns a list of (event type, count), largest first
+    '''
+    totals = {}
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        for table, rollup in schema.ROLLUPS.items():
+            columns = [
+                column for column, type, nullable in schema.TABLES[table]
+            ]
+            search = [
+                (column, value)
+                for column, value in (
+                    ('site', site), ('device', device), ('event', event)
+                )
+                if value is not None
+            ]
+
+            # Tables without a site can't match a site
+            if any(column not in columns for column, value in search):
+                continue
+
+            # Chat messages are lower case, so ignore case when matching
+            where = ''.join(
+                f" AND {pool.backend.match_expression(column)}"
+                for column, value in search
+            )
+            values = [value for column, value in search]
+
+            cursor.execute(
+                "SELECT value FROM watermarks WHERE name = ?",
+                (rollup,)
+            )
+            row = cursor.fetchone()
+            watermark = to_datetime(row[0]) if row else since
+
+            # Hours that have been rolled up
+            if watermark > since:
+                cursor.execute(
+                    f"SELECT event, SUM(events) FROM {rollup} "
+                    f"WHERE hour >= ? AND hour < ?{where} GROUP BY event",
+                    [hour_start(since), watermark] + values
+                )
+                for name, total in cursor.fetchall():
+                    totals[name] = totals.get(name, 0) + total
+
+            # Events since the last roll-up
+            cursor.execute(
+                f"SELECT event, COUNT(*) FROM {table} "
+                f"WHERE ts >= ?{where} GROUP BY event",
+                [max(since, watermark)] + values
+            )
+            for name, total in cursor.fetchall():
+                totals[name] = totals.get(name, 0) + total
+
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+
+# The shared maintenance job
+job = Maintenance(RETENTION)
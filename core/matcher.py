@@ -0,0 +1,79 @@
+"""
+Matches many keywords against a string in a single pass
+
+Usage:
+    import 'matcher' into a plugin or core module
+    Create a Matcher object with a list of keywords (compiled once)
+    Call first() to get the first keyword found in a string (or None)
+    Call findall() to get every keyword found in a string
+
+Authentication:
+    N/A
+
+Restrictions:
+    Keywords are plain text, not regular expressions
+    Matching is case sensitive
+
+To Do:
+    None
+"""
+
+
+import re
+
+
+class Matcher():
+    # Compile the keywords into a single pattern
+    def __init__(self, keywords):
+        '''
+        Takes a list of keywords
+        All keywords are combined into one regular expression,
+            so the string is scanned once for all of them
+        Longer keywords are tried first, so where two keywords start at
+            the same place, the longer (more specific) one is found
+        '''
+        # Empty keywords would match everywhere, so ignore them
+        self.keywords = sorted(
+            {str(keyword) for keyword in keywords if str(keyword) != ''},
+            key=len,
+            reverse=True
+        )
+
+        self.regex = None
+        if self.keywords:
+            self.regex = re.compile(
+                '|'.join(re.escape(keyword) for keyword in self.keywords)
+            )
+
+    # Find the first keyword in the string
+    def first(self, text):
+        '''Returns the first keyword found in 'text', or None'''
+        if self.regex is None:
+            return None
+
+        match = self.regex.search(text)
+        if match:
+            return match.group()
+
+        return None
+
+    # Find all keywords in the string
+    def findall(self, text):
+        '''
+        Returns a list of keywords found in 'text'
+        This includes keywords that overlap each other
+        For each position, only the longest keyword starting there is found
+        '''
+        found = []
+        if self.regex is None:
+            return found
+
+        # Start the next search one character after the previous match,
+        #   rather than at the end of it, so overlapping keywords are found
+        search = self.regex.search
+        match = search(text)
+        while match:
+            found.append(match.group())
+            match = search(text, match.start() + 1)
+
+        return found
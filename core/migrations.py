@@ -0,0 +1,309 @@
+"""
+Versioned schema migrations for the event tables
+Brings any database (new, or created by an older version) up to the
+    schema in schema.py
+
+Usage:
+    The SQL writer calls upgrade() when it starts
+        Migrations that have already been applied are skipped,
+        so this is safe to run every time
+    Or, run from the main application folder to upgrade by hand:
+        python core/migrations.py [--status]
+    Call status() to get the current schema version
+
+Authentication:
+    Requires permission to create and alter tables
+
+Restrictions:
+    Each migration is recorded in the 'schema_version' table
+    Each step checks the database first, so a migration that was
+        interrupted can be run again
+    Date partitioning is for SQL Server only
+        Set 'partition_months' in the 'sql' section of config.yaml
+        Tables are partitioned by month, on the 'ts' column
+        Partitions for the coming months are added at each startup
+
+To Do:
+    None
+"""
+
+
+import os
+import sys
+from datetime import date, datetime
+import termcolor
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from config import SQL  # noqa: E402
+from core import schema  # noqa: E402
+
+
+# Partition names (SQL Server)
+PARTITION_FUNCTION = 'pf_events_month'
+PARTITION_SCHEME = 'ps_events_month'
+
+# The schema version after the last successful upgrade
+current_version = None
+
+
+# Migration 1: Create tables that don't exist yet
+def create_tables(backend, cursor):
+    for table in schema.TABLES:
+        cursor.execute(backend.create_statement(table))
+
+
+# Migration 2: Move to indexable columns, and a single timestamp
+# Tables from before this have 'text' columns, and 'logdate' and 'logtime'
+def single_timestamp(backend, cursor):
+    for table, columns in schema.TABLES.items():
+        existing = backend.table_columns(cursor, table)
+        if 'ts' in existing or 'logdate' not in existing:
+            continue
+
+        print(termcolor.colored(
+            f"Migrating {table} to the new schema",
+            "yellow"))
+
+        if backend.name == 'sqlserver':
+            cursor.execute(f"ALTER TABLE {table} ADD ts datetime2 NULL")
+            cursor.execute(
+                f"UPDATE {table} SET ts = CAST("
+                f"CAST(logdate AS datetime) + CAST(logtime AS datetime) "
+                f"AS datetime2)"
+            )
+            cursor.execute(
+                f"ALTER TABLE {table} ALTER COLUMN ts datetime2 NOT NULL"
+            )
+            cursor.execute(f"ALTER TABLE {table} DROP COLUMN logdate, logtime")
+
+            # 'text' is deprecated, and can't be indexed
+            for column, type, nullable in columns:
+                if type in ('name', 'text') and column in existing:
+                    cursor.execute(
+                        f"ALTER TABLE {table} ALTER COLUMN {column} "
+                        f"{backend.TYPES[type]} "
+                        f"{'NULL' if nullable else 'NOT NULL'}"
+                    )
+
+        # SQLite can't change columns, so the table is rebuilt
+        else:
+            kept = [
+                column for column, type, nullable in columns
+                if column in existing
+            ]
+            cursor.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+            cursor.execute(backend.create_statement(table))
+            cursor.execute(
+                f"INSERT INTO {table} (ts, {', '.join(kept)}) "
+                f"SELECT logdate || 'T' || logtime, {', '.join(kept)} "
+                f"FROM {table}_old"
+            )
+            cursor.execute(f"DROP TABLE {table}_old")
+
+
+# Migration 3: Index by device and site, with the timestamp
+def time_indexes(backend, cursor):
+    for table, indexes in schema.INDEXES.items():
+        for name, columns in indexes:
+            cursor.execute(
+                backend.create_index_statement(table, name, columns)
+            )
+
+
+# Migration 4: Hourly roll-up tables, and their watermarks
+def rollup_tables(backend, cursor):
+    cursor.execute(backend.create_statement('watermarks'))
+    for table, rollup in schema.ROLLUPS.items():
+        cursor.execute(backend.create_statement(rollup))
+        cursor.execute(
+            backend.create_index_statement(
+                rollup,
+                f"ix_{rollup}_hour",
+                [
+                    column
+                    for column, type, nullable in schema.rollup_columns(table)
+                    if column != 'events'
+                ]
+            )
+        )
+
+
+# Migrations, in order
+#   (version, description, function)
+MIGRATIONS = [
+    (1, 'Create the event tables', create_tables),
+    (2, 'Use nvarchar columns and a single datetime2 timestamp',
+        single_timestamp),
+    (3, 'Index device and site by timestamp', time_indexes),
+    (4, 'Create hourly roll-up tables', rollup_tables),
+]
+
+
+# Get the version of the schema in the database
+def get_version(backend, cursor):
+    cursor.execute(
+        backend.create_statement(
+            'schema_version',
+            'version int not null, description nvarchar(255) null, '
+            'applied nvarchar(32) not null'
+        )
+    )
+    cursor.execute('SELECT MAX(version) FROM schema_version')
+    row = cursor.fetchone()
+    return row[0] or 0
+
+
+# Apply any migrations that haven't been applied yet
+def upgrade(pool):
+    '''
+    Takes the SQL connection pool
+    Returns True if the database is up to date, or False if there's an error
+    Each migration is committed as it's applied
+    '''
+    global current_version
+    backend = pool.backend
+
+    try:
+        with pool.connection() as conn:
+            cursor = conn.cursor()
+            version = get_version(backend, cursor)
+            conn.commit()
+
+            for number, description, migration in MIGRATIONS:
+                if number <= version:
+                    continue
+
+                print(termcolor.colored(
+                    f"Applying schema migration {number}: {description}",
+                    "yellow"))
+                migration(backend, cursor)
+                cursor.execute(
+                    'INSERT INTO schema_version '
+                    '(version, description, applied) VALUES (?, ?, ?)',
+                    (number, description, datetime.now().isoformat())
+                )
+                conn.commit()
+                version = number
+
+            # Partitioning can be turned on at any time
+            if SQL.get('partition_months', 0) and backend.name == 'sqlserver':
+                partition(cursor, SQL['partition_months'])
+                conn.commit()
+
+    except backend.Error as e:
+        print(termcolor.colored(
+            "Could not upgrade the database schema",
+            "red"))
+        print(e)
+        return False
+
+    current_version = version
+    return True
+
+
+# Partition the event tables by month (SQL Server)
+def partition(cursor, months):
+    '''
+    Creates the partition function and scheme if they don't exist,
+        adds partitions for this month and the next 'months' months,
+        and moves each table onto the scheme
+    Safe to run at every startup
+    '''
+    today = date.today()
+    boundaries = []
+    for offset in range(months + 1):
+        year, month = divmod(today.month - 1 + offset, 12)
+        boundaries.append(date(today.year + year, month + 1, 1))
+
+    cursor.execute(
+        "SELECT 1 FROM sys.partition_functions WHERE name = ?",
+        (PARTITION_FUNCTION,)
+    )
+    if cursor.fetchone() is None:
+        cursor.execute(
+            f"CREATE PARTITION FUNCTION {PARTITION_FUNCTION} (datetime2) "
+            f"AS RANGE RIGHT FOR VALUES ('{boundaries[0].isoformat()}')"
+        )
+        cursor.execute(
+            f"CREATE PARTITION SCHEME {PARTITION_SCHEME} "
+            f"AS PARTITION {PARTITION_FUNCTION} ALL TO ([PRIMARY])"
+        )
+
+    # Add boundaries for the coming months
+    cursor.execute(
+        "SELECT CAST(rv.value AS date) FROM sys.partition_range_values rv "
+        "JOIN sys.partition_functions pf "
+        "ON rv.function_id = pf.function_id WHERE pf.name = ?",
+        (PARTITION_FUNCTION,)
+    )
+    existing = {row[0] for row in cursor.fetchall()}
+    for boundary in boundaries:
+        if boundary in existing or boundary.isoformat() in existing:
+            continue
+        cursor.execute(
+            f"ALTER PARTITION SCHEME {PARTITION_SCHEME} NEXT USED [PRIMARY]"
+        )
+        cursor.execute(
+            f"ALTER PARTITION FUNCTION {PARTITION_FUNCTION}() "
+            f"SPLIT RANGE ('{boundary.isoformat()}')"
+        )
+
+    # Move each table onto the scheme, with a clustered index on 'ts'
+    # The primary key is kept on 'id', but made nonclustered
+    for table in schema.TABLES:
+        cursor.execute(
+            "SELECT 1 FROM sys.indexes i JOIN sys.partition_schemes ps "
+            "ON i.data_space_id = ps.data_space_id "
+            "WHERE i.object_id = OBJECT_ID(?) AND i.index_id <= 1",
+            (table,)
+        )
+        if cursor.fetchone() is not None:
+            continue
+
+        print(termcolor.colored(
+            f"Partitioning {table} by month",
+            "yellow"))
+
+        cursor.execute(
+            "SELECT name FROM sys.key_constraints "
+            "WHERE parent_object_id = OBJECT_ID(?) AND type = 'PK'",
+            (table,)
+        )
+        row = cursor.fetchone()
+        if row is not None:
+            cursor.execute(f"ALTER TABLE {table} DROP CONSTRAINT [{row[0]}]")
+
+        cursor.execute(
+            f"ALTER TABLE {table} ADD CONSTRAINT pk_{table} "
+            f"PRIMARY KEY NONCLUSTERED (id) ON [PRIMARY]"
+        )
+        cursor.execute(
+            f"CREATE CLUSTERED INDEX cx_{table}_ts ON {table} (ts) "
+            f"ON {PARTITION_SCHEME} (ts)"
+        )
+
+
+# Report the schema version
+def status():
+    '''Returns a dictionary with the current and latest schema versions'''
+    return {
+        'version': current_version,
+        'latest': MIGRATIONS[-1][0],
+    }
+
+
+# Upgrade the database by hand
+if __name__ == '__main__':
+    from core import sql
+
+    if '--status' in sys.argv:
+        with sql.pool.connection() as conn:
+            cursor = conn.cursor()
+            version = get_version(sql.backend, cursor)
+            conn.commit()
+        print(f"Schema version {version} (latest is {MIGRATIONS[-1][0]})")
+
+    elif upgrade(sql.pool):
+        print(f"Schema is up to date (version {current_version})")
@@ -0,0 +1,224 @@
+"""
+Queues change notifications from the Graph API (chat messages),
+    so the /chat route can respond straight away
+Worker threads decrypt each notification, and pass the message to
+    parse_chats
+
+Usage:
+    import 'notifications' into the application
+    The web service calls notifications.chats.start_pool() before it
+        starts any other threads, then start() to run the workers
+    Call put() with the 'value' list from a notification
+        Every item is queued (Graph may send several in one request)
+        put() returns the number of items queued,
+        or False if the queue is full (so Graph retries later)
+    Call status() to get queue statistics
+
+Authentication:
+    Each item is validated with its HMAC signature before it's parsed
+
+Restrictions:
+    Items are de-duplicated by message ID, as Graph retries a notification
+        if it doesn't get a response in time
+        The ID comes from the decrypted, validated message, so a forged
+        item can't hide a real one; Duplicates are still decrypted
+        IDs are remembered for 'dedup_ttl' seconds
+    The queue is in memory only; Items not handled are lost on restart
+        (they're chat messages, not alerts)
+    RSA decryption is done in the worker threads by default
+        pycryptodome does the RSA maths in C, outside the GIL,
+        so threads decrypt in parallel
+    Set 'processes' to decrypt in a process pool instead
+        This needs the 'fork' start method (Linux), as the web service
+        can't be imported again by new processes
+        Forking a process that's running threads can leave the child
+        stuck on a lock, so the pool must be started first
+        (start_pool()), and all its processes are forked straight away
+        On other platforms, or if other threads are already running,
+        the worker threads are used
+
+To Do:
+    None
+"""
+
+
+import queue
+import threading
+import multiprocessing
+import termcolor
+from concurrent.futures import ProcessPoolExecutor
+from config import CHAT
+from core import crypto
+from core import dedup
+from core import parse_chats
+
+
+# Defaults, used if the 'chat' section of config.yaml is missing
+CHAT_QUEUE_SIZE = 100
+CHAT_WORKERS = 2
+CHAT_PROCESSES = 0
+CHAT_DEDUP_TTL = 600
+
+
+class ChatQueue():
+    # Initialise the queue and statistics
+    def __init__(self, config):
+        self.size = config.get('size', CHAT_QUEUE_SIZE)
+        self.worker_count = config.get('workers', CHAT_WORKERS)
+        self.processes = config.get('processes', CHAT_PROCESSES)
+
+        self.queue = queue.Queue(maxsize=self.size)
+        self.workers = []
+        self.pool = None
+        self.seen = dedup.DedupCache(
+            ttl=config.get('dedup_ttl', CHAT_DEDUP_TTL),
+            max_entries=self.size * 100
+        )
+
+        self.lock = threading.Lock()
+        self.stats = {
+            'accepted': 0,
+            'rejected': 0,
+            'duplicates': 0,
+            'processed': 0,
+            'invalid': 0,
+            'failed': 0,
+        }
+
+    # Start the process pool (if enabled), before any threads are running
+    def start_pool(self):
+        '''
+        The keys are loaded first, so the processes get a copy of them
+        Returns True if the pool was started
+        '''
+        if not self.processes or self.pool is not None:
+            return False
+
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            print(termcolor.colored(
+                "A process pool for chat decryption needs 'fork'; "
+                "Using worker threads",
+                "yellow"))
+            return False
+
+        if threading.active_count() > 1:
+            print(termcolor.colored(
+                "The chat process pool must start before any other "
+                "threads; Using worker threads",
+                "yellow"))
+            return False
+
+        crypto.keys.load()
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context('fork')
+        )
+
+        # With 'fork', the first task forks every process in the pool,
+        #   so do that now, while this is the only thread
+        self.pool.submit(int).result()
+        return True
+
+    # Start the worker threads
+    def start(self):
+        for number in range(self.worker_count):
+            worker = threading.Thread(
+                target=self.worker,
+                name=f"chat-worker-{number}",
+                daemon=True
+            )
+            worker.start()
+            self.workers.append(worker)
+
+    # Add the items from a notification to the queue
+    def put(self, items):
+        '''
+        Takes the 'value' list from a change notification
+        Returns the number of items queued, or False if the queue is full
+        '''
+        queued = 0
+        for item in items:
+            # Only items with encrypted content can be handled
+            if not isinstance(item, dict) or \
+                    'encryptedContent' not in item:
+                self.count('invalid')
+                continue
+
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self.count('rejected')
+                return False
+
+            queued += 1
+
+        with self.lock:
+            self.stats['accepted'] += queued
+        return queued
+
+    # Worker thread; Take items off the queue, and handle them
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                self.handle(item)
+                self.count('processed')
+
+            except Exception as e:
+                self.count('failed')
+                print(termcolor.colored(
+                    f"Error handling a chat notification: {e}",
+                    "red"))
+
+            finally:
+                self.queue.task_done()
+
+    # Decrypt an item, and pass the message to parse_chats
+    def handle(self, item):
+        if self.pool is not None:
+            payload = self.pool.submit(
+                crypto.decrypt_content,
+                item['encryptedContent']
+            ).result()
+        else:
+            payload = crypto.decrypt_content(item['encryptedContent'])
+
+        if payload is None:
+            self.count('invalid')
+            print("Validation failed")
+            print("Data may have been tampered with")
+            return
+
+        # Skip messages we've already handled
+        # This uses the ID inside the validated payload, not 'resourceData'
+        #   (which anyone can send to /chat), and is only recorded once
+        #   the item has decrypted, so a failed item can be retried
+        if payload.get('id') is not None and self.seen.seen(payload['id']):
+            self.count('duplicates')
+            return
+
+        # Get key fields from the message, and parse it
+        name = payload['from']['user']['displayName']
+        message = payload['body']['content']
+        parse_chats.parse(message=message, sender=name)
+
+    # Update a counter
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    # Report queue statistics
+    def status(self):
+        '''Returns a dictionary of queue depth and counters'''
+        with self.lock:
+            stats = dict(self.stats)
+
+        stats['depth'] = self.queue.qsize()
+        stats['size'] = self.size
+        stats['workers'] = self.worker_count
+        stats['processes'] = self.processes if self.pool else 0
+        return stats
+
+
+# The shared chat queue
+chats = ChatQueue(CHAT)
@@ -0,0 +1,192 @@
+"""
+Keeps rows in a local SQLite file while the database is unavailable
+The SQL writer spills rows here, and drains them back once the database
+    is reachable again
+
+Usage:
+    import 'overflow' into the application (the SQL writer does this)
+    Create an Overflow object, and call open() to open or create the file
+    Call add() with a table, its columns, and a list of row values
+    Call read() to get the oldest rows, and remove() once they're written
+    Call status() to get the number of rows waiting
+
+Authentication:
+    N/A
+
+Restrictions:
+    Uses the sqlite3 module from the standard library
+    The file uses write-ahead logging (WAL), so spilling rows is fast
+    Values are stored as JSON; Dates and times are tagged,
+        so they're the same type when they're read back
+
+To Do:
+    None
+"""
+
+
+import os
+import json
+import sqlite3
+import threading
+import termcolor
+from datetime import date, time, datetime
+
+
+# Defaults
+OVERFLOW_PATH = 'sql-overflow.db'
+
+
+# Tag values that JSON can't store
+def encode(values):
+    '''
+    Takes a tuple of row values, and returns a JSON string
+    '''
+    tagged = []
+    for value in values:
+        if isinstance(value, datetime):
+            value = {'datetime': value.isoformat()}
+        elif isinstance(value, date):
+            value = {'date': value.isoformat()}
+        elif isinstance(value, time):
+            value = {'time': value.isoformat()}
+        tagged.append(value)
+
+    return json.dumps(tagged)
+
+
+# Read values back from JSON, restoring tagged types
+def decode(data):
+    '''
+    Takes a JSON string from encode(), and returns a tuple of values
+    '''
+    values = []
+    for value in json.loads(data):
+        if isinstance(value, dict):
+            if 'datetime' in value:
+                value = datetime.fromisoformat(value['datetime'])
+            elif 'date' in value:
+                value = date.fromisoformat(value['date'])
+            elif 'time' in value:
+                value = time.fromisoformat(value['time'])
+        values.append(value)
+
+    return tuple(values)
+
+
+class Overflow():
+    # Initialise the overflow, with the path to the SQLite file
+    def __init__(self, path=OVERFLOW_PATH):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+
+        self.stats = {
+            'spilled': 0,
+            'drained': 0,
+        }
+
+    # Open (or create) the SQLite file
+    def open(self):
+        '''
+        Returns True if the file is ready to use
+        '''
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        try:
+            self.conn = sqlite3.connect(
+                self.path,
+                check_same_thread=False
+            )
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS rows ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'tbl TEXT NOT NULL, '
+                'columns TEXT NOT NULL, '
+                'data TEXT NOT NULL)'
+            )
+            self.conn.commit()
+
+        except sqlite3.Error as e:
+            print(termcolor.colored(
+                f"Could not open the SQL overflow file {self.path}",
+                "red"))
+            print(e)
+            self.conn = None
+            return False
+
+        waiting = self.pending()
+        if waiting:
+            print(termcolor.colored(
+                f"{waiting} rows are waiting in the SQL overflow file",
+                "yellow"))
+        return True
+
+    # Store rows, to write to the database later
+    def add(self, table, columns, rows):
+        '''
+        Takes a table name, a tuple of column names,
+            and a list of value tuples
+        Returns True if the rows were stored
+        '''
+        columns = json.dumps(columns)
+        try:
+            with self.lock, self.conn:
+                self.conn.executemany(
+                    'INSERT INTO rows (tbl, columns, data) VALUES (?, ?, ?)',
+                    [(table, columns, encode(row)) for row in rows]
+                )
+                self.stats['spilled'] += len(rows)
+
+        except sqlite3.Error as e:
+            print(termcolor.colored(
+                "Could not write to the SQL overflow file",
+                "red"))
+            print(e)
+            return False
+
+        return True
+
+    # Get the oldest rows
+    def read(self, limit):
+        '''
+        Returns a list of (id, table, columns, values), oldest first
+        '''
+        with self.lock:
+            records = self.conn.execute(
+                'SELECT id, tbl, columns, data FROM rows ORDER BY id LIMIT ?',
+                (limit,)
+            ).fetchall()
+
+        return [
+            (id, table, tuple(json.loads(columns)), decode(data))
+            for id, table, columns, data in records
+        ]
+
+    # Remove rows once they've been written to the database
+    def remove(self, ids):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'DELETE FROM rows WHERE id = ?',
+                [(id,) for id in ids]
+            )
+            self.stats['drained'] += len(ids)
+
+    # Count the rows waiting to be written
+    def pending(self):
+        with self.lock:
+            row = self.conn.execute('SELECT COUNT(*) FROM rows').fetchone()
+        return row[0]
+
+    # Report overflow statistics
+    def status(self):
+        '''Returns a dictionary of overflow statistics'''
+        with self.lock:
+            stats = dict(self.stats)
+
+        stats['pending'] = self.pending()
+        stats['path'] = self.path
+        return stats
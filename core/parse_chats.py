@@ -4,6 +4,16 @@ Parses messages sent to the chat bot, so it can respond
 
 Usage:
     import this module into the application
+    Ask for recent events with messages like:
+        'last events'
+        'last 20 events for site Head Office'
+        'last 5 events for device SW-CORE-01'
+        'last events for type SW_DISCONNECTED'
+        'last events for level 1'
+    Ask for event counts over a longer time with messages like:
+        'event counts'
+        'event counts for site Head Office last 30 days'
+        'event counts for device SW-CORE-01 last 7 days'
 
 Authentication:
     None
@@ -21,7 +31,30 @@ Author:
 
 from config import GLOBAL
 from core import teamschat
+from core import recent
+from core import sql
+from core import maintenance
+from datetime import datetime, timedelta
 import random
+import re
+
+
+# The most events to show in one message
+QUERY_LIMIT = 50
+
+# 'last [count] events [for <field> <value>]'
+QUERY = re.compile(
+    r'^(?:show\s+)?(?:the\s+)?(?:last|recent)\s+(?:(\d+)\s+)?events?'
+    r'(?:\s+for\s+(site|device|type|event|level)\s+(.+?))?\s*$'
+)
+
+# 'event counts [for <field> <value>] [last <days> days]'
+COUNTS = re.compile(
+    r'^(?:show\s+)?(?:the\s+)?event\s+counts?'
+    r'(?:\s+for\s+(site|device|type|event)\s+(.+?))?'
+    r'(?:\s+(?:last|for)\s+(\d+)\s+days?)?\s*$'
+)
+COUNT_DAYS = 7
 
 jokes = [
     "I went to buy some camo pants but couldn't find any.",
@@ -62,7 +95,13 @@ def parse(message, sender):
 
     # Confirm it's not the chatbot itself generating the message
     if sender != GLOBAL['chatbot_name']:
-        if 'hi' in message:
+        query = QUERY.match(message.strip())
+        counts = COUNTS.match(message.strip())
+        if query:
+            teamschat.send_chat(recent_events(*query.groups()))
+        elif counts:
+            teamschat.send_chat(event_counts(*counts.groups()))
+        elif 'hi' in message:
             teamschat.send_chat("hi")
         elif 'tell me a joke' in message:
             teamschat.send_chat(random.choice(jokes))
@@ -70,3 +109,67 @@ def parse(message, sender):
             teamschat.send_chat("She's way out of my league")
         else:
             print(f"{sender} says {message}")
+
+
+# Answer a question about recent events, from the in-memory index
+def recent_events(count, field, value):
+    '''
+    Takes the number of events (may be None), and the field and value
+        to search for (may be None)
+    Returns a message listing the matching events
+    '''
+    limit = min(int(count or 20), QUERY_LIMIT)
+    search = {}
+    if field:
+        if field == 'type':
+            field = 'event'
+        if field == 'level':
+            if not value.isdigit():
+                return f"'{value}' isn't a level; Use a number from 1 to 4"
+            value = int(value)
+        search[field] = value
+
+    matches = recent.events.query(limit=limit, **search)
+    if not matches:
+        return "There are no recent events that match"
+
+    lines = []
+    for event in matches:
+        line = f"{event.ts:%d/%m %H:%M:%S} <b>{event.event}</b>"
+        if event.device:
+            line += f" on <span style=\"color:Yellow\">{event.device}</span>"
+        if event.site:
+            line += f" in <span style=\"color:Lime\">{event.site}</span>"
+        if event.description:
+            line += f" - {event.description}"
+        lines.append(line)
+
+    return f"The last {len(matches)} events:<br>" + '<br>'.join(lines)
+
+
+# Answer a question about event counts, from the hourly roll-ups
+def event_counts(field, value, days):
+    '''
+    Takes the field and value to search for (may be None),
+        and the number of days to count (may be None)
+    Returns a message listing the number of each event type
+    '''
+    days = int(days or COUNT_DAYS)
+    since = datetime.now() - timedelta(days=days)
+    search = {}
+    if field:
+        if field == 'type':
+            field = 'event'
+        search[field] = value
+
+    try:
+        totals = maintenance.counts(sql.pool, since, **search)
+    except sql.backend.Error as e:
+        print(e)
+        return "I couldn't read event counts from the database"
+
+    if not totals:
+        return f"There were no matching events in the last {days} days"
+
+    lines = [f"<b>{event}</b>: {total}" for event, total in totals]
+    return f"Events in the last {days} days:<br>" + '<br>'.join(lines)
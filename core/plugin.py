@@ -9,12 +9,19 @@ Usage:
             class MyPlugin(plugin.PluginTemplate):
                 def __init__(self):
                     super().__init__(LOCATION)
+    Extend compile() to add the plugin's own settings to the snapshot
+    When a plugin is reloaded, the registry calls take_over() on the new
+        handler, and close() on the old one
 
 Authentication:
     N/A
 
 Restrictions:
-    TBA
+    The config is compiled into an immutable Snapshot
+        The file is watched, and a new snapshot replaces the old one
+        when it changes; A bad file keeps the last good snapshot
+    The config dictionary in the snapshot is shared, and must be
+        treated as read-only
 
 To Do:
     None
@@ -27,38 +34,189 @@ import yaml
 import socket
 import struct
 import termcolor
-from core import sql, hash
+from core import sql, hash, filters, dedup, recent, teamschat, watcher
+
+
+class Snapshot():
+    """
+    A plugin's compiled config
+    Snapshots are never changed; A refresh builds a new one
+        and replaces the old one, so readers don't need a lock
+    """
+
+    # Set the parts once, when the snapshot is created
+    def __init__(self, **parts):
+        for name, value in parts.items():
+            object.__setattr__(self, name, value)
+
+    # Stop the parts being changed later
+    def __setattr__(self, name, value):
+        raise AttributeError("Snapshots can't be changed")
+
+    def __delattr__(self, name):
+        raise AttributeError("Snapshots can't be changed")
 
 
 class PluginTemplate():
+    # Map the logical filter fields to the keys in this plugin's events
+    # Plugins can override this to suit their own events
+    FILTER_FIELDS = {
+        'site': ['site'],
+        'device': ['device', 'hostname', 'name'],
+        'type': ['type', 'event'],
+        'text': ['text', 'message', 'description'],
+    }
+
+    # Fields that can change between copies of the same event
+    # These are ignored when checking for duplicates
+    DEDUP_EXCLUDE = ('timestamp', 'time', 'src_ip', 'source', 'level')
+
     # Initialise the class and read the YAML file
     def __init__(self, location):
         # Default variables
-        self.config = {}
-        self.alert_levels = {}
         self.location = location
+        self.snapshot = None
+        self.config_error = None
 
-        # Read the YAML file
-        with open(location) as config:
-            try:
-                self.config = yaml.load(config, Loader=yaml.FullLoader)
-
-            # Handle problems with YAML syntax
-            except yaml.YAMLError as err:
-                print('Error parsing config file, exiting')
-                print('Check the YAML formatting at \
-                    https://yaml-online-parser.appspot.com/')
-                print(err)
-                return False
+        # Read and compile the YAML file
+        if not self.refresh():
+            raise ValueError(f"Could not load the config from {location}")
 
-        # Setup webhook authentication
-        self.auth_header = self.config['config']['auth_header']
-        self.webhook_secret = self.config['config']['webhook_secret']
-        try:
-            self.auth_header_secret = \
-                self.config['config']['auth_header_secret']
-        except Exception as e:
-            print(f"{e} not used in this plugin")
+        # Reload the config when the file changes
+        watcher.files.watch(location, self.refresh)
+
+    # Settings from the current snapshot
+    # Each of these is a single read, so they never need a lock
+    @property
+    def config(self):
+        return self.snapshot.config
+
+    @property
+    def filter(self):
+        return self.snapshot.filter
+
+    @property
+    def verifier(self):
+        return self.snapshot.verifier
+
+    @property
+    def dedup(self):
+        return self.snapshot.dedup
+
+    @property
+    def dedup_fields(self):
+        return self.snapshot.dedup_fields
+
+    @property
+    def auth_header(self):
+        return self.snapshot.auth_header
+
+    @property
+    def webhook_secret(self):
+        return self.snapshot.webhook_secret
+
+    @property
+    def auth_header_secret(self):
+        return self.snapshot.auth_header_secret
+
+    # Compile anything that's built from the config (eg, filters)
+    # Plugins can extend this to compile their own settings
+    def compile(self, config):
+        """
+        Compile the config into objects that are quick to use per event
+        Takes the config (from the YAML file)
+        Returns a dictionary of parts, which become the snapshot
+        Raises an exception if the config isn't valid
+        """
+        parts = {
+            'filter': filters.EventFilter(
+                config.get('filter') or [],
+                self.FILTER_FIELDS
+            )
+        }
+
+        # Webhook authentication; 'webhook_secret' can be a list,
+        #   so a secret can be changed without rejecting webhooks
+        auth_config = config['config']
+        parts['auth_header'] = auth_config['auth_header']
+        parts['webhook_secret'] = auth_config['webhook_secret']
+        parts['auth_header_secret'] = auth_config.get('auth_header_secret')
+
+        parts['verifier'] = hash.Verifier(
+            header=auth_config.get('auth_header', ''),
+            secrets=auth_config.get('webhook_secret') or [],
+            replay_window=auth_config.get('replay_window', 0),
+            timestamp_header=auth_config.get('timestamp_header')
+        )
+
+        # Duplicate detection (disabled if there's no 'dedup' section)
+        dedup_config = config.get('dedup') or {}
+        parts['dedup_fields'] = dedup_config.get('fields')
+        parts['dedup'] = None
+        if dedup_config.get('enabled', False):
+            parts['dedup'] = dedup.DedupCache(
+                ttl=dedup_config.get('ttl', dedup.DEDUP_TTL),
+                max_entries=dedup_config.get(
+                    'max_entries', dedup.DEDUP_MAX_ENTRIES)
+            )
+
+        return parts
+
+    # Keep the caches from the last snapshot, so a refresh doesn't
+    #   forget the webhooks and events that were already seen
+    def carry_over(self, previous, parts):
+        """
+        Takes the last snapshot, and the parts of the new one
+        Only called once the new config has compiled
+        """
+        if previous is None:
+            return
+
+        verifier = parts['verifier']
+        if previous.verifier.replay is not None \
+                and verifier.replay is not None:
+            previous.verifier.replay.ttl = verifier.replay_window
+            verifier.replay = previous.verifier.replay
+
+        cache = parts['dedup']
+        if previous.dedup is not None and cache is not None:
+            previous.dedup.ttl = cache.ttl
+            previous.dedup.max_entries = cache.max_entries
+            parts['dedup'] = previous.dedup
+
+    # Take over the caches of the handler this one replaces
+    # Without this, a reload would forget the webhooks and events seen
+    #   so far, and let replays and duplicates through
+    def take_over(self, old):
+        previous = getattr(old, 'snapshot', None)
+        if not isinstance(previous, Snapshot):
+            return
+
+        parts = dict(vars(self.snapshot))
+        del parts['config']
+        self.carry_over(previous, parts)
+        self.snapshot = Snapshot(config=self.snapshot.config, **parts)
+
+    # Stop watching the config file, once this handler is replaced
+    def close(self):
+        watcher.files.unwatch(self.location, self.refresh)
+
+    # Check if an event should be filtered out
+    def filtered(self, event, snapshot=None):
+        """
+        Returns True if the event matches any filter in the config
+        Optionally takes the snapshot to use, so a webhook is handled
+            with the same config throughout
+        """
+        snapshot = snapshot or self.snapshot
+        match = snapshot.filter.check(event)
+        if match is not None:
+            print(termcolor.colored(
+                f"filtering out an event (filter: {match})",
+                "yellow"))
+            return True
+
+        return False
 
     # Convert an IPv4 address to an integer
     def ip2integer(self, ip):
@@ -70,43 +228,101 @@ class PluginTemplate():
         packedIP = socket.inet_aton(ip)
         return struct.unpack("!L", packedIP)[0]
 
+    # Check if an event is a duplicate of a recent one
+    def duplicate(self, event, snapshot=None):
+        """
+        Returns True if the same event was seen recently
+        The 'fields' list in the 'dedup' config decides what makes
+            two events the same (default: all fields except DEDUP_EXCLUDE)
+        Optionally takes the snapshot to use, as filtered() does
+        """
+        snapshot = snapshot or self.snapshot
+        if snapshot.dedup is None:
+            return False
+
+        key = dedup.event_key(
+            event, snapshot.dedup_fields, self.DEDUP_EXCLUDE)
+        if snapshot.dedup.seen(key):
+            print(termcolor.colored(
+                "dropping a duplicate event",
+                "yellow"))
+            return True
+
+        return False
+
     # Refresh the plugin's config file
     def refresh(self):
         """
-        Re-read the config file as needed
+        Read the config file, and compile it into a new snapshot
+        The snapshot replaces the old one in a single step
+        If the file can't be used, the last good snapshot is kept
+        Returns True if the new config was loaded
         """
-        with open(self.location) as config:
-            try:
-                self.config = yaml.load(config, Loader=yaml.FullLoader)
+        try:
+            with open(self.location) as file:
+                config = yaml.load(file, Loader=yaml.FullLoader)
+            if not isinstance(config, dict):
+                raise ValueError("The config file is empty")
 
-            # Handle problems with YAML syntax
-            except yaml.YAMLError as err:
-                print(termcolor.colored(
-                    'Error parsing config file, exiting',
-                    "red"))
-                print('Check the YAML formatting at \
-                    https://yaml-online-parser.appspot.com/')
-                print(err)
-                return False
+            parts = self.compile(config)
+            self.carry_over(self.snapshot, parts)
+            snapshot = Snapshot(config=config, **parts)
+
+        # Problems with YAML syntax, or settings that can't be compiled
+        except Exception as err:
+            self.config_failed(err)
+            return False
+
+        self.snapshot = snapshot
+        if self.config_error is not None:
+            print(termcolor.colored(
+                f"Config file {self.location} loaded again",
+                "green"))
+            self.config_error = None
+
+        return True
+
+    # Report a config file that can't be loaded
+    def config_failed(self, err):
+        """
+        The error is only reported once, until the file is fixed
+        The latest error is kept in 'config_error'
+        """
+        reported = self.config_error is not None
+        error = f"{type(err).__name__}: {err}"
+        self.config_error = error
+        if reported:
+            return
+
+        message = f"Error loading config file {self.location}"
+        if self.snapshot is not None:
+            message += "; Keeping the last good config"
+        print(termcolor.colored(message, "red"))
+        print('Check the YAML formatting at '
+              'https://yaml-online-parser.appspot.com/')
+        print(err)
+
+        # Only send a chat for a refresh; The registry reports startup
+        if self.snapshot is not None:
+            teamschat.send_chat(f"{message}<br>{error}")
 
     # Write to an SQL database
-    def sql_write(self, database, fields):
+    def sql_write(self, database, fields, level=None):
         """
         Write fields to the SQL server
+        The row is buffered, and written in a batch with other events
+        The event is also added to the recent events, for chat queries
+        Returns a Future, which is True once the row is written
         """
-        sql_conn = sql.Sql()
-        sql_conn.add(database, fields)
+        recent.events.add(database, fields, level)
+        return sql.writer.write(database, fields)
 
     # Check webhook authentication
     def authenticate(self, request, plugin):
         # Check if there is an authentication header
         if plugin['handler'].auth_header != '':
             # Check that this webhook has come from a legitimate resource
-            auth_result = hash.auth_message(
-                header=plugin['handler'].auth_header,
-                secret=plugin['handler'].webhook_secret,
-                webhook=request
-            )
+            auth_result = plugin['handler'].verifier.verify(request)
 
             if auth_result == 'fail':
                 print(termcolor.colored(
@@ -114,6 +330,12 @@ class PluginTemplate():
                     "red"))
                 return False
 
+            elif auth_result == 'replayed':
+                print(termcolor.colored(
+                    "Received a webhook that was already seen, or is too old",
+                    "red"))
+                return False
+
             elif auth_result == 'unauthenticated':
                 print(termcolor.colored(
                     "Unauthenticated webhook received",
@@ -0,0 +1,254 @@
+"""
+Keeps the most recent events in memory, so they can be queried quickly
+Used to answer chat questions like 'last 20 events for site X',
+    without going to the database
+
+Usage:
+    import 'recent' into the application
+    Plugins add events with recent.events.add()
+        (the plugin template's sql_write() does this)
+    The web service calls recent.events.warm() at startup,
+        to load the newest events from the database
+    Call query() with any of device, site, event, and level
+        Returns the newest matching events first
+    Call status() to get the number of events held
+
+Authentication:
+    N/A
+
+Restrictions:
+    Holds up to 'size' events (see the 'recent' section of config.yaml)
+        When full, the oldest event is replaced
+    Descriptions are cut to 'description_limit' characters,
+        so memory use stays bounded
+    Matching is not case sensitive
+    Events loaded from the database don't have a level
+
+To Do:
+    None
+"""
+
+
+import sys
+import threading
+import termcolor
+from collections import deque
+from datetime import datetime
+from config import RECENT
+from core import schema
+
+
+# Defaults, used if the 'recent' section of config.yaml is missing
+RECENT_SIZE = 10000
+DESCRIPTION_LIMIT = 200
+
+# Fields that events are indexed by
+INDEXED = ('device', 'site', 'event', 'level')
+
+
+class Event():
+    '''
+    A compact record of one event
+    Repeated strings (device, site, etc) are interned, so they're shared
+    '''
+    __slots__ = (
+        'seq', 'ts', 'table', 'device', 'site', 'event', 'level',
+        'description', 'message'
+    )
+
+    def __init__(self, seq, ts, table, device, site, event, level,
+                 description, message):
+        self.seq = seq
+        self.ts = ts
+        self.table = table
+        self.device = device
+        self.site = site
+        self.event = event
+        self.level = level
+        self.description = description
+        self.message = message
+
+
+# Intern a string, so identical values share memory
+def intern(value):
+    if not value:
+        return ''
+    return sys.intern(str(value))
+
+
+# Get the index key for a value
+def index_key(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, int):
+        return value
+    return sys.intern(str(value).strip().lower())
+
+
+class RecentEvents():
+    # Initialise an empty ring buffer
+    def __init__(self, size=RECENT_SIZE, description_limit=DESCRIPTION_LIMIT):
+        self.size = size
+        self.description_limit = description_limit
+
+        # The ring buffer; An event's slot is its sequence number % size
+        self.buffer = [None] * size
+        self.next_seq = 0
+
+        # Sequence numbers for each value of each indexed field,
+        #   oldest first
+        self.indexes = {field: {} for field in INDEXED}
+        self.lock = threading.Lock()
+
+    # Add an event
+    def add(self, table, fields, level=None):
+        '''
+        Takes the table the event was written to, its SQL fields,
+            and optionally the event's level
+        '''
+        description = fields.get('description') or ''
+        record = Event(
+            seq=0,
+            ts=fields.get('ts') or datetime.now(),
+            table=intern(table),
+            device=intern(fields.get('device')),
+            site=intern(fields.get('site')),
+            event=intern(fields.get('event')),
+            level=level,
+            description=description[:self.description_limit],
+            message=fields.get('message') or ''
+        )
+
+        with self.lock:
+            record.seq = self.next_seq
+            self.next_seq += 1
+            slot = record.seq % self.size
+
+            # Replace the oldest event, and remove it from the indexes
+            # It's always the first entry in each of its index lists
+            old = self.buffer[slot]
+            if old is not None:
+                for field in INDEXED:
+                    key = index_key(getattr(old, field))
+                    if key is None:
+                        continue
+                    entries = self.indexes[field][key]
+                    entries.popleft()
+                    if not entries:
+                        del self.indexes[field][key]
+
+            self.buffer[slot] = record
+            for field in INDEXED:
+                key = index_key(getattr(record, field))
+                if key is not None:
+                    self.indexes[field].setdefault(key, deque()).append(
+                        record.seq
+                    )
+
+    # Find the newest events that match
+    def query(self, device=None, site=None, event=None, level=None,
+              limit=20):
+        '''
+        Takes any of device, site, event type, and level
+        Returns up to 'limit' matching events, newest first
+        '''
+        wanted = {
+            field: index_key(value)
+            for field, value in (
+                ('device', device),
+                ('site', site),
+                ('event', event),
+                ('level', level)
+            )
+            if value is not None
+        }
+
+        results = []
+        with self.lock:
+            # Start with the smallest index, then check the other fields
+            if wanted:
+                candidates = min(
+                    (
+                        self.indexes[field].get(key, ())
+                        for field, key in wanted.items()
+                    ),
+                    key=len
+                )
+                sequences = reversed(candidates)
+            else:
+                oldest = max(0, self.next_seq - self.size)
+                sequences = range(self.next_seq - 1, oldest - 1, -1)
+
+            for seq in sequences:
+                record = self.buffer[seq % self.size]
+                if all(
+                    index_key(getattr(record, field)) == key
+                    for field, key in wanted.items()
+                ):
+                    results.append(record)
+                    if len(results) >= limit:
+                        break
+
+        return results
+
+    # Load the newest events from the database
+    def warm(self, pool):
+        '''
+        Takes the SQL connection pool
+        Loads up to 'size' events from each table, oldest first
+        '''
+        rows = []
+        backend = pool.backend
+
+        try:
+            with pool.connection() as conn:
+                cursor = conn.cursor()
+                for table, columns in schema.TABLES.items():
+                    names = [
+                        column for column, type, nullable in columns
+                        if column in ('ts', 'device', 'site', 'event',
+                                      'description', 'message')
+                    ]
+                    cursor.execute(
+                        backend.recent_statement(table, names, self.size)
+                    )
+                    for row in cursor.fetchall():
+                        fields = dict(zip(names, row))
+                        if isinstance(fields['ts'], str):
+                            fields['ts'] = datetime.fromisoformat(fields['ts'])
+                        rows.append((fields['ts'], table, fields))
+
+        except backend.Error as e:
+            print(termcolor.colored(
+                "Could not load recent events from the database",
+                "yellow"))
+            print(e)
+            return False
+
+        # Add the newest events across all tables, oldest first
+        rows.sort(key=lambda row: row[0])
+        for ts, table, fields in rows[-self.size:]:
+            self.add(table, fields)
+
+        print(termcolor.colored(
+            f"Loaded {min(len(rows), self.size)} recent events",
+            "green"))
+        return True
+
+    # Report statistics
+    def status(self):
+        '''Returns a dictionary with the number of events held'''
+        with self.lock:
+            return {
+                'events': min(self.next_seq, self.size),
+                'size': self.size,
+                'devices': len(self.indexes['device']),
+                'sites': len(self.indexes['site']),
+            }
+
+
+# The shared recent events, used by all plugins
+events = RecentEvents(
+    RECENT.get('size', RECENT_SIZE),
+    RECENT.get('description_limit', DESCRIPTION_LIMIT)
+)
@@ -0,0 +1,291 @@
+"""
+Keeps the loaded plugins, indexed by their route
+Plugins can be loaded again while the service is running,
+    so a plugin can be added or fixed without a restart
+
+Usage:
+    import 'registry' into the application
+    The web service calls registry.plugins.load_all() at startup
+    Call get() with a route to find its plugin entry
+        An entry is a dictionary with 'name', 'route', and 'handler'
+    Call reload() to import the plugins again, and swap in new handlers
+        Pass a route to reload just that plugin
+        The list of plugins is read from config.yaml again,
+        so new plugins are added, and removed plugins are dropped
+    Call watch_signal() to reload when the service gets SIGHUP
+    Call count() to add to a route's request counters
+    Call status() to get the counters for each route
+
+Authentication:
+    N/A
+
+Restrictions:
+    Each reload creates a new handler, and replaces the route's entry in
+        one step; Requests (and queued webhooks) that already have the old
+        entry finish with the old handler
+        The new handler takes over the old one's replay and dedup caches,
+        and the old handler stops watching its config file
+    If a plugin fails to load, its old handler is kept
+    Python modules in the plugin's package are reloaded, so code changes
+        take effect; Other modules (eg, core) are not
+    SIGHUP isn't available on Windows; Use the /admin/reload route instead
+    config.plugin_list is kept up to date, for modules that loop through
+        all plugins
+
+To Do:
+    None
+"""
+
+
+import sys
+import yaml
+import signal
+import importlib
+import threading
+import termcolor
+from config import PLUGINS, plugin_list
+from core import teamschat
+
+
+# Counters kept for each route
+COUNTERS = (
+    'requests', 'accepted', 'unauthenticated', 'invalid', 'busy'
+)
+
+
+class PluginRegistry():
+    # Initialise an empty registry
+    def __init__(self, entries):
+        '''
+        Takes a list, which is kept up to date with the loaded plugins
+        '''
+        self.entries = entries
+        self.routes = {}
+        self.counters = {}
+        self.reloads = 0
+        self.errors = 0
+
+        # 'lock' protects the counters
+        # 'reload_lock' stops two reloads running at once
+        self.lock = threading.Lock()
+        self.reload_lock = threading.Lock()
+
+    # Find the plugin for a route
+    def get(self, route):
+        '''Returns the plugin entry, or None if there's no such route'''
+        return self.routes.get(route)
+
+    # Import a plugin, and create its handler
+    def load(self, settings, reload=False):
+        '''
+        Takes the plugin's settings from config.yaml
+        Returns a new plugin entry, or None if the plugin can't be loaded
+        '''
+        print(termcolor.colored(
+            f"Loading plugin: {settings['name']}",
+            "green"))
+
+        try:
+            if reload:
+                module = reload_module(settings['module'])
+            else:
+                module = importlib.import_module(settings['module'])
+        except Exception as e:
+            print(termcolor.colored(
+                f"Error loading the {settings['name']} plugin",
+                "red"))
+            print(f"{e} error while loading the module")
+            return None
+        print(module)
+
+        try:
+            handler = getattr(module, settings['class'])()
+        except Exception as e:
+            message = f"Error loading the {settings['name']} plugin"
+            print(termcolor.colored(message, "red"))
+            print(f"{e} error while loading the class")
+            teamschat.send_chat(message)
+            return None
+
+        return {
+            'name': settings['name'],
+            'route': settings['route'],
+            'handler': handler,
+        }
+
+    # Load all plugins in config.yaml
+    def load_all(self, plugins=None):
+        '''
+        Takes the 'plugins' section of config.yaml
+        Returns the number of plugins loaded
+        '''
+        with self.reload_lock:
+            for settings in (plugins or PLUGINS).values():
+                entry = self.load(settings)
+                if entry is not None:
+                    self.routes[entry['route']] = entry
+
+            self.publish()
+            return len(self.routes)
+
+    # Load plugins again, and swap in the new handlers
+    def reload(self, route=None):
+        '''
+        Takes a route to reload, or None to reload every plugin
+        Returns a dictionary of route: True/False (loaded or not)
+        '''
+        with self.reload_lock:
+            plugins = read_plugins()
+            results = {}
+
+            for settings in plugins.values():
+                if route is not None and settings['route'] != route:
+                    continue
+
+                entry = self.load(settings, reload=True)
+                results[settings['route']] = entry is not None
+                if entry is None:
+                    self.errors += 1
+                    continue
+
+                # Keep the caches, so replays and duplicates are still
+                #   caught, then replace the entry in one step
+                old = self.routes.get(entry['route'])
+                if old is not None:
+                    take_over(entry['handler'], old['handler'])
+                self.routes[entry['route']] = entry
+                self.reloads += 1
+
+                if old is not None:
+                    close(old['handler'])
+
+            # Drop plugins that have been removed from config.yaml
+            if route is None:
+                configured = {
+                    settings['route'] for settings in plugins.values()
+                }
+                for old in list(self.routes):
+                    if old not in configured:
+                        print(termcolor.colored(
+                            f"Removing plugin for /{old}",
+                            "yellow"))
+                        close(self.routes.pop(old)['handler'])
+
+            self.publish()
+
+        print(termcolor.colored(
+            f"Plugins reloaded: {results}",
+            "green" if all(results.values()) else "red"))
+        return results
+
+    # Update the shared list of plugins
+    def publish(self):
+        self.entries[:] = list(self.routes.values())
+
+    # Reload all plugins when the service gets SIGHUP
+    def watch_signal(self):
+        '''
+        Must be called from the main thread
+        Returns False if the platform doesn't have SIGHUP
+        '''
+        if not hasattr(signal, 'SIGHUP'):
+            return False
+
+        # Signal handlers should be quick, so the reload runs in a thread
+        def handler(signum, frame):
+            threading.Thread(
+                target=self.reload,
+                name='plugin-reload',
+                daemon=True
+            ).start()
+
+        signal.signal(signal.SIGHUP, handler)
+        return True
+
+    # Update a route's counters
+    def count(self, route, name):
+        with self.lock:
+            counters = self.counters.get(route)
+            if counters is None:
+                counters = self.counters[route] = dict.fromkeys(COUNTERS, 0)
+            counters[name] += 1
+
+    # Report request counters for each route
+    def status(self):
+        '''Returns a dictionary of counters for each route'''
+        with self.lock:
+            routes = {
+                route: dict(counters)
+                for route, counters in self.counters.items()
+            }
+
+        for route, entry in list(self.routes.items()):
+            routes.setdefault(route, dict.fromkeys(COUNTERS, 0))
+            routes[route]['plugin'] = entry['name']
+
+        return {
+            'routes': routes,
+            'reloads': self.reloads,
+            'errors': self.errors,
+        }
+
+
+# Have a new handler take over an old one's state (see plugin.py)
+# Plugins that don't use the plugin template may not support this
+def take_over(handler, old):
+    if hasattr(handler, 'take_over'):
+        try:
+            handler.take_over(old)
+        except Exception as e:
+            print(termcolor.colored(
+                "Could not keep the caches of the old handler",
+                "red"))
+            print(e)
+
+
+# Tidy up a handler that has been replaced or removed
+def close(handler):
+    if hasattr(handler, 'close'):
+        handler.close()
+
+
+# Import a plugin's module again, with the other modules in its package
+def reload_module(name):
+    '''
+    Takes the module name (eg, 'plugins.mist.misthandler')
+    Modules in the same package are reloaded first, as the plugin's
+        module usually imports them
+    Returns the reloaded module
+    '''
+    package = name.rpartition('.')[0]
+    if package:
+        for loaded in sorted(sys.modules):
+            if loaded.startswith(package + '.') and loaded != name:
+                importlib.reload(sys.modules[loaded])
+
+    if name in sys.modules:
+        return importlib.reload(sys.modules[name])
+    return importlib.import_module(name)
+
+
+# Read the list of plugins from config.yaml again
+def read_plugins():
+    '''
+    Returns the 'plugins' section of config.yaml
+    If the file can't be read, the plugins from startup are used
+    '''
+    try:
+        with open('config.yaml') as file:
+            return yaml.load(file, Loader=yaml.FullLoader)['plugins']
+
+    except (OSError, yaml.YAMLError, KeyError, TypeError) as e:
+        print(termcolor.colored(
+            "Could not read the plugins from config.yaml; "
+            "Using the plugins from startup",
+            "red"))
+        print(e)
+        return PLUGINS
+
+
+# The shared plugin registry
+plugins = PluginRegistry(plugin_list)
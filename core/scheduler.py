@@ -0,0 +1,246 @@
+"""
+Runs periodic and delayed jobs from a single thread
+Replaces a Timer thread per job (eg, token and subscription refreshes)
+
+Usage:
+    import 'scheduler' into the application
+    Call scheduler.jobs.add() with a name and a function
+        'delay' is the time until the first run (seconds)
+        'interval' runs it again after each successful run;
+            Leave it out for a job that runs once
+    Call run_now() to run a job straight away (eg, after logging in)
+    Call cancel() to stop a job
+    The web service calls scheduler.jobs.start() at startup
+    Call status() to get each job's next run and last duration
+
+Authentication:
+    N/A
+
+Restrictions:
+    Jobs are kept in a heap, ordered by when they're due
+        The thread sleeps until the next job is due, or a job is added
+    Each name is one job; Adding it again while it's waiting doesn't
+        create a second copy, it keeps the earlier of the two run times
+        A job can call add() with its own name to pick its next run
+    A job has failed if it returns False or raises an exception
+        It's retried after 'retry_delay' seconds, doubling each time,
+        up to 'max_retry_delay' (see the 'scheduler' section of config.yaml)
+    Jobs run one at a time, so they should be quick
+        A job that needs to wait (eg, for a login) should fail,
+        and be retried, rather than block the thread
+
+To Do:
+    None
+"""
+
+
+import time
+import heapq
+import threading
+import termcolor
+from datetime import datetime, timedelta
+from config import SCHEDULER
+
+
+# Defaults, used if the 'scheduler' section of config.yaml is missing
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 900
+
+
+class Scheduler():
+    # Initialise an empty schedule
+    def __init__(self, config):
+        '''
+        Takes the 'scheduler' section of config.yaml
+        '''
+        self.retry_delay = config.get('retry_delay', RETRY_DELAY)
+        self.max_retry_delay = config.get('max_retry_delay', MAX_RETRY_DELAY)
+
+        # Jobs, keyed by name, and a heap of (due, sequence, name)
+        # An entry is stale if its sequence isn't the job's current one
+        self.jobs = {}
+        self.heap = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.thread = None
+
+    # Add a job, or bring an existing one forward
+    def add(self, name, function, delay=0, interval=None):
+        '''
+        Takes a name for the job, and the function to run (no arguments)
+        Optionally, takes the delay before it runs,
+            and the interval between runs
+        '''
+        with self.condition:
+            job = self.jobs.get(name)
+            if job is None:
+                job = self.jobs[name] = {
+                    'name': name,
+                    'due': None,
+                    'sequence': None,
+                    'runs': 0,
+                    'failures': 0,
+                    'retries': 0,
+                    'last_run': None,
+                    'last_duration': None,
+                    'last_error': None,
+                }
+
+            job['function'] = function
+            job['interval'] = interval
+            self.push(job, time.monotonic() + max(delay, 0))
+
+    # Run a job as soon as possible
+    def run_now(self, name):
+        '''Returns False if there's no such job'''
+        with self.condition:
+            job = self.jobs.get(name)
+            if job is None:
+                return False
+            self.push(job, time.monotonic())
+            return True
+
+    # Stop running a job
+    def cancel(self, name):
+        with self.condition:
+            self.jobs.pop(name, None)
+
+    # Schedule a job; Must be called with the condition held
+    def push(self, job, due, force=False):
+        '''
+        A waiting job keeps the earlier run time, unless 'force' is set
+        '''
+        if job['due'] is not None and job['due'] <= due and not force:
+            return
+
+        self.sequence += 1
+        job['due'] = due
+        job['sequence'] = self.sequence
+        heapq.heappush(self.heap, (due, self.sequence, job['name']))
+        self.condition.notify()
+
+    # Start the scheduler thread
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(
+            target=self.run,
+            name='scheduler',
+            daemon=True
+        )
+        self.thread.start()
+
+    # Thread; Run each job when it's due
+    def run(self):
+        while True:
+            with self.condition:
+                job = self.next_job()
+                if job is None:
+                    continue
+
+            self.run_job(job)
+
+    # Wait for the next job; Must be called with the condition held
+    def next_job(self):
+        '''
+        Returns the job, or None if the thread was woken early
+        '''
+        # Drop entries for jobs that were moved or cancelled
+        while self.heap:
+            due, sequence, name = self.heap[0]
+            job = self.jobs.get(name)
+            if job is not None and job['sequence'] == sequence:
+                break
+            heapq.heappop(self.heap)
+
+        if not self.heap:
+            self.condition.wait()
+            return None
+
+        wait = self.heap[0][0] - time.monotonic()
+        if wait > 0:
+            self.condition.wait(wait)
+            return None
+
+        heapq.heappop(self.heap)
+        job['due'] = None
+        return job
+
+    # Run a job, and schedule its next run
+    def run_job(self, job):
+        started = time.monotonic()
+        sequence = job['sequence']
+        error = None
+
+        try:
+            result = job['function']()
+        except Exception as e:
+            result = False
+            error = f"{type(e).__name__}: {e}"
+
+        duration = time.monotonic() - started
+        with self.condition:
+            job['runs'] += 1
+            job['last_run'] = datetime.now().isoformat(timespec='seconds')
+            job['last_duration'] = round(duration, 3)
+
+            if result is False:
+                job['failures'] += 1
+                job['retries'] += 1
+                job['last_error'] = error or 'failed'
+                delay = min(
+                    self.retry_delay * 2 ** (job['retries'] - 1),
+                    self.max_retry_delay
+                )
+                if self.jobs.get(job['name']) is job:
+                    self.push(job, time.monotonic() + delay, force=True)
+
+            else:
+                job['retries'] = 0
+                job['last_error'] = None
+
+                # Unless the job picked its own next run,
+                #   run it again after the interval
+                if job['sequence'] == sequence and job['interval']:
+                    self.push(job, time.monotonic() + job['interval'])
+                elif job['due'] is None:
+                    self.jobs.pop(job['name'], None)
+
+        if result is False:
+            print(termcolor.colored(
+                f"Scheduled job '{job['name']}' failed, "
+                f"retrying in {delay} seconds",
+                "red"))
+            if error:
+                print(error)
+
+    # Report each job's schedule
+    def status(self):
+        '''Returns a dictionary of jobs'''
+        now = time.monotonic()
+        jobs = {}
+        with self.condition:
+            for name, job in self.jobs.items():
+                next_run = None
+                if job['due'] is not None:
+                    next_run = (
+                        datetime.now() + timedelta(seconds=job['due'] - now)
+                    ).isoformat(timespec='seconds')
+
+                jobs[name] = {
+                    'next_run': next_run,
+                    'interval': job['interval'],
+                    'last_run': job['last_run'],
+                    'last_duration': job['last_duration'],
+                    'runs': job['runs'],
+                    'failures': job['failures'],
+                    'retries': job['retries'],
+                    'last_error': job['last_error'],
+                }
+
+        return jobs
+
+
+# The shared scheduler
+jobs = Scheduler(SCHEDULER)
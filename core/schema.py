@@ -0,0 +1,106 @@
+"""
+The database schema, shared by all storage backends
+Tables are defined once here, and each backend turns them into SQL
+
+Usage:
+    import 'schema' into a backend or script
+    TABLES lists each table, with its columns
+    Each column has a name, a generic type, and whether it can be null
+        Backends map the generic types to their own (see storage.py)
+    INDEXES lists the indexes on each table
+    ROLLUPS lists the hourly roll-up table for each event table
+        Call columns() to get the columns of any table
+    Changes to existing databases are made by migrations.py
+
+Authentication:
+    N/A
+
+Restrictions:
+    Generic types are:
+        id - An auto-incrementing primary key
+        timestamp - A date and time
+        name - A short string that can be indexed (up to 255 characters)
+        text - A string of any length
+        ip - An IPv4 address, stored as a number
+        count - A whole number
+
+To Do:
+    None
+"""
+
+
+# Columns shared by the event tables
+#   (name, type, nullable)
+EVENT_COLUMNS = [
+    ('id', 'id', False),
+    ('ts', 'timestamp', False),
+    ('device', 'name', True),
+    ('event', 'name', False),
+    ('description', 'text', True),
+    ('source', 'ip', False),
+    ('message', 'name', True),
+]
+
+
+# Tables used by the plugins
+TABLES = {
+    'mist_events': EVENT_COLUMNS[:3] + [('site', 'name', True)] +
+    EVENT_COLUMNS[3:],
+    'junos_events': EVENT_COLUMNS,
+    'loginsight_events': EVENT_COLUMNS,
+}
+
+
+# Indexes on each table, for queries like 'events for X in the last hour'
+#   (index name, columns)
+INDEXES = {
+    'mist_events': [
+        ('ix_mist_events_device_ts', ('device', 'ts')),
+        ('ix_mist_events_site_ts', ('site', 'ts')),
+    ],
+    'junos_events': [
+        ('ix_junos_events_device_ts', ('device', 'ts')),
+    ],
+    'loginsight_events': [
+        ('ix_loginsight_events_device_ts', ('device', 'ts')),
+    ],
+}
+
+
+# Hourly roll-ups, with the number of events for each site, device,
+#   and event type in each hour (see maintenance.py)
+# Missing values are stored as '', so each row is unique
+def rollup_columns(table):
+    return [('hour', 'timestamp', False)] + [
+        (column, 'name', False)
+        for column, type, nullable in TABLES[table]
+        if column in ('site', 'device', 'event')
+    ] + [('events', 'count', False)]
+
+
+ROLLUPS = {
+    table: f"{table}_hourly"
+    for table in TABLES
+}
+
+
+# The last hour rolled up for each table
+WATERMARK_COLUMNS = [
+    ('name', 'name', False),
+    ('value', 'timestamp', False),
+]
+
+
+# Get the columns for any table
+def columns(table):
+    if table in TABLES:
+        return TABLES[table]
+
+    for source, rollup in ROLLUPS.items():
+        if rollup == table:
+            return rollup_columns(source)
+
+    if table == 'watermarks':
+        return WATERMARK_COLUMNS
+
+    raise KeyError(table)
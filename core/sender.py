@@ -0,0 +1,242 @@
+"""
+Sends requests to the Graph API, handling throttling and retries
+
+Usage:
+    import 'sender' into a module that calls the Graph API
+    Create a Sender object (teamschat has a shared one)
+    Call send() with a function that makes the API call
+        The function is called again for each retry
+        Pass idempotent=False for calls that create something (eg, POST)
+        Returns the response, or None if the message was dropped
+    Call status() to get counters and the current in-flight limit
+
+Authentication:
+    N/A - The request function handles authentication
+
+Restrictions:
+    Graph throttles per app and per chat
+        (https://learn.microsoft.com/en-us/graph/throttling)
+    When Graph responds with 429 (or 503), the Retry-After header is
+        honoured by all threads, not just the one that was throttled
+    Requests are retried with jittered backoff until the deadline
+        Messages that can't be sent within the deadline are dropped
+    Requests that aren't idempotent (eg, posting a chat message) are only
+        retried when we know Graph didn't act on them:
+        A connection error, 429, or 503 with a Retry-After header
+        Other errors (eg, a read timeout or a 502) may come after Graph
+        has acted on the request, so retrying could post a duplicate
+    The number of requests in flight is adaptive:
+        It halves each time Graph throttles us,
+        and grows back slowly as requests succeed
+
+To Do:
+    None
+"""
+
+
+import time
+import random
+import threading
+import requests
+import termcolor
+
+
+# Responses that are worth retrying
+THROTTLE_STATUS = (429, 503)
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Defaults
+MAX_IN_FLIGHT = 8
+MIN_IN_FLIGHT = 1
+DEADLINE = 60
+BASE_DELAY = 1
+MAX_DELAY = 30
+
+
+class Sender():
+    # Initialise the sender and counters
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, deadline=DEADLINE,
+                 base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+        self.max_in_flight = max_in_flight
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        # The current limit on requests in flight, and when we can send
+        #   again after being throttled (time.monotonic())
+        self.limit = float(max_in_flight)
+        self.in_flight = 0
+        self.paused_until = 0
+        self.condition = threading.Condition()
+
+        self.stats = {
+            'sent': 0,
+            'throttled': 0,
+            'retried': 0,
+            'dropped': 0,
+            'failed': 0,
+        }
+
+    # Send a request, retrying if needed
+    def send(self, request, idempotent=True):
+        '''
+        Takes a function that makes the API call, and returns the response
+            idempotent is False if repeating the call could create a
+            duplicate (eg, POST); These are retried more carefully
+        Returns None if the call couldn't be made before the deadline
+        Responses that aren't worth retrying (eg, 400) are returned as-is
+        '''
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+
+        while True:
+            if not self.acquire(deadline):
+                return self.drop('no capacity before the deadline')
+
+            throttled = False
+            response = None
+            error = None
+            try:
+                response = request()
+                status = response.status_code
+                throttled = status in THROTTLE_STATUS
+            except requests.RequestException as e:
+                status = None
+                error = e
+                print(termcolor.colored(
+                    f"Graph API request error: {e}",
+                    "yellow"))
+            finally:
+                self.release(throttled)
+
+            # Success, or an error that retrying won't fix
+            if status is not None and not should_retry(response, idempotent):
+                self.count('sent' if response.ok else 'failed')
+                return response
+
+            # Unless we couldn't connect, Graph may have the request already
+            if (
+                error is not None and not idempotent and
+                not isinstance(error, requests.ConnectionError)
+            ):
+                return self.drop(
+                    f"{type(error).__name__}, it may have been sent")
+
+            # Work out how long to wait before trying again
+            # Retry-After is used if Graph sent it,
+            #   otherwise a random delay (full jitter) that grows each time
+            delay = None
+            if response is not None:
+                delay = retry_after(response)
+                if throttled:
+                    self.count('throttled')
+                    self.pause(delay)
+
+            if delay is None:
+                delay = random.uniform(
+                    0,
+                    min(self.max_delay, self.base_delay * 2 ** attempt)
+                )
+
+            if time.monotonic() + delay > deadline:
+                return self.drop(f"status {status}, out of time to retry")
+
+            self.count('retried')
+            time.sleep(delay)
+            attempt += 1
+
+    # Wait for a free slot, or until the deadline passes
+    def acquire(self, deadline):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    return False
+
+                # Everyone waits if Graph has asked us to back off
+                if now < self.paused_until:
+                    self.condition.wait(min(self.paused_until, deadline) - now)
+                    continue
+
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return True
+
+                self.condition.wait(deadline - now)
+
+    # Free a slot, and adjust the limit
+    def release(self, throttled):
+        with self.condition:
+            self.in_flight -= 1
+
+            # Halve the limit when throttled, grow it slowly otherwise
+            if throttled:
+                self.limit = max(MIN_IN_FLIGHT, self.limit / 2)
+            else:
+                self.limit = min(
+                    self.max_in_flight,
+                    self.limit + 1 / self.limit
+                )
+
+            self.condition.notify_all()
+
+    # Stop all threads from sending for a while
+    def pause(self, delay):
+        if delay is None:
+            return
+
+        with self.condition:
+            self.paused_until = max(
+                self.paused_until,
+                time.monotonic() + delay
+            )
+
+    # Give up on a message
+    def drop(self, reason):
+        self.count('dropped')
+        print(termcolor.colored(
+            f"Dropped a Graph API request ({reason})",
+            "red"))
+        return None
+
+    # Update a counter
+    def count(self, name):
+        with self.condition:
+            self.stats[name] += 1
+
+    # Report counters
+    def status(self):
+        '''Returns a dictionary of counters, and the current limits'''
+        with self.condition:
+            stats = dict(self.stats)
+            stats['in_flight'] = self.in_flight
+            stats['limit'] = round(self.limit, 2)
+            stats['paused'] = max(
+                0, round(self.paused_until - time.monotonic(), 1)
+            )
+
+        return stats
+
+
+# Check if a response is worth retrying
+def should_retry(response, idempotent):
+    status = response.status_code
+    if idempotent:
+        return status in RETRY_STATUS
+
+    # Graph didn't act on a throttled request, so it's safe to send again
+    return status == 429 or (
+        status == 503 and retry_after(response) is not None
+    )
+
+
+# Read the Retry-After header (in seconds) from a response
+def retry_after(response):
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        return None
@@ -0,0 +1,398 @@
+"""
+A write-ahead spool for webhooks, so accepted webhooks survive a restart
+Each authenticated webhook is written to disk before it is acknowledged,
+    and marked as done once the plugin has handled it
+Anything not marked as done is replayed when the service starts
+
+Usage:
+    import 'spool' into the application
+    Create a Spool object, and call open() before serving any traffic
+        open() returns a list of records that were not completed
+    Call append() with the route, source IP, and webhook body
+        Pass the raw body too, so it's written as it was received,
+        rather than encoded again
+        This returns a record ID once the record is safely on disk
+    Call ack() with the record ID once the webhook has been handled
+    Call append_messages() with the route and a list of Teams messages,
+        to keep alerts that couldn't be sent (eg, Graph was unavailable)
+        These records have 'messages' rather than 'body'
+
+Authentication:
+    N/A
+
+Restrictions:
+    Records are JSON (UTF-8), one per line, in segment files
+        Segments are named 'segment-NNNNNNNN.log' in the spool directory
+    Segments are deleted once every record in them has been acknowledged
+        Records still outstanding in an older segment are copied into the
+        current segment, so they don't keep the segments after them
+    Disk writes are group-committed; Threads that append at the same time
+        share a single fsync
+    'done' markers don't wait for an fsync of their own; They're made
+        durable by the next group commit (the next append or rotation)
+        A crash before then replays the webhook, so alerts are sent at
+        least once, and may be sent twice after a crash
+
+To Do:
+    None
+"""
+
+
+import os
+import json
+import codecs
+import threading
+import termcolor
+from config import SPOOL
+from core import codec
+
+
+# Defaults, used if the 'spool' section of config.yaml is missing
+SPOOL_PATH = 'spool'
+SPOOL_SEGMENT_SIZE = 4 * 1024 * 1024
+SPOOL_MAX_REPLAYS = 3
+
+
+# Put a raw JSON body on one line, so it can be written as a record
+# Line breaks in valid JSON are only ever whitespace between values
+#   (inside strings they're escaped), so they can be replaced with spaces
+# A body with a byte order mark can't be embedded in the record,
+#   so None is returned and the caller serialises the parsed body instead
+def one_line(raw):
+    raw = bytes(raw)
+    if raw.startswith(codecs.BOM_UTF8):
+        return None
+
+    try:
+        return raw.replace(b'\r', b' ').replace(b'\n', b' ') \
+            .decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+
+class Spool():
+    # Initialise the spool; Nothing is read or written until open()
+    def __init__(self, path=None, segment_size=None, max_replays=None):
+        self.path = path or SPOOL.get('path', SPOOL_PATH)
+        self.segment_size = segment_size or \
+            SPOOL.get('segment_size', SPOOL_SEGMENT_SIZE)
+        self.max_replays = max_replays or \
+            SPOOL.get('max_replays', SPOOL_MAX_REPLAYS)
+
+        # 'lock' protects the file, IDs and segment tracking
+        # 'sync_lock' is held by the thread doing a group commit
+        # When both are needed, 'sync_lock' is always taken first
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+
+        self.file = None
+        self.segment = 0
+        self.next_id = 1
+
+        # Number of records written, and number known to be on disk
+        self.written = 0
+        self.synced = 0
+
+        # Outstanding (not acknowledged) records per segment,
+        #   and the segment each outstanding record is in
+        self.segments = {}
+        self.records = {}
+
+        self.stats = {
+            'appended': 0,
+            'acked': 0,
+            'syncs': 0,
+            'replayed': 0,
+            'discarded': 0,
+            'carried': 0,
+        }
+
+    # Get the file name for a segment number
+    def segment_file(self, number):
+        return os.path.join(self.path, f"segment-{number:08d}.log")
+
+    # Open the spool, and find any records that were not completed
+    def open(self):
+        '''
+        Reads existing segments, and returns records that were not acked
+        The records are compacted into a new segment,
+            and the old segments are deleted
+        '''
+        os.makedirs(self.path, exist_ok=True)
+
+        # Find existing segments, oldest first
+        numbers = sorted(
+            int(name[8:16]) for name in os.listdir(self.path)
+            if name.startswith('segment-') and name.endswith('.log')
+        )
+
+        # Read each record; A 'done' record cancels an earlier record
+        pending = {}
+        for number in numbers:
+            path = self.segment_file(number)
+            with open(path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        record = codec.json.loads(line)
+                    except ValueError:
+                        # A partly written line, from a crash mid-write
+                        continue
+
+                    if 'done' in record:
+                        pending.pop(record['done'], None)
+                    else:
+                        pending[record['id']] = record
+                        self.next_id = max(self.next_id, record['id'] + 1)
+
+        # Records that have failed too many times are not replayed again
+        replay = []
+        for record in pending.values():
+            record['replays'] = record.get('replays', 0) + 1
+            if record['replays'] > self.max_replays:
+                self.stats['discarded'] += 1
+                print(termcolor.colored(
+                    f"Spool: discarding record {record['id']} for "
+                    f"/{record['route']} after {self.max_replays} replays",
+                    "red"))
+                continue
+            replay.append(record)
+
+        # Start a new segment, and copy the outstanding records into it
+        self.segment = numbers[-1] + 1 if numbers else 1
+        self.file = open(
+            self.segment_file(self.segment), 'a', encoding='utf-8'
+        )
+        self.segments[self.segment] = 0
+
+        for record in replay:
+            self.file.write(codec.json.dumps(record) + '\n')
+            self.records[record['id']] = self.segment
+            self.segments[self.segment] += 1
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        # The old segments are no longer needed
+        for number in numbers:
+            os.remove(self.segment_file(number))
+
+        self.stats['replayed'] = len(replay)
+        if replay:
+            print(termcolor.colored(
+                f"Spool: replaying {len(replay)} webhooks",
+                "yellow"))
+
+        return replay
+
+    # Write a webhook to the spool
+    def append(self, route, src, body, raw=None):
+        '''
+        Takes the route, source IP, and webhook body
+        Optionally, takes the raw JSON body (bytes), as it was received
+        Returns the record ID once the record is on disk
+        '''
+        data = one_line(raw) if raw is not None else None
+        if data is None:
+            data = codec.json.dumps(body)
+
+        return self.write(
+            f'"route": {json.dumps(route)}, '
+            f'"src": {json.dumps(src)}, "body": {data}'
+        )
+
+    # Write Teams messages that still need to be sent
+    def append_messages(self, route, messages):
+        '''
+        Takes the route the messages came from, and a list of messages
+        Returns the record ID once the record is on disk
+        '''
+        return self.write(
+            f'"route": {json.dumps(route)}, '
+            f'"messages": {codec.json.dumps(messages)}'
+        )
+
+    # Write a record, with the next ID, and wait until it's on disk
+    def write(self, fields):
+        '''
+        Takes the record's fields, as JSON without the braces
+        Returns the record ID
+        '''
+        with self.lock:
+            id = self.next_id
+            self.next_id += 1
+
+            self.file.write(f'{{"id": {id}, {fields}}}\n')
+            self.records[id] = self.segment
+            self.segments[self.segment] += 1
+
+            self.written += 1
+            sequence = self.written
+            self.stats['appended'] += 1
+            full = self.file.tell() >= self.segment_size
+
+        # Wait until this record is on disk
+        self.sync(sequence)
+
+        if full:
+            self.rotate()
+
+        return id
+
+    # Group commit; One thread fsyncs on behalf of all waiting threads
+    def sync(self, sequence):
+        '''Makes sure records up to 'sequence' are on disk'''
+        if self.synced >= sequence:
+            return
+
+        with self.sync_lock:
+            # Another thread may have synced this record while we waited
+            if self.synced >= sequence:
+                return
+
+            # Flush everything written so far, then fsync without
+            #   holding the main lock, so other threads can keep writing
+            with self.lock:
+                target = self.written
+                self.file.flush()
+                file = self.file
+
+            os.fsync(file.fileno())
+            self.synced = target
+            self.stats['syncs'] += 1
+
+    # Mark a record as done
+    def ack(self, id):
+        '''
+        Marks a record as done, once the webhook has been handled
+        Segments are deleted once all their records are done
+        '''
+        with self.lock:
+            segment = self.records.pop(id, None)
+            if segment is None:
+                return
+
+            # Synced with the next group commit; If it's lost in a crash
+            #   before then, the webhook is replayed, which is safer than
+            #   losing it
+            self.file.write(f'{{"done": {id}}}\n')
+            self.file.flush()
+            self.written += 1
+            self.segments[segment] -= 1
+            self.stats['acked'] += 1
+
+        self.cleanup()
+
+    # Start a new segment once the current one is full
+    def rotate(self):
+        with self.sync_lock:
+            with self.lock:
+                if self.file.tell() < self.segment_size:
+                    return
+
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.synced = self.written
+
+                self.segment += 1
+                self.file = open(
+                    self.segment_file(self.segment), 'a', encoding='utf-8'
+                )
+                self.segments[self.segment] = 0
+
+        self.cleanup()
+
+    # Delete segments that have no outstanding records
+    def cleanup(self):
+        '''
+        Deletes the oldest segments, as long as all their records are done
+        Segments are only deleted oldest first, so a 'done' record is never
+            deleted before the record it refers to
+        If a few records are holding up an older segment, they're copied
+            into the current segment, and the old one is deleted
+        '''
+        with self.lock:
+            held = self.delete_segments()
+
+        if held:
+            with self.sync_lock:
+                with self.lock:
+                    self.carry_forward()
+                    self.delete_segments()
+
+    # Delete the oldest segments, while all their records are done
+    # Called with 'lock' held
+    def delete_segments(self):
+        '''
+        Returns True if an older segment is only kept for its outstanding
+            records; Records in the newest full segment may still be in
+            progress, so they're given until the next rotation
+        '''
+        while True:
+            oldest = min(self.segments)
+            if oldest == self.segment:
+                return False
+
+            if self.segments[oldest] > 0:
+                return oldest < self.segment - 1
+
+            del self.segments[oldest]
+            try:
+                os.remove(self.segment_file(oldest))
+            except OSError as e:
+                print(termcolor.colored(
+                    f"Spool: could not delete segment {oldest}",
+                    "red"))
+                print(e)
+
+    # Copy outstanding records from older segments into the current one
+    # Called with 'sync_lock' and 'lock' held
+    def carry_forward(self):
+        for number in sorted(self.segments):
+            if number >= self.segment - 1:
+                break
+
+            if self.segments[number] == 0:
+                continue
+
+            try:
+                with open(self.segment_file(number), 'r',
+                          encoding='utf-8') as file:
+                    for line in file:
+                        try:
+                            record = codec.json.loads(line)
+                        except ValueError:
+                            continue
+
+                        # Only records that are still outstanding
+                        id = record.get('id')
+                        if id is None or self.records.get(id) != number:
+                            continue
+
+                        self.file.write(line.rstrip('\n') + '\n')
+                        self.records[id] = self.segment
+                        self.segments[number] -= 1
+                        self.segments[self.segment] += 1
+                        self.stats['carried'] += 1
+
+            except OSError as e:
+                print(termcolor.colored(
+                    f"Spool: could not read segment {number}",
+                    "red"))
+                print(e)
+
+        # The copies must be on disk before the old segments are deleted
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.synced = self.written
+
+    # Report spool statistics
+    def status(self):
+        '''Returns a dictionary of spool statistics'''
+        with self.lock:
+            stats = dict(self.stats)
+            stats['outstanding'] = len(self.records)
+            stats['segments'] = len(self.segments)
+            stats['segment'] = self.segment
+
+        return stats
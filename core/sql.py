@@ -3,29 +3,622 @@ Creates entries in the database
 
 Usage:
     Call when an event comes in that needs handling
+    Values are passed as normal Python values (str, int, date, etc)
+        They are sent as parameters, so they don't need quoting or escaping
+    Plugins call sql.writer.write() with a table name and fields
+        Rows are buffered, and written in batches by a background thread
+        Returns a Future, which is True if the row was written
+    Sql().add() and Sql().add_many() write straight away
+    The web service calls sql.writer.start() to run the writer thread
+        Until this is started, rows are written as they arrive
 
 Authentication:
     Requires permissions to access the database
 
 Restrictions:
-    Requires the 'pyodbc' module (install with pip)
+    The database engine is set by 'backend' in the 'sql' section of
+        config.yaml (see storage.py); SQL Server needs the 'pyodbc' module
     Requires a database to be available, as well as tables and fields
         (see sql-create.py script)
+    Connections come from a shared pool (see the 'sql' section of config.yaml)
+    A batch is written when it has 'batch_size' rows,
+        or its first row has waited 'batch_age' seconds
+    Buffered rows are written when the service stops normally,
+        but are lost if it crashes
+    If the database is unreachable or too slow, rows are kept in a local
+        SQLite file (see overflow.py), and written once it's back
+    Only one 'database degraded' message is sent to Teams per
+        'notice_interval', so an outage doesn't flood the chat
 
 To Do:
     Add logging to text file if global DEBUG=True
-    Add a teardown function to Flask to gracefully close this connection
 
 Author:
     Luke Robertson - November 2022
 """
 
-import pyodbc
-from config import GLOBAL
+import time
+import queue
+import atexit
+import threading
+import functools
+import contextlib
+from concurrent.futures import Future
+from config import GLOBAL, SQL
 from core import teamschat
+from core import overflow
+from core import storage
+from core import migrations
+from core import maintenance
 import termcolor
 
 
+# Defaults, used if the 'sql' section of config.yaml is missing
+POOL_SIZE = 4
+BATCH_SIZE = 500
+BATCH_AGE = 2
+RETRY_INTERVAL = 30
+NOTICE_INTERVAL = 3600
+
+# When the last 'database degraded' message was sent
+last_notice = None
+notice_lock = threading.Lock()
+
+
+# Tell Teams about a database problem
+def notify(message):
+    '''
+    Sends a 'database degraded' message to Teams
+    Only one message is sent per 'notice_interval' seconds;
+        Later messages are printed to the terminal only
+    '''
+    global last_notice
+    now = time.monotonic()
+    interval = SQL.get('notice_interval', NOTICE_INTERVAL)
+    with notice_lock:
+        if last_notice is not None and now - last_notice < interval:
+            print(termcolor.colored(f"SQL: {message}", "red"))
+            return
+        last_notice = now
+
+    teamschat.send_chat(f"Database degraded: {message}")
+
+
+# Build a parameterized INSERT statement
+# Statements are cached, so each table and set of columns always uses
+#   the same text, and SQL Server can reuse the query plan
+@functools.lru_cache(maxsize=256)
+def insert_statement(table, columns):
+    '''
+    Takes a table name, and a tuple of column names
+    Returns an INSERT statement, with a '?' placeholder for each value
+    '''
+    sql_string = f'INSERT INTO {table} ('
+    sql_string += ', '.join(columns)
+    sql_string += ')'
+
+    sql_string += '\nVALUES ('
+    sql_string += ', '.join('?' for column in columns) + ');'
+    return sql_string
+
+
+# Get the oldest timestamp ('ts') in a list of rows
+# Returns None if there isn't one
+def oldest(columns, values):
+    if 'ts' not in columns:
+        return None
+
+    index = columns.index('ts')
+    times = [row[index] for row in values if row[index] is not None]
+    return min(times) if times else None
+
+
+class ConnectionPool():
+    # Initialise an empty pool, for a storage backend
+    def __init__(self, backend, size=POOL_SIZE):
+        self.backend = backend
+        self.size = size
+
+        # Idle connections; The most recently used is reused first
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+
+        self.stats = {
+            'opened': 0,
+            'reused': 0,
+            'discarded': 0,
+        }
+
+    # Borrow a connection from the pool
+    @contextlib.contextmanager
+    def connection(self):
+        '''
+        Use with 'with'; The connection is returned to the pool afterwards
+        No more than 'size' connections are open at once
+        If there's an error, the transaction is rolled back,
+            and the connection is closed if it's no longer usable
+        '''
+        with self.slots:
+            try:
+                conn = self.idle.get_nowait()
+                self.count('reused')
+            except queue.Empty:
+                conn = self.backend.connect()
+                self.count('opened')
+
+            try:
+                yield conn
+
+            except Exception:
+                try:
+                    conn.rollback()
+                    self.idle.put(conn)
+                except self.backend.Error:
+                    self.discard(conn)
+                raise
+
+            else:
+                self.idle.put(conn)
+
+    # Close a broken connection
+    def discard(self, conn):
+        self.count('discarded')
+        try:
+            conn.close()
+        except self.backend.Error:
+            pass
+
+    # Update a counter
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    # Report pool statistics
+    def status(self):
+        '''Returns a dictionary of pool statistics'''
+        with self.lock:
+            stats = dict(self.stats)
+
+        stats['idle'] = self.idle.qsize()
+        stats['size'] = self.size
+        return stats
+
+
+class BulkWriter():
+    # Initialise the writer, with a pool to get connections from
+    def __init__(self, pool, batch_size=BATCH_SIZE, batch_age=BATCH_AGE,
+                 overflow=None, retry_interval=RETRY_INTERVAL):
+        self.pool = pool
+        self.backend = pool.backend
+        self.batch_size = batch_size
+        self.batch_age = batch_age
+        self.retry_interval = retry_interval
+
+        # Where rows go while the database is unavailable (optional)
+        self.overflow = overflow
+
+        # Buffered rows, keyed by (table, columns)
+        # Full batches wait in 'ready' for the writer thread
+        self.batches = {}
+        self.ready = []
+        self.condition = threading.Condition()
+        self.thread = None
+
+        # When the database became unavailable (None if it's available),
+        #   and when to try it again
+        self.degraded = None
+        self.retry_at = 0
+
+        # Whether the schema is up to date (see migrations.py)
+        self.migrated = False
+
+        self.stats = {
+            'written': 0,
+            'failed': 0,
+            'spilled': 0,
+            'batches': 0,
+            'errors': 0,
+        }
+
+    # Start the thread that writes batches when they're due
+    def start(self):
+        if self.thread is not None:
+            return
+
+        # Without the overflow file, rows are lost if the database is down
+        if self.overflow and not self.overflow.open():
+            self.overflow = None
+
+        # Bring the schema up to date before writing anything
+        # If this fails, rows are kept until it can be done
+        self.migrated = migrations.upgrade(self.pool)
+
+        # Rows left from last time are written before any new rows
+        if not self.migrated or (self.overflow and self.overflow.pending()):
+            self.degraded = time.monotonic()
+
+        self.thread = threading.Thread(
+            target=self.run,
+            name='sql-writer',
+            daemon=True
+        )
+        self.thread.start()
+
+        # Write anything still buffered when the service stops
+        atexit.register(self.flush_all)
+
+    # Buffer a row to be written
+    def write(self, table, fields):
+        '''
+        Takes a table name, and a dictionary of column names and values
+        Returns a Future; Its result is True if the row was written
+            (or kept in the overflow file, to be written later),
+            or False if it wasn't
+        '''
+        future = Future()
+        key = (table, tuple(fields))
+        full = None
+
+        with self.condition:
+            batch = self.batches.get(key)
+            if batch is None:
+                batch = {'first': time.monotonic(), 'rows': []}
+                self.batches[key] = batch
+
+            batch['rows'].append((tuple(fields.values()), future))
+
+            # Without a writer thread, write straight away
+            if self.thread is None:
+                full = self.batches.pop(key)
+
+            # Hand full batches to the writer thread,
+            #   so the caller never waits for the database
+            elif len(batch['rows']) >= self.batch_size:
+                self.ready.append((key, self.batches.pop(key)))
+                self.condition.notify()
+
+            else:
+                self.condition.notify()
+
+        if full:
+            self.flush(key, full)
+
+        return future
+
+    # Buffer several rows to be written
+    def write_many(self, table, rows):
+        '''Returns a list of Futures, one for each row'''
+        return [self.write(table, fields) for fields in rows]
+
+    # Thread; Write batches as they become due
+    def run(self):
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                due = self.ready
+                self.ready = []
+
+                # With nothing buffered, wait until something is written
+                wait = None
+
+                for key, batch in list(self.batches.items()):
+                    write_at = batch['first'] + self.batch_age
+                    if write_at <= now:
+                        due.append((key, self.batches.pop(key)))
+                    elif wait is None or write_at - now < wait:
+                        wait = write_at - now
+
+                # Wake up in time to check on the database again
+                retry = self.degraded is not None
+                if retry:
+                    if self.retry_at <= now:
+                        wait = 0
+                    elif wait is None or self.retry_at - now < wait:
+                        wait = self.retry_at - now
+
+                if not due and wait != 0:
+                    self.condition.wait(wait)
+                    continue
+
+            # Write outside the lock, so plugins can keep buffering rows
+            # An unexpected error must not stop the thread
+            for key, batch in due:
+                try:
+                    self.flush(key, batch)
+                except Exception as e:
+                    self.failed(key, batch, e)
+
+            if retry and self.retry_at <= time.monotonic():
+                try:
+                    self.drain()
+                except Exception as e:
+                    self.retry_at = time.monotonic() + self.retry_interval
+                    with self.condition:
+                        self.stats['errors'] += 1
+                    print(termcolor.colored(
+                        "SQL: Error writing rows from the overflow file",
+                        "red"))
+                    print(e)
+
+    # A batch couldn't be handled, because of an unexpected error
+    def failed(self, key, batch, error):
+        '''
+        Resolves the batch's Futures that aren't done yet as False,
+            so callers waiting on them aren't left waiting
+        '''
+        table, columns = key
+        with self.condition:
+            self.stats['errors'] += 1
+
+        print(termcolor.colored(
+            f"SQL: Error writing a batch to {table}",
+            "red"))
+        print(error)
+
+        for row, future in batch['rows']:
+            if not future.done():
+                future.set_result(False)
+
+    # Write everything that's buffered
+    def flush_all(self):
+        with self.condition:
+            due = self.ready + list(self.batches.items())
+            self.ready = []
+            self.batches.clear()
+
+        for key, batch in due:
+            try:
+                self.flush(key, batch)
+            except Exception as e:
+                self.failed(key, batch, e)
+
+    # Write a batch of rows to a table
+    def flush(self, key, batch):
+        table, columns = key
+        rows = batch['rows']
+        values = [row for row, future in rows]
+
+        # While the database is unavailable, go straight to the overflow
+        if self.degraded is not None and self.overflow is not None:
+            results = self.spill(key, values)
+
+        else:
+            results = self.write_batch(key, values)
+
+        for (row, future), result in zip(rows, results):
+            future.set_result(result)
+
+    # Write rows to the database, returning a result for each
+    def write_batch(self, key, values):
+        table, columns = key
+        sql_string = insert_statement(table, columns)
+
+        if GLOBAL['flask_debug']:
+            print(termcolor.colored(
+                f"DEBUG (sql.py): {sql_string} ({len(values)} rows)",
+                "magenta"))
+
+        # Write the whole batch in one round trip
+        try:
+            with self.pool.connection() as conn:
+                self.backend.executemany(conn.cursor(), sql_string, values)
+                conn.commit()
+            results = [True] * len(values)
+
+        except self.backend.Error as e:
+            # The database is unreachable or too slow; Keep the rows
+            if self.backend.is_unavailable(e):
+                self.unavailable(e)
+                return self.spill(key, values)
+
+            # Otherwise, write the rows one at a time,
+            #   to find out which ones are the problem
+            print(termcolor.colored(
+                f"SQL batch error writing to {table}, retrying each row",
+                "red"))
+            print(e)
+            results = self.write_each(sql_string, values)
+
+            # The connection was lost part way through
+            if len(results) < len(values):
+                results += self.spill(key, values[len(results):])
+
+        failed = results.count(False)
+        with self.condition:
+            self.stats['batches'] += 1
+            self.stats['written'] += len(results) - failed
+            self.stats['failed'] += failed
+
+        if failed:
+            notify(f"{failed} rows could not be written to {table}")
+
+        return results
+
+    # Write rows one at a time, returning a result for each
+    # Stops early if the database becomes unavailable
+    def write_each(self, sql_string, values):
+        results = []
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                for row in values:
+                    try:
+                        cursor.execute(sql_string, row)
+                        conn.commit()
+                        results.append(True)
+                    except self.backend.Error as e:
+                        if self.backend.is_unavailable(e):
+                            raise
+                        conn.rollback()
+                        print(termcolor.colored(
+                            f"SQL row error: {row}",
+                            "red"))
+                        print(e)
+                        results.append(False)
+
+        except self.backend.Error as e:
+            if not self.backend.is_unavailable(e):
+                raise
+            self.unavailable(e)
+
+        return results
+
+    # Keep rows in the overflow file, to write later
+    def spill(self, key, values):
+        table, columns = key
+        if self.overflow is None or \
+                not self.overflow.add(table, columns, values):
+            with self.condition:
+                self.stats['failed'] += len(values)
+            return [False] * len(values)
+
+        with self.condition:
+            self.stats['spilled'] += len(values)
+        return [True] * len(values)
+
+    # Write rows from the overflow file back to the database
+    def drain(self):
+        '''
+        Writes the oldest rows in the overflow file, in batches
+        Returns True once the database is available and the file is empty
+        '''
+        self.retry_at = time.monotonic() + self.retry_interval
+        if not self.migrated:
+            self.migrated = migrations.upgrade(self.pool)
+            if not self.migrated:
+                return False
+
+        if self.overflow is None:
+            self.available()
+            return True
+
+        while True:
+            records = self.overflow.read(self.batch_size)
+            if not records:
+                self.available()
+                return True
+
+            # Group consecutive rows for the same table and columns
+            groups = {}
+            for id, table, columns, values in records:
+                group = groups.setdefault((table, columns), ([], []))
+                group[0].append(id)
+                group[1].append(values)
+
+            for (table, columns), (ids, values) in groups.items():
+                sql_string = insert_statement(table, columns)
+                try:
+                    with self.pool.connection() as conn:
+                        cursor = conn.cursor()
+                        self.backend.executemany(cursor, sql_string, values)
+
+                        # These rows are late, so their hours need to be
+                        #   rolled up again
+                        maintenance.job.rewind(
+                            cursor, table, oldest(columns, values))
+                        conn.commit()
+
+                except self.backend.Error as e:
+                    # Still unavailable; Try again later
+                    if self.backend.is_unavailable(e):
+                        self.unavailable(e)
+                        return False
+
+                    # A bad row; Find it, so it doesn't block the others
+                    # Rows that fail are removed, as they'll never be written
+                    results = self.write_each(sql_string, values)
+                    failed = results.count(False)
+                    self.rewind(table, columns, [
+                        row for row, result in zip(values, results) if result
+                    ])
+
+                    # The connection was lost part way through
+                    # The rows handled so far are already committed (or
+                    #   failed), so remove them, or they'd be written again
+                    if len(results) < len(values):
+                        done = len(results)
+                        self.overflow.remove(ids[:done])
+                        with self.condition:
+                            self.stats['written'] += done - failed
+                            self.stats['failed'] += failed
+                        return False
+
+                else:
+                    failed = 0
+
+                self.overflow.remove(ids)
+                with self.condition:
+                    self.stats['written'] += len(ids) - failed
+                    self.stats['failed'] += failed
+
+    # Have the roll-ups count rows that were written late
+    def rewind(self, table, columns, values):
+        oldest_ts = oldest(columns, values)
+        if oldest_ts is None:
+            return
+
+        try:
+            with self.pool.connection() as conn:
+                maintenance.job.rewind(conn.cursor(), table, oldest_ts)
+                conn.commit()
+
+        except self.backend.Error as e:
+            print(termcolor.colored(
+                f"SQL: Could not update the roll-up watermark for {table}",
+                "red"))
+            print(e)
+
+    # The database can't be reached
+    def unavailable(self, error):
+        self.retry_at = time.monotonic() + self.retry_interval
+        if self.degraded is not None:
+            return
+
+        self.degraded = time.monotonic()
+        if self.overflow is not None:
+            print(termcolor.colored(
+                "The database is unavailable; Keeping rows for later",
+                "red"))
+        else:
+            print(termcolor.colored(
+                "The database is unavailable; Rows will be lost",
+                "red"))
+        print(error)
+        notify("The database is unavailable")
+
+    # The database can be reached again
+    def available(self):
+        if self.degraded is None:
+            return
+
+        print(termcolor.colored(
+            f"The database is available again, after "
+            f"{round(time.monotonic() - self.degraded)} seconds",
+            "green"))
+        self.degraded = None
+
+    # Report writer statistics
+    def status(self):
+        '''Returns a dictionary of writer, pool, and overflow statistics'''
+        with self.condition:
+            stats = dict(self.stats)
+            stats['buffered'] = sum(
+                len(batch['rows']) for key, batch in self.ready
+            ) + sum(
+                len(batch['rows']) for batch in self.batches.values()
+            )
+
+        stats.update(self.backend.status())
+        stats['running'] = self.thread is not None
+        stats['degraded'] = self.degraded is not None
+        stats['schema'] = migrations.status()
+        stats['pool'] = self.pool.status()
+        if self.overflow is not None and self.overflow.conn is not None:
+            stats['overflow'] = self.overflow.status()
+        return stats
+
+
 class Sql():
     # Initialise the class
     def __init__(self):
@@ -34,87 +627,100 @@ class Sql():
 
     # Add an entry to the SQL server
     def add(self, table, fields):
-        # Create empty strings for columns and corresponding values
-        columns = ''
-        values = '('
+        '''
+        Takes a table name, and a dictionary of column names and values
+        '''
+        sql_string = insert_statement(table, tuple(fields))
+        return self.execute(sql_string, [tuple(fields.values())])
 
-        # Populate the columns and values
-        for field in fields:
-            columns += field + ', '
-            values += str(fields[field]) + ', '
+    # Add several entries to the same table
+    # This is much faster than calling add() for each entry
+    def add_many(self, table, rows):
+        '''
+        Takes a table name, and a list of field dictionaries
+        All rows must have the same fields
+        Writes all rows using one connection and one commit
+        '''
+        columns = tuple(rows[0])
+        sql_string = insert_statement(table, columns)
+        values = [
+            tuple(row[column] for column in columns)
+            for row in rows
+        ]
 
-        # Clean up the trailing comma, to make this valid
-        columns = columns.strip(", ")
-        values = values.strip(", ")
-
-        # Build the correct string
-        sql_string = f'INSERT INTO {table} ('
-        sql_string += columns
-        sql_string += ')'
-
-        sql_string += '\nVALUES '
-        sql_string += values + ');'
+        return self.execute(sql_string, values)
 
+    # Run a statement for each set of values, and commit them together
+    def execute(self, sql_string, values):
         if GLOBAL['flask_debug']:
             print(termcolor.colored(
-                f"DEBUG (sql.py): {sql_string}",
+                f"DEBUG (sql.py): {sql_string} ({len(values)} rows)",
                 "magenta"))
 
-        # Connect to db using 'with' (gracefully closes when done)
-        with pyodbc.connect(
-                'Driver={SQL Server};'
-                'Server=%s;'
-                'Database=%s;'
-                'Trusted_Connection=yes;'
-                % (self.server, self.db)) as self.conn:
-            self.cursor = self.conn.cursor()
+        # Borrow a connection from the pool (returned when done)
+        try:
+            with pool.connection() as self.conn:
+                self.cursor = self.conn.cursor()
 
-            try:
-                self.cursor.execute(sql_string)
-            except Exception as e:
-                print("SQL execution error")
-                print(e)
-                teamschat.send_chat(
-                    "An error has occurred while writing to SQL"
-                )
-                return False
+                try:
+                    if len(values) == 1:
+                        self.cursor.execute(sql_string, values[0])
+                    else:
+                        backend.executemany(self.cursor, sql_string, values)
+                except Exception as e:
+                    print("SQL execution error")
+                    print(e)
+                    self.conn.rollback()
+                    notify("An error has occurred while writing to SQL")
+                    return False
+
+                try:
+                    self.conn.commit()
+                except Exception as e:
+                    print(termcolor.colored("SQL commit error", "red"))
+                    print(e)
+                    self.conn.rollback()
+                    notify("An error has occurred while writing to SQL")
+                    return False
+
+        except backend.Error as e:
+            print(termcolor.colored("SQL connection error", "red"))
+            print(e)
+            notify("The database is unavailable")
+            return False
 
-            try:
-                self.conn.commit()
-            except Exception as e:
-                print(termcolor.colored("SQL commit error", "red"))
-                print(e)
-                teamschat.send_chat(
-                    "An error has occurred while writing to SQL"
-                )
-                return False
         return True
 
     # Read the last entry from the SQL server
     def read_last(self, table):
-        # Connect to db using 'with' (gracefully closes when done)
-        with pyodbc.connect(
-                'Driver={SQL Server};'
-                'Server=%s;'
-                'Database=%s;'
-                'Trusted_Connection=yes;'
-                % (self.server, self.db)) as self.conn:
+        # Borrow a connection from the pool (returned when done)
+        with pool.connection() as self.conn:
             self.cursor = self.conn.cursor()
 
             try:
-                self.cursor.execute(
-                    f"SELECT TOP 1 * \
-                    FROM [NetworkAssistant_Alerts].[dbo].[{table}] \
-                    ORDER BY id DESC"
-                )
+                self.cursor.execute(backend.read_last_statement(table))
                 for row in self.cursor:
                     entry = row
             except Exception as e:
                 print("SQL execution error")
                 print(e)
-                teamschat.send_chat(
+                notify(
                     "An error has occurred while reading from the SQL database"
                 )
                 return False
 
             return entry
+
+
+# The shared backend, connection pool, and writer, used by all plugins
+# Set 'overflow_path' to an empty string to disable the overflow file
+backend = storage.get_backend(SQL)
+pool = ConnectionPool(backend, SQL.get('pool_size', POOL_SIZE))
+overflow_path = SQL.get('overflow_path', overflow.OVERFLOW_PATH)
+writer = BulkWriter(
+    pool,
+    batch_size=SQL.get('batch_size', BATCH_SIZE),
+    batch_age=SQL.get('batch_age', BATCH_AGE),
+    overflow=overflow.Overflow(overflow_path) if overflow_path else None,
+    retry_interval=SQL.get('retry_interval', RETRY_INTERVAL)
+)
@@ -0,0 +1,358 @@
+"""
+Storage backends for the database
+Each backend knows how to connect, and how its SQL differs from the others
+
+Usage:
+    import 'storage' into the application (sql.py does this)
+    Call get_backend() with the 'sql' section of config.yaml
+        'backend' selects the engine: 'sqlserver' (default) or 'sqlite'
+    The backend object provides:
+        connect() - Open a new connection (DB-API 2.0)
+        executemany() - Run a statement for many rows, as fast as possible
+        create_statement() - SQL to create a table from the schema
+        create_index_statement() - SQL to create an index from the schema
+        table_columns() - The columns a table has in the database
+        read_last_statement() - SQL to read the newest row in a table
+        recent_statement() - SQL to read the newest rows in a table
+        hour_expression() - SQL to round a timestamp down to the hour
+        purge_statement() - SQL to delete a batch of old rows
+        match_expression() - SQL to match a text column, ignoring case
+        Error - The base exception class for this engine
+        is_unavailable() - Whether an error means the database is
+            unavailable (rather than a problem with the SQL or a row)
+
+Authentication:
+    SQL Server uses Windows authentication (Trusted_Connection)
+    SQLite needs permission to write to the database file
+
+Restrictions:
+    SQL Server requires the 'pyodbc' module (install with pip)
+        This is only imported if the SQL Server backend is used
+    SQLite uses the sqlite3 module from the standard library
+        It's tuned for high insert rates (WAL, and batched transactions),
+        so a single collector can absorb an alert storm locally
+    Both engines use '?' placeholders, so statements are shared
+
+To Do:
+    None
+"""
+
+
+import abc
+import sqlite3
+import termcolor
+from datetime import date, time, datetime
+from config import GLOBAL
+from core import schema
+
+
+# Defaults, used if the 'sql' section of config.yaml is missing
+SQL_BACKEND = 'sqlserver'
+SQL_DRIVER = 'SQL Server'
+SQLITE_PATH = 'events.db'
+TIMEOUT = 10
+
+# SQLite errors that mean the database is unavailable
+#   The codes are used if Python has them (3.11+), otherwise the message
+SQLITE_UNAVAILABLE_CODES = (
+    'SQLITE_BUSY', 'SQLITE_LOCKED', 'SQLITE_IOERR', 'SQLITE_CANTOPEN'
+)
+SQLITE_UNAVAILABLE_TEXT = (
+    'locked', 'busy', 'disk i/o', 'unable to open'
+)
+
+
+# The base for each engine; The abstract methods must be implemented
+class Backend(abc.ABC):
+    # The name used in config.yaml
+    name = ''
+
+    # Generic column types (see schema.py), mapped to this engine's types
+    TYPES = {}
+
+    # Initialise the backend with the 'sql' section of config.yaml
+    def __init__(self, config):
+        self.config = config
+        self.timeout = config.get('timeout', TIMEOUT)
+
+    # Open a new connection
+    @abc.abstractmethod
+    def connect(self):
+        raise NotImplementedError
+
+    # Run a statement for each set of values
+    def executemany(self, cursor, sql_string, values):
+        cursor.executemany(sql_string, values)
+
+    # Build the columns for a CREATE TABLE statement
+    def column_list(self, table):
+        return ', '.join(
+            f"{column} {self.TYPES[type]}{'' if nullable else ' not null'}"
+            for column, type, nullable in schema.columns(table)
+        )
+
+    # SQL to create a table, if it doesn't exist yet
+    # The columns come from the schema, unless they're given as SQL
+    @abc.abstractmethod
+    def create_statement(self, table, columns=None):
+        raise NotImplementedError
+
+    # SQL to create an index, if it doesn't exist yet
+    @abc.abstractmethod
+    def create_index_statement(self, table, name, columns):
+        raise NotImplementedError
+
+    # Get the names of a table's columns (empty if there's no table)
+    @abc.abstractmethod
+    def table_columns(self, cursor, table):
+        raise NotImplementedError
+
+    # SQL to read the newest row in a table
+    @abc.abstractmethod
+    def read_last_statement(self, table):
+        raise NotImplementedError
+
+    # SQL to read the newest rows in a table, newest first
+    @abc.abstractmethod
+    def recent_statement(self, table, columns, limit):
+        raise NotImplementedError
+
+    # SQL for the start of the hour that a timestamp column is in
+    @abc.abstractmethod
+    def hour_expression(self, column):
+        raise NotImplementedError
+
+    # SQL to delete up to 'limit' rows older than a timestamp ('?')
+    @abc.abstractmethod
+    def purge_statement(self, table, limit):
+        raise NotImplementedError
+
+    # SQL to match a text column to a value ('?'), ignoring case
+    @abc.abstractmethod
+    def match_expression(self, column):
+        raise NotImplementedError
+
+    # Check if an error means the database is unavailable
+    # Other errors are a problem with the statement or the row
+    def is_unavailable(self, error):
+        return isinstance(error, self.connection_errors)
+
+    # Report backend details
+    def status(self):
+        return {'backend': self.name}
+
+
+class SqlServer(Backend):
+    name = 'sqlserver'
+
+    TYPES = {
+        'id': 'int IDENTITY(1,1) PRIMARY KEY',
+        'timestamp': 'datetime2',
+        'name': 'nvarchar(255)',
+        'text': 'nvarchar(max)',
+        'ip': 'binary(4)',
+        'count': 'int',
+    }
+
+    def __init__(self, config):
+        super().__init__(config)
+
+        # Only needed for this backend, so it's imported here
+        import pyodbc
+        self.pyodbc = pyodbc
+
+        self.Error = pyodbc.Error
+        self.connection_errors = (
+            pyodbc.OperationalError,
+            pyodbc.InterfaceError
+        )
+        self.fast_executemany = config.get('fast_executemany', True)
+
+    # Open a new connection to SQL Server
+    # The timeout applies to logging in, and to each query
+    def connect(self):
+        conn = self.pyodbc.connect(
+            'Driver={%s};'
+            'Server=%s;'
+            'Database=%s;'
+            'Trusted_Connection=yes;'
+            % (
+                self.config.get('driver', SQL_DRIVER),
+                GLOBAL['db_server'],
+                GLOBAL['db_name']
+            ),
+            timeout=self.timeout
+        )
+        conn.timeout = self.timeout
+        return conn
+
+    # Send all rows in one round trip, if the driver supports it
+    def executemany(self, cursor, sql_string, values):
+        cursor.fast_executemany = self.fast_executemany
+        cursor.executemany(sql_string, values)
+
+    def create_statement(self, table, columns=None):
+        return (
+            f"IF OBJECT_ID(N'{table}', N'U') IS NULL "
+            f"CREATE TABLE {table} ({columns or self.column_list(table)})"
+        )
+
+    def create_index_statement(self, table, name, columns):
+        return (
+            f"IF NOT EXISTS (SELECT 1 FROM sys.indexes "
+            f"WHERE name = N'{name}' AND object_id = OBJECT_ID(N'{table}')) "
+            f"CREATE INDEX {name} ON {table} ({', '.join(columns)})"
+        )
+
+    def table_columns(self, cursor, table):
+        cursor.execute(
+            "SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS "
+            "WHERE TABLE_NAME = ?",
+            (table,)
+        )
+        return {row[0] for row in cursor.fetchall()}
+
+    # The connection already uses the database from config.yaml
+    def read_last_statement(self, table):
+        return f"SELECT TOP 1 * FROM {table} ORDER BY id DESC"
+
+    def recent_statement(self, table, columns, limit):
+        return f"SELECT TOP {int(limit)} {', '.join(columns)} " \
+            f"FROM {table} ORDER BY ts DESC"
+
+    def hour_expression(self, column):
+        return f"CAST(DATEADD(hour, DATEDIFF(hour, 0, {column}), 0) " \
+            f"AS datetime2)"
+
+    # Small batches stop SQL Server escalating to a table lock
+    def purge_statement(self, table, limit):
+        return f"DELETE TOP ({int(limit)}) FROM {table} WHERE ts < ?"
+
+    # The default SQL Server collation ignores case,
+    #   and a plain comparison can still use the indexes
+    def match_expression(self, column):
+        return f"{column} = ?"
+
+    def status(self):
+        return {
+            'backend': self.name,
+            'server': GLOBAL['db_server'],
+            'database': GLOBAL['db_name'],
+        }
+
+
+class Sqlite(Backend):
+    name = 'sqlite'
+
+    TYPES = {
+        'id': 'INTEGER PRIMARY KEY AUTOINCREMENT',
+        'timestamp': 'TEXT',
+        'name': 'TEXT',
+        'text': 'TEXT',
+        'ip': 'INTEGER',
+        'count': 'INTEGER',
+    }
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.path = config.get('sqlite_path', SQLITE_PATH)
+
+        self.Error = sqlite3.Error
+
+        # OperationalError also covers missing tables and syntax errors,
+        #   so the error itself is checked (see is_unavailable())
+        self.connection_errors = (sqlite3.OperationalError,)
+
+        # Dates and times are stored as ISO 8601 text, so they sort in order
+        sqlite3.register_adapter(date, date.isoformat)
+        sqlite3.register_adapter(time, time.isoformat)
+        sqlite3.register_adapter(datetime, datetime.isoformat)
+
+    # Open a new connection to the SQLite file
+    def connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            check_same_thread=False
+        )
+
+        # WAL lets readers and the writer work at the same time,
+        #   and 'NORMAL' only syncs at checkpoints, not every commit
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-16000')
+        return conn
+
+    def create_statement(self, table, columns=None):
+        return f"CREATE TABLE IF NOT EXISTS {table} " \
+            f"({columns or self.column_list(table)})"
+
+    def create_index_statement(self, table, name, columns):
+        return f"CREATE INDEX IF NOT EXISTS {name} " \
+            f"ON {table} ({', '.join(columns)})"
+
+    def table_columns(self, cursor, table):
+        cursor.execute(f"PRAGMA table_info({table})")
+        return {row[1] for row in cursor.fetchall()}
+
+    def read_last_statement(self, table):
+        return f"SELECT * FROM {table} ORDER BY id DESC LIMIT 1"
+
+    def recent_statement(self, table, columns, limit):
+        return f"SELECT {', '.join(columns)} FROM {table} " \
+            f"ORDER BY ts DESC LIMIT {int(limit)}"
+
+    # Timestamps are ISO 8601 text, so this matches datetime.isoformat()
+    def hour_expression(self, column):
+        return f"strftime('%Y-%m-%dT%H:00:00', {column})"
+
+    def purge_statement(self, table, limit):
+        return f"DELETE FROM {table} WHERE id IN " \
+            f"(SELECT id FROM {table} WHERE ts < ? LIMIT {int(limit)})"
+
+    # SQLite compares text with case by default
+    def match_expression(self, column):
+        return f"{column} = ? COLLATE NOCASE"
+
+    # Only a locked or busy database, disk I/O errors, and files that
+    #   can't be opened mean the database is unavailable
+    def is_unavailable(self, error):
+        if not isinstance(error, self.connection_errors):
+            return False
+
+        name = getattr(error, 'sqlite_errorname', None)
+        if name is not None:
+            return name.startswith(SQLITE_UNAVAILABLE_CODES)
+
+        message = str(error).lower()
+        return any(text in message for text in SQLITE_UNAVAILABLE_TEXT)
+
+    def status(self):
+        return {
+            'backend': self.name,
+            'path': self.path,
+        }
+
+
+# Backends that can be selected in config.yaml
+BACKENDS = {
+    SqlServer.name: SqlServer,
+    Sqlite.name: Sqlite,
+}
+
+
+# Get the backend selected in config.yaml
+def get_backend(config):
+    '''
+    Takes the 'sql' section of config.yaml
+    Returns a backend object
+    '''
+    name = config.get('backend', SQL_BACKEND)
+    if name not in BACKENDS:
+        print(termcolor.colored(
+            f"Unknown SQL backend '{name}', using '{SQL_BACKEND}'",
+            "red"))
+        name = SQL_BACKEND
+
+    return BACKENDS[name](config)
@@ -0,0 +1,146 @@
+"""
+Keeps the MSAL token cache on disk, encrypted,
+    so the service can get a token after a restart without a login
+
+Usage:
+    import 'tokencache' into the application
+    Create a TokenCache, call load(), and pass it to the MSAL application
+        (azureauth does this)
+    Call save() after getting a token; It only writes if the cache changed
+
+Authentication:
+    The cache is encrypted with AES-GCM
+    The key is derived (PBKDF2) from 'cache_key' in the 'teams' section of
+        config.yaml, or the application secret if that's blank
+
+Restrictions:
+    pip install pycryptodome
+    The cache holds refresh tokens, so it's never written in clear text
+        (tokenstore only keeps the access token, in memory)
+    If the file can't be decrypted (eg, the key or secret changed),
+        it's ignored, and the service falls back to an interactive login
+    The file is written to a temporary file first, then replaced,
+        so it's never left half written
+
+To Do:
+    None
+"""
+
+
+import os
+import hashlib
+import threading
+import termcolor
+from msal import SerializableTokenCache
+from Crypto.Cipher import AES
+
+
+# Default location, used if 'token_cache' isn't in config.yaml
+CACHE_FILE = 'token-cache.bin'
+
+# File layout: MAGIC, salt, nonce, tag, then the encrypted cache
+MAGIC = b'CBTC1'
+SALT_SIZE = 16
+NONCE_SIZE = 12
+TAG_SIZE = 16
+KDF_ROUNDS = 200000
+
+
+class TokenCache(SerializableTokenCache):
+    # Initialise the cache, with its file and secret
+    def __init__(self, path, secret):
+        '''
+        Takes the file to keep the cache in,
+            and the secret the encryption key is derived from
+        '''
+        super().__init__()
+        self.path = path
+        self.secret = str(secret).encode()
+        self.salt = None
+        self.key = None
+        self.file_lock = threading.Lock()
+
+    # Derive the key for a salt (once per salt)
+    def derive(self, salt):
+        if salt != self.salt:
+            self.key = hashlib.pbkdf2_hmac(
+                'sha256', self.secret, salt, KDF_ROUNDS
+            )
+            self.salt = salt
+        return self.key
+
+    # Read and decrypt the cache file
+    def load(self):
+        '''
+        Returns True if a cache was loaded
+        '''
+        try:
+            with open(self.path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            print(termcolor.colored(
+                f"Could not read the token cache from {self.path}",
+                "red"))
+            print(e)
+            return False
+
+        try:
+            if not data.startswith(MAGIC):
+                raise ValueError("Not a token cache file")
+            position = len(MAGIC)
+            salt = data[position:position + SALT_SIZE]
+            position += SALT_SIZE
+            nonce = data[position:position + NONCE_SIZE]
+            position += NONCE_SIZE
+            tag = data[position:position + TAG_SIZE]
+            position += TAG_SIZE
+
+            cipher = AES.new(self.derive(salt), AES.MODE_GCM, nonce=nonce)
+            state = cipher.decrypt_and_verify(data[position:], tag)
+            self.deserialize(state.decode())
+
+        # The tag doesn't match (wrong key, or the file was changed),
+        #   or the contents aren't a cache
+        except ValueError as e:
+            print(termcolor.colored(
+                f"Could not decrypt the token cache in {self.path}; "
+                "A new login will be needed",
+                "red"))
+            print(e)
+            return False
+
+        return True
+
+    # Encrypt and write the cache file, if the cache has changed
+    def save(self):
+        '''
+        Returns True if the file is up to date
+        '''
+        with self.file_lock:
+            if not self.has_state_changed:
+                return True
+
+            salt = self.salt or os.urandom(SALT_SIZE)
+            nonce = os.urandom(NONCE_SIZE)
+            cipher = AES.new(self.derive(salt), AES.MODE_GCM, nonce=nonce)
+            encrypted, tag = cipher.encrypt_and_digest(
+                self.serialize().encode()
+            )
+
+            temp_file = self.path + '.tmp'
+            try:
+                with open(temp_file, 'wb') as file:
+                    file.write(MAGIC + salt + nonce + tag + encrypted)
+                os.replace(temp_file, self.path)
+
+            except OSError as e:
+                print(termcolor.colored(
+                    f"Could not save the token cache to {self.path}",
+                    "red"))
+                print(e)
+                return False
+
+            self.has_state_changed = False
+            return True
@@ -0,0 +1,103 @@
+"""
+Holds the Graph API bearer token in memory, for all threads to share
+
+Usage:
+    import 'tokenstore' into the application
+    Call set_token() with a new token from MSAL (azureauth does this)
+    Call get_token() to get the current token
+        Returns None if there's no token yet
+    Call valid() to check there's a token that hasn't expired
+    Call remove_token_file() at startup, to delete token.txt
+        (written by older versions)
+
+Authentication:
+    N/A
+
+Restrictions:
+    The token is replaced as a whole, never changed in place
+        Readers always see a complete token, without taking a lock
+    Only the access token and its expiry are kept
+        The refresh token and ID token stay in the MSAL token cache
+    Nothing is written to disk here; After a restart, the token comes
+        from the encrypted token cache (see tokencache.py)
+
+To Do:
+    None
+"""
+
+
+import os
+import time
+import termcolor
+
+
+# Written by older versions, with the whole MSAL result in clear text
+TOKEN_FILE = 'token.txt'
+
+# The parts of the MSAL result that are kept
+TOKEN_FIELDS = ('access_token', 'token_type', 'expires_in')
+
+
+# The current token (a dictionary)
+token = None
+
+
+# Get the current token
+def get_token():
+    '''
+    Returns the current token, or None if there isn't one yet
+    '''
+    return token
+
+
+# Store a new token
+def set_token(access_token):
+    '''
+    Takes a token from MSAL, and makes it the current token
+    '''
+    global token
+    new_token = {
+        field: access_token[field]
+        for field in TOKEN_FIELDS
+        if field in access_token
+    }
+
+    # 'expires_in' is relative to when the token was issued
+    if 'expires_in' in new_token:
+        new_token['expires_at'] = int(time.time()) + int(
+            new_token['expires_in'])
+
+    token = new_token
+
+
+# Check there's a token that can be used
+def valid(margin=0):
+    '''
+    Takes a number of seconds the token must still be valid for
+    Returns True if there's a token that hasn't expired
+    '''
+    current = get_token()
+    if not current or 'expires_at' not in current:
+        return False
+
+    return current['expires_at'] - margin > time.time()
+
+
+# Delete token.txt, which older versions wrote in clear text
+def remove_token_file():
+    '''Returns True if the file was deleted'''
+    try:
+        os.remove(TOKEN_FILE)
+    except FileNotFoundError:
+        return False
+    except OSError as e:
+        print(termcolor.colored(
+            f"Could not delete {TOKEN_FILE}; Please delete it",
+            "red"))
+        print(e)
+        return False
+
+    print(termcolor.colored(
+        f"Deleted {TOKEN_FILE}; Tokens are kept in the token cache now",
+        "yellow"))
+    return True
@@ -0,0 +1,141 @@
+"""
+Watches files, and calls a function when one changes
+Used to load plugin config files again, without waiting for a restart
+
+Usage:
+    import 'watcher' into the application
+    Call watcher.files.watch() with a file and a function
+        The function is called (with no arguments) when the file changes
+        Watching the same file again replaces the function
+    Call unwatch() to stop watching a file
+        Pass the function too, so it's only removed if it's still the
+        one being called (a newer one may have replaced it)
+    The web service calls watcher.files.start() at startup,
+        which checks the files as a scheduled job (see scheduler.py)
+    Call status() to get the watched files, and the number of changes
+
+Authentication:
+    N/A
+
+Restrictions:
+    Files are polled, by checking their modification time and size
+        every 'config_check_interval' seconds (in the 'global' section)
+    inotify isn't used, as it's Linux only, and isn't in the standard library
+    A file that's missing or can't be read is ignored until it's back
+    Callbacks run in the scheduler thread, one at a time
+
+To Do:
+    None
+"""
+
+
+import os
+import threading
+import termcolor
+from config import GLOBAL
+from core import scheduler
+
+
+# Default, used if 'config_check_interval' isn't in config.yaml
+CHECK_INTERVAL = 5
+
+
+class FileWatcher():
+    # Initialise an empty list of files
+    def __init__(self, interval):
+        '''
+        Takes the time between checks, in seconds
+        '''
+        self.interval = interval
+        self.files = {}
+        self.changes = 0
+        self.lock = threading.Lock()
+
+    # Start watching a file
+    def watch(self, path, callback):
+        '''
+        Takes the file, and the function to call when it changes
+        '''
+        with self.lock:
+            self.files[path] = (callback, stamp(path))
+
+    # Stop watching a file
+    def unwatch(self, path, callback=None):
+        '''
+        Takes the file, and optionally the function it was watched with
+        Returns True if the file is no longer watched
+        '''
+        with self.lock:
+            entry = self.files.get(path)
+            if entry is None:
+                return True
+
+            # Bound methods are new objects each time, so compare with ==
+            if callback is not None and entry[0] != callback:
+                return False
+
+            del self.files[path]
+            return True
+
+    # Check the files every 'interval' seconds
+    def start(self):
+        scheduler.jobs.add('config-reload', self.check,
+                           delay=self.interval, interval=self.interval)
+
+    # Check each file once, and call the function for any that changed
+    def check(self):
+        '''Returns the number of files that changed'''
+        with self.lock:
+            files = list(self.files.items())
+
+        changed = 0
+        for path, (callback, old) in files:
+            new = stamp(path)
+            if new is None or new == old:
+                continue
+
+            # Only update the file if it wasn't replaced in the meantime
+            with self.lock:
+                if self.files.get(path, (None,))[0] is callback:
+                    self.files[path] = (callback, new)
+
+            print(termcolor.colored(
+                f"File changed: {path}",
+                "cyan"))
+            try:
+                callback()
+            except Exception as e:
+                print(termcolor.colored(
+                    f"Error handling a change to {path}",
+                    "red"))
+                print(e)
+
+            changed += 1
+
+        self.changes += changed
+        return changed
+
+    # Report the watched files
+    def status(self):
+        with self.lock:
+            files = list(self.files)
+
+        return {
+            'files': files,
+            'interval': self.interval,
+            'changes': self.changes,
+        }
+
+
+# Get a file's modification time and size, to see if it has changed
+def stamp(path):
+    '''Returns None if the file can't be read'''
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return (info.st_mtime_ns, info.st_size)
+
+
+# The shared file watcher
+files = FileWatcher(GLOBAL.get('config_check_interval', CHECK_INTERVAL))
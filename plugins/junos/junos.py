@@ -17,9 +17,9 @@ Author:
 """
 
 
-import yaml
 from core import teamschat
-from core import sql
+from core import plugin
+from core import digest
 import socket
 import struct
 from datetime import datetime
@@ -30,44 +30,54 @@ LOCATION = 'plugins\\junos\\junos-config.yaml'
 
 
 # Junos handler class
-class JunosHandler:
+class JunosHandler(plugin.PluginTemplate):
+    # Map the logical filter fields to the keys in Junos events
+    FILTER_FIELDS = {
+        'site': [],
+        'device': ['hostname'],
+        'type': ['event'],
+        'text': ['message'],
+    }
+
+    # Initialise the class from the inherited class
     def __init__(self):
-        # Empty variables for later
-        self.config = {}
-        self.alert_levels = {}
-
-        # Read the YAML file
-        with open(LOCATION) as config:
-            try:
-                self.config = yaml.load(config, Loader=yaml.FullLoader)
-
-            # Handle problems with YAML syntax
-            except yaml.YAMLError as err:
-                print('Error parsing config file, exiting')
-                print('Check the YAML formatting at \
-                    https://yaml-online-parser.appspot.com/')
-                print(err)
-                return False
-
-        # Setup webhook authentication
-        self.auth_header = self.config['config']['auth_header']
-        self.webhook_secret = self.config['config']['webhook_secret']
-
-        # Initialize alert levels
-        self.alert_levels = self.config['events']
+        super().__init__(LOCATION)
+
+    # Compile the filters (in the template), and the alert levels
+    def compile(self, config):
+        parts = super().compile(config)
+        parts['alert_levels'] = dict(config.get('events') or {})
+        return parts
+
+    # The alert levels, from the current snapshot
+    @property
+    def alert_levels(self):
+        return self.snapshot.alert_levels
 
     # Handle the event as it comes in
+    # Returns a list with the message if it wasn't sent to Teams,
+    #   and a list of Futures for the SQL writes
     def handle_event(self, raw_response, src):
+        # Use the same config for the whole event
+        snapshot = self.snapshot
+
+        # Filter events (see the 'filter' section of the config)
+        if self.filtered(raw_response, snapshot):
+            return
+
+        # Drop duplicates of a recent event
+        if self.duplicate(raw_response, snapshot):
+            return
+
         # Add the sending IP to the event
         raw_response['source'] = src
 
         # Assign a priority to the event
-        self.alert_priority(raw_response)
+        self.alert_priority(raw_response, snapshot)
 
         # Cleanup the message string
         raw_response['message'] = \
             raw_response['message'].replace(raw_response['event'], "")
-        raw_response['message'] = raw_response['message'].replace("'", "")
 
         # Depending on priority,
         # print event to terminal and prepare message for Teams
@@ -77,14 +87,14 @@ class JunosHandler:
                 message = f"{raw_response['message']} on \
                     <span style=\"color:Lime\"><b> \
                     {raw_response['hostname']}</b></span>"
-                self.log(message, raw_response)
+                return self.log(message, raw_response)
 
             # Priority 2
             case 2:
                 message = f"{raw_response['message']} on \
                     <span style=\"color:Lime\"><b> \
                     {raw_response['hostname']}</b></span>"
-                self.log(message, raw_response)
+                return self.log(message, raw_response)
 
             # Priority 3
             case 3:
@@ -95,48 +105,49 @@ class JunosHandler:
                 pass
 
     # Assign a priority to an event
-    def alert_priority(self, webhook):
-        if webhook['event'] in self.alert_levels:
-            webhook['level'] = self.alert_levels[webhook['event']]
+    def alert_priority(self, webhook, snapshot=None):
+        alert_levels = (snapshot or self.snapshot).alert_levels
+        if webhook['event'] in alert_levels:
+            webhook['level'] = alert_levels[webhook['event']]
         else:
             webhook['level'] = 1
 
     # Log to SQL and terminal
+    # Returns a list with the message if it wasn't sent (an empty list if
+    #   it was, or it's held for a digest), and the Future for the write
     def log(self, message, event):
-        date = datetime.now().date()
-        time = datetime.now().time().strftime("%H:%M:%S")
-
-        chat_id = teamschat.send_chat(message)['id']
+        now = datetime.now()
+
+        # Similar alerts may be held, and sent later as a digest
+        chat_id = ''
+        unsent = []
+        if not digest.alerts.submit(
+            message,
+            event['level'],
+            event['hostname'],
+            event['event']
+        ):
+            response = teamschat.send_chat(message)
+            chat_id = response['id'] if response else ''
+            if not response:
+                unsent.append(message)
         print('Junos event:', event)
 
         fields = {
-            'device': f"'{event['hostname']}'",
-            'event': f"'{event['event']}'",
-            'description': f"'{event['message']}'",
-            'logdate': f"'{date}'",
-            'logtime': f"'{time}'",
-            'source': f"{ip2integer(event['source'])}",
-            'message': f"'{chat_id}'"
+            'device': event['hostname'],
+            'event': event['event'],
+            'description': event['message'],
+            'ts': now,
+            'source': ip2integer(event['source']),
+            'message': chat_id
         }
 
-        sql_conn = sql.Sql()
-        sql_conn.add('junos_events', fields)
-
-    # Refresh the alert levels
-    # Reread the config file
-    def refresh(self):
-        # Read the YAML file
-        with open(LOCATION) as config:
-            try:
-                self.config = yaml.load(config, Loader=yaml.FullLoader)
-
-            # Handle problems with YAML syntax
-            except yaml.YAMLError as err:
-                print('Error parsing config file, exiting')
-                print('Check the YAML formatting at \
-                    https://yaml-online-parser.appspot.com/')
-                print(err)
-                return False
+        write = self.sql_write(
+            database='junos_events',
+            fields=fields,
+            level=event['level']
+        )
+        return unsent, [write]
 
 
 def ip2integer(ip):
@@ -28,18 +28,42 @@ LOCATION = 'plugins\\loginsight\\config.yaml'
 
 
 class LogInsight(plugin.PluginTemplate):
+    # Map the logical filter fields to the keys in parsed events
+    FILTER_FIELDS = {
+        'site': [],
+        'device': ['hostname'],
+        'type': ['alert'],
+        'text': ['description', 'recommendation'],
+    }
+
     # Initialise the class from the inherited class
     def __init__(self):
         super().__init__(LOCATION)
 
     # Handle the webhook
     def handle_event(self, raw_response, src):
-        '''Handle webhooks when the are sent'''
+        '''
+        Handle webhooks when the are sent
+        Returns True if the alert was sent,
+            and a list of Futures for the SQL writes
+        '''
         # Add the sending IP to the event
         raw_response['source'] = src
 
         # Cleanup the message
         event = self.parse_message(raw_response)
+
+        # Use the same config for the whole event
+        snapshot = self.snapshot
+
+        # Filter events (see the 'filter' section of the config)
+        if self.filtered(event, snapshot):
+            return
+
+        # Log Insight may fire the same alert again; Only handle it once
+        if self.duplicate(event, snapshot):
+            return
+
         message = event
         message = f"<span style=\"color:yellow\"><b>{event['hostname']} \
             </span></b> had a <span style=\"color:orange\"><b> \
@@ -48,7 +72,7 @@ class LogInsight(plugin.PluginTemplate):
             <br><a href={message['url']}>See more logs here</a>"
 
         # Log the message, and send to teams
-        self.log(message, raw_response)
+        return self.log(message, raw_response)
 
     # Parse the message
     def parse_message(self, event):
@@ -77,15 +101,17 @@ class LogInsight(plugin.PluginTemplate):
         return message
 
     # Log to Teams and SQL
+    # Returns a list with the message if it wasn't sent to Teams,
+    #   and a list with the Future for the SQL write
     def log(self, message, event):
-        date = datetime.now().date()
-        time = datetime.now().time().strftime("%H:%M:%S")
+        now = datetime.now()
 
-        chat_id = teamschat.send_chat(message)['id']
+        response = teamschat.send_chat(message)
+        chat_id = response['id'] if response else ''
         print(termcolor.colored(f"Log Insight event: {event}", "yellow"))
 
         try:
-            description = event['messages'][0]['text'].replace("'", "")
+            description = event['messages'][0]['text']
         except IndexError:
             description = ''
 
@@ -95,29 +121,30 @@ class LogInsight(plugin.PluginTemplate):
             hostname = 'No hostname'
 
         fields = {
-            'device': f"'{hostname}'",
-            'event': f"'{event['source']}'",
-            'description': f"'{description}'",
-            'logdate': f"'{date}'",
-            'logtime': f"'{time}'",
-            'source': f"{self.ip2integer(event['source'])}",
-            'message': f"'{chat_id}'"
+            'device': hostname,
+            'event': event['source'],
+            'description': description,
+            'ts': now,
+            'source': self.ip2integer(event['source']),
+            'message': chat_id
         }
 
-        self.sql_write(database='loginsight_events', fields=fields)
+        write = self.sql_write(database='loginsight_events', fields=fields)
+        return [] if response else [message], [write]
 
     # Check webhook authentication
     # This overrides the default implementation from the template
     # WARNING: Log Insight sends the username and password in clear text
     def authenticate(self, request, plugin):
         # Check if there is an authentication header
-        if request.headers[plugin['handler'].auth_header] != 'undefined':
-            username = self.config['config']['webhook_user']
-            password = self.config['config']['webhook_secret']
+        snapshot = self.snapshot
+        if request.headers[snapshot.auth_header] != 'undefined':
+            username = snapshot.config['config']['webhook_user']
+            password = snapshot.config['config']['webhook_secret']
             sent_username = \
-                request.headers[plugin['handler'].auth_header]
+                request.headers[snapshot.auth_header]
             sent_password = \
-                request.headers[plugin['handler'].auth_header_secret]
+                request.headers[snapshot.auth_header_secret]
 
             if (username == sent_username) and (password == sent_password):
                 return True
@@ -11,10 +11,6 @@ Restrictions:
     Needs access to the 'teamschat' module
 
 To Do:
-    Some webhooks come through twice; Only send one to teams
-        eg: Level 2 event: {'event': 'alarm', 'count': 1, 'devices':
-        ['EDG-NET-WAP-1'], 'site': 'Edgeworth Library',
-        'type': 'device_reconnected', 'level': 2}
     Stop updating 'global' variables in the get_config() function
     Put the path to the YAML file in a variable somewhere
 
@@ -22,9 +18,8 @@ Author:
     Luke Robertson - November 2022
 """
 
-from core import sql, teamschat
-from plugins.mist.mistdebug import MistDebug
-import yaml
+from core import teamschat, plugin, digest
+from plugins.mist import priority
 from datetime import datetime
 import socket
 import struct
@@ -32,113 +27,75 @@ import struct
 
 LOCATION = 'plugins\\mist\\mist-config.yaml'
 
+# Teams messages are combined up to this many characters
+# Graph API rejects messages that are much larger than this
+MESSAGE_LIMIT = 20000
+
 
 # Create a class to handle Mist webhooks
-class MistHandler:
+class MistHandler(plugin.PluginTemplate):
+    # Map the logical filter fields to the keys in Mist events
+    FILTER_FIELDS = {
+        'site': ['site'],
+        'device': ['name', 'devices'],
+        'type': ['type', 'err_type', 'task'],
+        'text': ['text', 'task', 'before', 'after'],
+    }
+
+    # Initialise the class from the inherited class
     def __init__(self):
-        # Empty variables for later
-        self.alert_levels = {}
-        self.logfile = ''
-
-        # Read the YAML file
-        with open(LOCATION) as config:
-            try:
-                self.alert_levels = yaml.load(config, Loader=yaml.FullLoader)
-
-            # Handle problems with YAML syntax
-            except yaml.YAMLError as err:
-                print('Error parsing config file, exiting')
-                print('Check the YAML formatting at \
-                    https://yaml-online-parser.appspot.com/')
-                print(err)
-                return False
-
-        if self.alert_levels['config']['debug']:
-            self.log = MistDebug()
-
-        # Setup webhook authentication
-        self.auth_header = self.alert_levels['config']['auth_header']
-        self.webhook_secret = self.alert_levels['config']['webhook_secret']
+        super().__init__(LOCATION)
+
+    # Compile the filters (in the template), and the priority rules
+    def compile(self, config):
+        parts = super().compile(config)
+        parts['rules'] = priority.PriorityRules(config)
+        return parts
+
+    # The priority rules, from the current snapshot
+    @property
+    def rules(self):
+        return self.snapshot.rules
+
+    # The whole config holds the alert levels
+    @property
+    def alert_levels(self):
+        return self.snapshot.config
 
     # Each alert has a different priority, which admins assign
-    # These priorities are defined in mist-config.yaml
-    def alert_priority(self, event):
+    # These priorities are defined in mist-config.yaml, and compiled
+    #   into the snapshot's rules when the config is loaded
+    def alert_priority(self, event, snapshot=None):
         '''Takes given events, and adds a priority level'''
-        match event['event']:
-            case 'device_event':
-                if event['type'] in self.alert_levels['device_event']:
-                    # Check if this alert has a subpriority
-                    # (the 'default' keyword must be there)
-                    if 'default' in str(self.alert_levels['device_event']
-                                        [event['type']]):
-                        # Set the default priority
-                        event['level'] = (self.alert_levels['device_event']
-                                          [event['type']]['default'])
-
-                        # Check if there is a more specific priority
-                        for entry in (self.alert_levels['device_event']
-                                                       [event['type']]):
-                            if entry == 'default':
-                                break
-                            if entry in event['text']:
-                                event['level'] = (self.alert_levels
-                                                  ['device_event']
-                                                  [event['type']][entry])
-
-                    # An alert with no sub priority
-                    else:
-                        event['level'] = (self.alert_levels['device_event']
-                                          [event['type']])
-                else:
-                    event['level'] = 1
-
-            case 'audit':
-                # Some audit events don't have an 'admin' (user) field,
-                # so we will inject one
-                if 'admin' not in event:
-                    event['admin'] = 'system'
-
-                # Some audit events don't have an 'site' field,
-                # so we will inject one
-                if 'site' not in event:
-                    event['site'] = 'global'
-
-                # Split the 'task' field, to just read the part before the
-                # description; This matches the entry in the YAML file
-                if event['task'].split(' "')[0] in self.alert_levels['audit']:
-                    event['level'] = (self.alert_levels['audit']
-                                      [event['task'].split(' "')[0]])
-                else:
-                    event['level'] = 1
-
-            case 'alarm':
-                if event['type'] in self.alert_levels['alarm']:
-                    event['level'] = (self.alert_levels['alarm']
-                                      [event['type']])
-                else:
-                    event['level'] = 1
+        snapshot = snapshot or self.snapshot
+        if event['event'] == 'audit':
+            # Some audit events don't have an 'admin' (user) field,
+            # so we will inject one
+            if 'admin' not in event:
+                event['admin'] = 'system'
 
-            case 'updown':
-                if event['err_type'] in self.alert_levels['updown']:
-                    event['level'] = (self.alert_levels['updown']
-                                      [event['err_type']])
-                else:
-                    event['level'] = 1
+            # Some audit events don't have an 'site' field,
+            # so we will inject one
+            if 'site' not in event:
+                event['site'] = 'global'
 
-            case 'default':
-                event['level'] = 1
+        event['level'] = snapshot.rules.level(event)
 
     # Parse the alerts into a standard dictionary format that we can use
     # If fields are missing, add them in
+    # Mist may batch several events into one webhook
     def alert_parse(self, raw_response):
         '''
-        Takes a raw event from Mist,
-        and parses it into something we can use
+        Takes a raw webhook from Mist,
+        and parses each event in it into something we can use
+        Returns a list of events
         '''
-        details = {}
-        match raw_response['topic']:
-            case 'device-events':
-                for event in raw_response['events']:
+        events = []
+        topic = raw_response['topic']
+        for event in raw_response['events']:
+            details = {}
+            match topic:
+                case 'device-events':
                     details['event'] = 'device_event'
                     details['name'] = event['device_name']
                     details['type'] = event['device_type']
@@ -153,8 +110,7 @@ class MistHandler:
                     else:
                         details['text'] = 'no additional details available'
 
-            case 'alarms':
-                for event in raw_response['events']:
+                case 'alarms':
                     details['event'] = 'alarm'
                     details['count'] = event['count']
                     details['site'] = event['site_name']
@@ -164,8 +120,7 @@ class MistHandler:
                     else:
                         details['devices'] = 'No device listed'
 
-            case 'audits':
-                for event in raw_response['events']:
+                case 'audits':
                     details['event'] = 'audit'
                     details['task'] = event['message']
 
@@ -183,8 +138,7 @@ class MistHandler:
                     if 'site_name' in event:
                         details['site'] = event['site_name']
 
-            case 'device-updowns':
-                for event in raw_response['events']:
+                case 'device-updowns':
                     details['event'] = 'updown'
                     details['name'] = event['device_name']
                     details['device'] = event['device_type']
@@ -192,45 +146,95 @@ class MistHandler:
                     details['site'] = event['site_name']
                     details['err_type'] = event['type']
 
-            case _:
-                topic = raw_response['topic']
-                for event in raw_response['events']:
+                case _:
                     details['event'] = topic
                     details['data'] = event
                     print(raw_response)
 
-        return details
+            events.append(details)
 
-    # Handle an event, whatever it may be
-    # Takes the event, which needs parsing
+        return events
+
+    # Handle a webhook, whatever it may be
+    # Takes the webhook, which needs parsing into one or more events
     def handle_event(self, raw_response, src):
         '''
-        takes a raw event from Mist, and handles it as appropriate
-        This includes parsing the event, assigning a priority,
-        and possibly sending it to teams
+        takes a raw webhook from Mist, and handles each event in it
+        This includes parsing the events, assigning a priority,
+        and possibly sending them to teams
+        Teams messages are combined, and the events are written to SQL
+            in a single batch
+        Returns a list of the messages that weren't sent to Teams,
+            and a list of Futures for the SQL writes
         '''
 
-        # Parse the message
-        event = self.alert_parse(raw_response)
-
-        if self.alert_levels['config']['debug']:
-            self.log.log_entry(str(event))
-
-        # Filter events
-        # These are just keywords that we want to avoid
-        for item in self.alert_levels['filter']:
-            if item in str(event):
-                print('filtering out an event')
-                return
-
-        # Add the event level (1-4) to the 'event'
-        self.alert_priority(event)
-
-        # Add the source IP to the event
-        event['src_ip'] = src
+        # Use the same config for the whole webhook,
+        #   even if the file is reloaded in the meantime
+        snapshot = self.snapshot
+
+        # Parse the webhook into a list of events
+        events = []
+        messages = []
+        for event in self.alert_parse(raw_response):
+            if snapshot.config['config']['debug']:
+                print('Mist event:', event)
+
+            # Filter events (see the 'filter' section of the config)
+            if self.filtered(event, snapshot):
+                continue
+
+            # Some webhooks come through twice; Only handle one
+            if self.duplicate(event, snapshot):
+                continue
+
+            # Add the event level (1-4) to the 'event'
+            self.alert_priority(event, snapshot)
+
+            # Add the source IP to the event
+            event['src_ip'] = src
+
+            # Prepare a message for teams (not all events have one)
+            # Similar alerts may be held, and sent later as a digest
+            message = self.alert_message(event)
+            if message and digest.alerts.submit(
+                message,
+                event['level'],
+                event.get('site', ''),
+                self.event_type(event)
+            ):
+                message = ''
+
+            # Keep track of which message belongs to this event
+            if message:
+                messages.append(message)
+                events.append((event, len(messages) - 1))
+            else:
+                events.append((event, None))
+
+        # Send the messages to Teams, combined into as few as possible
+        chat_ids, unsent = self.send_messages(messages)
+
+        # Write the entries to the database, as a single batch
+        now = datetime.now()
+        writes = []
+        for event, index in events:
+            if event['level'] != 4:
+                print(event)
+                chat_id = chat_ids[index] if index is not None else ''
+                writes.append(self.sql_write(
+                    database='mist_events',
+                    fields=self.sql_fields(event, chat_id, now),
+                    level=event['level']
+                ))
+
+        return unsent, writes
+
+    # Prepare a teams message for an event, based on its priority
+    # Returns an empty string if no message should be sent
+    def alert_message(self, event):
+        message = ''
 
         # Handle device events
-        message = ''
         if event['event'] == 'device_event':
             match event['level']:
                 case 1:
@@ -343,76 +347,93 @@ class MistHandler:
 
         # Handle anything unexpected
         else:
-            message = event
+            message = str(event)
             print(event)
 
-        # Send the message to Teams
-        chat_id = ''
-        if message:
-            chat_id = teamschat.send_chat(message)['id']
+        return message
+
+    # Send a list of messages to Teams, combining them where possible
+    # Returns a list of chat IDs, one for each message,
+    #   and a list of the combined messages that weren't sent
+    def send_messages(self, messages):
+        chat_ids = []
+        unsent = []
+        batch = []
+        length = 0
+
+        for message in messages + [None]:
+            # Send the current batch if it's full, or there are no more
+            if batch and (
+                message is None or
+                length + len(message) > MESSAGE_LIMIT
+            ):
+                combined = '<br><br>'.join(batch)
+                response = teamschat.send_chat(combined)
+                chat_id = response['id'] if response else ''
+                if not response:
+                    unsent.append(combined)
+                chat_ids += [chat_id] * len(batch)
+                batch = []
+                length = 0
+
+            if message is not None:
+                batch.append(message)
+                length += len(message) + len('<br><br>')
+
+        return chat_ids, unsent
+
+    # Get the specific event type (eg, SW_DISCONNECTED)
+    # The field this comes from depends on the kind of event
+    def event_type(self, event):
+        match event['event']:
+            case 'device_event' | 'alarm':
+                return event['type']
+            case 'audit':
+                return event['task'].split(" ", 1)[0]
+            case 'updown':
+                return event['err_type']
+            case _:
+                return event['event']
+
+    # Build the SQL fields for an event
+    # Different event types have different fields
+    # Some need to be handled a little differently
+    def sql_fields(self, event, chat_id, ts):
+        ip_decimal = ip2integer(event['src_ip'])
 
-        # Write the entry to the database
-        if event['level'] != 4:
-            print(event)
+        if event['event'] == 'device_event':
+            device = event['name']
+            description = event['text']
 
-            date = datetime.now().date()
-            time = datetime.now().time().strftime("%H:%M:%S")
-            ip_decimal = ip2integer(event['src_ip'])
-
-            # Different event types have different fields
-            # Some need to be handled a little differently
-            if event['event'] == 'device_event':
-                device = event['name']
-                description = event['text']
-                type = event['type']
-
-            elif event['event'] == 'alarm':
-                device = ''
-                for mist_device in event['devices']:
-                    device += ', ' + mist_device
-                description = ''
-                type = event['type']
-
-            elif event['event'] == 'audit':
-                device = ''
-                description = event['task'].replace("[", "").replace("]", "") \
-                    .replace("'", "")
-                type = event['task'].split(" ", 1)[0]
-
-            elif event['event'] == 'updown':
-                device = event['name']
-                type = event['err_type']
-                description = ''
-
-            fields = {
-                'device': f"'{device}'",
-                'site': f"'{event['site']}'",
-                'event': f"'{type}'",
-                'description': f"'{description}'",
-                'logdate': f"'{date}'",
-                'logtime': f"'{time}'",
-                'source': f"{ip_decimal}",  # IP address needs to be decimal
-                'message': f"'{chat_id}'"
-            }
-
-            sql_conn = sql.Sql()
-            sql_conn.add('mist_events', fields)
-
-    # Refresh the alert levels
-    # Reread the config file
-    def refresh(self):
-        # Read the YAML file
-        with open(LOCATION) as config:
-            try:
-                self.alert_levels = yaml.load(config, Loader=yaml.FullLoader)
-
-            # Handle problems with YAML syntax
-            except yaml.YAMLError as err:
-                print('Error parsing config file, exiting')
-                print('Check the YAML formatting at \
-                    https://yaml-online-parser.appspot.com/')
-                print(err)
-                return False
+        elif event['event'] == 'alarm':
+            device = ''
+            for mist_device in event['devices']:
+                device += ', ' + mist_device
+            description = ''
+
+        elif event['event'] == 'audit':
+            device = ''
+            description = event['task'].replace("[", "").replace("]", "")
+
+        elif event['event'] == 'updown':
+            device = event['name']
+            description = ''
+
+        else:
+            device = ''
+            description = ''
+
+        fields = {
+            'device': device,
+            'site': event.get('site', ''),
+            'event': self.event_type(event),
+            'description': description,
+            'ts': ts,
+            'source': ip_decimal,  # IP address needs to be decimal
+            'message': chat_id
+        }
+
+        return fields
 
 
 def ip2integer(ip):
@@ -0,0 +1,106 @@
+"""
+Compiles the Mist alert levels into rules that are quick to look up
+
+Usage:
+    import 'priority' into the Mist plugin
+    Create a PriorityRules object from the contents of mist-config.yaml
+        Do this when the config is loaded or refreshed, not per event
+    Call level() with a parsed event to get its priority level
+
+Restrictions:
+    Device events can have sub-priorities, based on keywords in the text
+    When more than one keyword is found, the precedence is:
+        (1) The longest (most specific) keyword wins
+        (2) If keywords are the same length, the most severe level wins
+        (3) If no keywords are found, the 'default' level is used
+        (4) If there's no 'default', level 1 is used
+    The order of keywords in the YAML file doesn't matter
+
+To Do:
+    None
+"""
+
+
+from core import matcher
+import termcolor
+
+
+# Events not in the config file are treated as critical
+DEFAULT_LEVEL = 1
+
+
+class PriorityRules():
+    # Compile the alert levels from the config file
+    def __init__(self, alert_levels):
+        # Device events; Each type maps to a tuple of:
+        #   default level, keyword matcher (or None), keyword levels
+        self.device_event = {}
+        for type, rule in (alert_levels.get('device_event') or {}).items():
+            if isinstance(rule, dict):
+                levels = {
+                    str(keyword): level
+                    for keyword, level in rule.items()
+                    if keyword != 'default'
+                }
+
+                if 'default' not in rule:
+                    print(termcolor.colored(
+                        f"Mist: {type} has sub-priorities, but no default; "
+                        f"using level {DEFAULT_LEVEL}",
+                        "yellow"))
+
+                self.device_event[type] = (
+                    rule.get('default', DEFAULT_LEVEL),
+                    matcher.Matcher(levels) if levels else None,
+                    levels
+                )
+
+            else:
+                self.device_event[type] = (rule, None, None)
+
+        # Other event types only have one level per event
+        self.audit = dict(alert_levels.get('audit') or {})
+        self.alarm = dict(alert_levels.get('alarm') or {})
+        self.updown = dict(alert_levels.get('updown') or {})
+
+    # Get the level for a device event, including sub-priorities
+    def device_level(self, type, text):
+        rule = self.device_event.get(type)
+        if rule is None:
+            return DEFAULT_LEVEL
+
+        default, keywords, levels = rule
+        if keywords is None:
+            return default
+
+        found = keywords.findall(text)
+        if not found:
+            return default
+
+        # Longest keyword first, then the most severe (lowest) level
+        best = max(found, key=lambda keyword: (len(keyword), -levels[keyword]))
+        return levels[best]
+
+    # Get the level for any parsed event
+    def level(self, event):
+        '''Takes a parsed event, and returns its priority level'''
+        match event['event']:
+            case 'device_event':
+                return self.device_level(event['type'], event['text'])
+
+            case 'audit':
+                # Only the part of the task before the description
+                #   matches the entry in the YAML file
+                return self.audit.get(
+                    event['task'].split(' "')[0],
+                    DEFAULT_LEVEL
+                )
+
+            case 'alarm':
+                return self.alarm.get(event['type'], DEFAULT_LEVEL)
+
+            case 'updown':
+                return self.updown.get(event['err_type'], DEFAULT_LEVEL)
+
+            case _:
+                return DEFAULT_LEVEL
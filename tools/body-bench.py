@@ -0,0 +1,126 @@
+"""
+Compares the per-request cost of the old and new webhook body handling
+
+Usage:
+    Run from the main application folder:
+        python tools/body-bench.py [--mist-events 200] [--loginsight-kb 300]
+    Times the work done on each body before it's queued:
+        Old - HMAC with a new key, parse with json, encode again for the spool
+        New - HMAC from a prepared key, parse once with the configured codec,
+            and write the raw body to the spool
+
+Authentication:
+    N/A
+
+Restrictions:
+    Reading the request and writing to disk aren't timed; Both are the same
+        in the old and new paths
+    Install orjson to see the difference the codec makes
+        (or set 'json_codec' in config.yaml to compare)
+
+To Do:
+    None
+"""
+
+import os
+import sys
+import hmac
+import json
+import timeit
+import hashlib
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from core import codec, hash, spool  # noqa: E402
+
+
+SECRET = 'Secret'
+
+
+# A Mist device-events webhook, with many events
+def mist_body(events):
+    return json.dumps({
+        'topic': 'device-events',
+        'events': [
+            {
+                'device_name': f"ADM-NET-SW-Edge{number:02}",
+                'device_type': 'switch',
+                'mac': f"5c5b35{number:06x}",
+                'org_id': '00000000-0000-0000-0000-000000000000',
+                'site_id': '00000000-0000-0000-0000-000000000001',
+                'site_name': 'Head Office',
+                'text': f"ge-0/0/{number % 48}: down",
+                'timestamp': 1665000000 + number,
+                'type': 'SW_PORT_DOWN',
+            }
+            for number in range(events)
+        ]
+    }, indent=2).encode()
+
+
+# A Log Insight alert, with a large list of matching messages
+def loginsight_body(kb):
+    messages = []
+    size = 0
+    while size < kb * 1024:
+        message = {
+            'timestamp': 1665000000000 + len(messages),
+            'text': 'Oct 18 10:00:00 esx01 vmkernel: cpu12:2097 '
+                    'NMP: nmp_ThrottleLogForDevice:3689: Cmd 0x2a '
+                    'to dev "naa.600" on path "vmhba2:C0:T1:L12" Failed',
+            'fields': [
+                {'name': 'hostname', 'content': 'esx01.example.com'},
+                {'name': 'appname', 'content': 'vmkernel'},
+            ],
+        }
+        messages.append(message)
+        size += len(json.dumps(message))
+
+    return json.dumps({
+        'AlertName': 'Storage path failed',
+        'HitCount': len(messages),
+        'messages': messages,
+    }).encode()
+
+
+# The body handling, as it was before the Webhook class
+def legacy(data, signature):
+    local = hmac.new(SECRET.encode(), data, hashlib.sha256).hexdigest()
+    assert signature == local
+    body = json.loads(data)
+    return json.dumps(body)
+
+
+# The body handling now
+def current(verifier, data, signature):
+    assert verifier.check(memoryview(data), signature)
+    codec.json.loads(data)
+    return spool.one_line(data)
+
+
+# Time both over the same body
+def compare(name, data, repeat=5):
+    signature = hmac.new(SECRET.encode(), data, hashlib.sha256).hexdigest()
+    verifier = hash.Verifier('X-Signature', SECRET)
+    count = max(10, 2000000 // len(data))
+
+    old = min(timeit.repeat(
+        lambda: legacy(data, signature),
+        number=count, repeat=repeat)) / count
+    new = min(timeit.repeat(
+        lambda: current(verifier, data, signature),
+        number=count, repeat=repeat)) / count
+
+    print(f"{name} ({len(data) / 1024:.0f} KB, codec '{codec.json.name}')")
+    print(f"    old: {old * 1e6:9.1f} us/request")
+    print(f"    new: {new * 1e6:9.1f} us/request ({old / new:.1f}x)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Body handling benchmark")
+    parser.add_argument('--mist-events', type=int, default=200)
+    parser.add_argument('--loginsight-kb', type=int, default=300)
+    args = parser.parse_args()
+
+    compare(f"Mist, {args.mist_events} events", mist_body(args.mist_events))
+    compare("Log Insight", loginsight_body(args.loginsight_kb))
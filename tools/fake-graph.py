@@ -0,0 +1,127 @@
+"""
+A local fake Graph API server, to test how the sender handles throttling
+
+Usage:
+    Run from the main application folder:
+        python tools/fake-graph.py [--messages 200] [--threads 20]
+                                   [--throttle 0.3] [--retry-after 1]
+    Starts a fake server on localhost, then sends messages to it from
+        several threads with teamschat.send_chat()
+    The server responds with 429 (and Retry-After) to a share of requests,
+        and 201 to the rest
+    Prints the server's counts and the sender's counters
+
+Authentication:
+    A dummy token is used; The fake server doesn't check it
+
+Restrictions:
+    Requires the 'requests' module, as the application does
+
+To Do:
+    None
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from config import GRAPH  # noqa: E402
+from core import teamschat, tokenstore  # noqa: E402
+
+
+# Counts of what the fake server has seen
+counts = {'requests': 0, 'throttled': 0, 'created': 0, 'max_in_flight': 0}
+in_flight = 0
+lock = threading.Lock()
+
+
+# Responds to message posts, throttling some of them
+class FakeGraph(BaseHTTPRequestHandler):
+    throttle = 0.3
+    retry_after = 1
+
+    def do_POST(self):
+        global in_flight
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+
+        with lock:
+            in_flight += 1
+            counts['requests'] += 1
+            counts['max_in_flight'] = max(counts['max_in_flight'], in_flight)
+            throttled = random.random() < self.throttle
+            counts['throttled' if throttled else 'created'] += 1
+
+        # Simulate Graph taking a little while to respond
+        time.sleep(0.02)
+
+        if throttled:
+            body = {'error': {'code': 'TooManyRequests'}}
+            self.send_response(429)
+            self.send_header('Retry-After', str(self.retry_after))
+        else:
+            body = {'id': str(counts['created'])}
+            self.send_response(201)
+
+        data = json.dumps(body).encode()
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+        with lock:
+            in_flight -= 1
+
+    # Keep the terminal quiet
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fake Graph API server")
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=20)
+    parser.add_argument('--throttle', type=float, default=0.3)
+    parser.add_argument('--retry-after', type=int, default=1)
+    args = parser.parse_args()
+
+    FakeGraph.throttle = args.throttle
+    FakeGraph.retry_after = args.retry_after
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeGraph)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Point teamschat at the fake server
+    GRAPH['base_url'] = f"http://127.0.0.1:{server.server_port}/"
+    tokenstore.token = {'access_token': 'Bearer fake'}
+
+    results = []
+
+    def worker(count):
+        for number in range(count):
+            results.append(teamschat.send_chat(f"Test message {number}"))
+
+    per_thread = args.messages // args.threads
+    threads = [
+        threading.Thread(target=worker, args=(per_thread,))
+        for _ in range(args.threads)
+    ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    print(f"Elapsed:           {elapsed:.1f}s")
+    print(f"Messages sent:     {sum(1 for result in results if result)}"
+          f" of {len(results)}")
+    print(f"Server:            {counts}")
+    print(f"Sender:            {teamschat.graph_sender.status()}")
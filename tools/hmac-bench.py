@@ -0,0 +1,77 @@
+"""
+Compares the per-request cost of the old and new webhook signature checks
+
+Usage:
+    Run from the main application folder:
+        python tools/hmac-bench.py [--size 2048] [--secrets 2]
+    Checks a small body, and a generated body of the given size
+    With several secrets, the body is signed with the last one,
+        so every secret is tried (the worst case)
+
+Authentication:
+    N/A
+
+Restrictions:
+    The old check is copied here, as it was before the Verifier class
+    A real request also includes reading the body, which isn't timed here
+
+To Do:
+    None
+"""
+
+import os
+import sys
+import hmac
+import timeit
+import hashlib
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from core import hash  # noqa: E402
+
+
+# The signature check, as it was in hash.auth_message()
+def legacy_check(secret, data, signature):
+    local = hmac.new(secret.encode(), data, hashlib.sha256).hexdigest()
+    return signature == local
+
+
+# Time both checks over the same body
+def compare(size, secret_count, count=20000, repeat=5):
+    secrets = [f"secret-{number}" for number in range(secret_count)]
+    data = os.urandom(size)
+
+    # Signed with the newest secret, so every secret is tried
+    signature = hmac.new(
+        secrets[-1].encode(), data, hashlib.sha256
+    ).hexdigest()
+
+    verifier = hash.Verifier('X-Signature', secrets)
+    assert verifier.check(data, signature)
+
+    old = min(timeit.repeat(
+        lambda: legacy_check(secrets[-1], data, signature),
+        number=count, repeat=repeat)) / count
+    new = min(timeit.repeat(
+        lambda: verifier.check(data, signature),
+        number=count, repeat=repeat)) / count
+    view = min(timeit.repeat(
+        lambda: verifier.check(memoryview(data), signature),
+        number=count, repeat=repeat)) / count
+
+    print(f"{size} byte body, {secret_count} secret(s)")
+    print(f"    old:              {old * 1e6:7.2f} us/request (one secret)")
+    print(f"    new:              {new * 1e6:7.2f} us/request "
+          f"({old / new:.1f}x)")
+    print(f"    new (memoryview): {view * 1e6:7.2f} us/request")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="HMAC benchmark")
+    parser.add_argument('--size', type=int, default=2048)
+    parser.add_argument('--secrets', type=int, default=2)
+    args = parser.parse_args()
+
+    compare(256, 1)
+    compare(args.size, 1)
+    compare(args.size, args.secrets)
@@ -0,0 +1,116 @@
+"""
+Compares the per-event cost of the old and new Mist priority lookups
+
+Usage:
+    Run from the main application folder:
+        python tools/priority-bench.py [--types 500] [--keywords 20]
+    Uses the real mist-config.yaml, plus a generated config of the given size
+
+Authentication:
+    N/A
+
+Restrictions:
+    The old lookup is copied here, as it was before the rules were compiled
+
+To Do:
+    None
+"""
+
+import os
+import sys
+import yaml
+import random
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from plugins.mist import priority  # noqa: E402
+
+
+CONFIG = os.path.join('plugins', 'mist', 'mist-config.yaml')
+
+
+# The device event lookup, as it was in MistHandler.alert_priority()
+def legacy_priority(alert_levels, event):
+    if event['type'] in alert_levels['device_event']:
+        if 'default' in str(alert_levels['device_event'][event['type']]):
+            event['level'] = \
+                alert_levels['device_event'][event['type']]['default']
+
+            for entry in alert_levels['device_event'][event['type']]:
+                if entry == 'default':
+                    break
+                if entry in event['text']:
+                    event['level'] = \
+                        alert_levels['device_event'][event['type']][entry]
+
+        else:
+            event['level'] = alert_levels['device_event'][event['type']]
+    else:
+        event['level'] = 1
+
+
+# Generate a config with many event types and sub-priorities
+def generate(types, keywords):
+    device_event = {}
+    for number in range(types):
+        if number % 3 == 0:
+            rule = {
+                f"keyword-{number}-{entry}": random.randint(1, 4)
+                for entry in range(keywords)
+            }
+            rule['default'] = 3
+            device_event[f"EVENT_{number}"] = rule
+        else:
+            device_event[f"EVENT_{number}"] = random.randint(1, 4)
+
+    return {'device_event': device_event}
+
+
+# Generate events that hit a mix of plain and sub-priority rules
+def events_for(alert_levels, count):
+    names = list(alert_levels['device_event']) + ['NOT_CONFIGURED']
+    events = []
+    for _ in range(count):
+        type = random.choice(names)
+        text = 'Port ge-0/0/12 on ADM-NET-SW-Edge01 changed state, ' \
+            'user 508857fb3518 on vlan Users'
+        rule = alert_levels['device_event'].get(type)
+        if isinstance(rule, dict) and random.random() < 0.5:
+            text += ' ' + random.choice(list(rule))
+        events.append({'event': 'device_event', 'type': type, 'text': text})
+
+    return events
+
+
+# Time both lookups over the same events
+def compare(name, alert_levels, count=5000, repeat=5):
+    events = events_for(alert_levels, count)
+    rules = priority.PriorityRules(alert_levels)
+
+    old = min(timeit.repeat(
+        lambda: [legacy_priority(alert_levels, event) for event in events],
+        number=1, repeat=repeat)) / count
+    new = min(timeit.repeat(
+        lambda: [rules.level(event) for event in events],
+        number=1, repeat=repeat)) / count
+
+    print(f"{name}")
+    print(f"    old: {old * 1e6:7.2f} us/event")
+    print(f"    new: {new * 1e6:7.2f} us/event ({old / new:.1f}x)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Priority benchmark")
+    parser.add_argument('--types', type=int, default=500)
+    parser.add_argument('--keywords', type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(1)
+    with open(CONFIG) as config:
+        compare('mist-config.yaml', yaml.load(config, Loader=yaml.FullLoader))
+
+    compare(
+        f"generated ({args.types} types, {args.keywords} keywords)",
+        generate(args.types, args.keywords)
+    )
@@ -0,0 +1,87 @@
+"""
+Benchmarks the webhook spool, to show sustained events per second
+
+Usage:
+    Run from the main application folder:
+        python tools/spool-bench.py [--threads 8] [--events 2000]
+    A temporary spool directory is used, and deleted afterwards
+
+Authentication:
+    N/A
+
+Restrictions:
+    Results depend heavily on the disk; fsync is the expensive part
+
+To Do:
+    None
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from core import spool  # noqa: E402
+
+
+# A representative Mist device-event webhook
+SAMPLE = {
+    'topic': 'device-events',
+    'events': [
+        {
+            'device_name': 'ADM-NET-SW-Edge01',
+            'device_type': 'switch',
+            'mac': '5c5b35000001',
+            'org_id': '00000000-0000-0000-0000-000000000000',
+            'site_id': '00000000-0000-0000-0000-000000000001',
+            'site_name': 'Head Office',
+            'text': 'ge-0/0/12: down',
+            'timestamp': 1665000000,
+            'type': 'SW_PORT_DOWN',
+        }
+    ] * 4
+}
+
+
+# Append and ack events from several threads at once
+def run(path, threads, events):
+    webhook_spool = spool.Spool(path=path)
+    webhook_spool.open()
+
+    def worker():
+        for _ in range(events):
+            id = webhook_spool.append('mist', '10.0.0.1', SAMPLE)
+            webhook_spool.ack(id)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return elapsed, webhook_spool.status()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Spool benchmark")
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--events', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        elapsed, stats = run(path, args.threads, args.events)
+
+    total = args.threads * args.events
+    print(f"Threads:        {args.threads}")
+    print(f"Events:         {total}")
+    print(f"Elapsed:        {elapsed:.2f}s")
+    print(f"Events/sec:     {total / elapsed:,.0f}")
+    print(f"fsyncs:         {stats['syncs']} "
+          f"({total / max(stats['syncs'], 1):.1f} events per fsync)")
+    print(f"Outstanding:    {stats['outstanding']}")
+    print(f"Segments left:  {stats['segments']}")
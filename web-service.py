@@ -8,6 +8,9 @@ Usage:
     Test the web server - Browse to /test
     Test the mist webhook - GET /mist
     Send a Mist webhook - POST /mist
+    Queue statistics - GET /status
+    Reload plugins - POST /admin/reload[/<route>], or send SIGHUP
+        Needs the 'X-Admin-Secret' header to match 'admin_secret'
 
 Authentication:
     Mist - Not required, as this service passively receives webhooks
@@ -24,9 +27,7 @@ Restrictions:
         Apparently a known Flask issue
 
 To Do:
-    Find an alternative to saving the token to a file
-        Can't get variables to work between Flask routes
-        My current solution is to save to disk, and read later
+    None
 
 Author:
     Luke Robertson - January 2023
@@ -36,75 +37,125 @@ Author:
 from flask import Flask, request, Response
 from core import azureauth
 from core import crypto
-from core import parse_chats
+from core import notifications
+from core import ingest
+from core import spool
+from core import digest
+from core import sql
+from core import recent
+from core import maintenance
+from core import codec
+from core import registry
+from core import watcher
+from core import scheduler
+from core import tokenstore
 from config import GLOBAL
-from config import PLUGINS, plugin_list
-import importlib
+from config import SPOOL, REQUEST, plugin_list
+import hmac
 from core import teamschat
 import termcolor
 from urllib.parse import urlparse, parse_qs
-import threading
-
-
-# Load plugins
-def load_plugins(plugin_list):
-    for plugin in PLUGINS:
-        print(termcolor.colored(
-            f"Loading plugin: {PLUGINS[plugin]['name']}",
-            "green"))
-
-        try:
-            module = importlib.import_module(PLUGINS[plugin]['module'])
-        except Exception as e:
-            print(termcolor.colored(
-                f"Error loading the {PLUGINS[plugin]['name']} plugin",
-                "red"))
-            print(f"{e} error while loading the module")
-            continue
-        print(module)
-
-        try:
-            handler = eval('module.' + PLUGINS[plugin]['class'])()
-        except Exception as e:
-            message = f"Error loading the {PLUGINS[plugin]['name']} plugin"
-            print(termcolor.colored(message, "red"))
-            print(f"{e} error while loading the class")
-            teamschat.send_chat(message)
-            continue
-
-        plugin_entry = {
-            'name': PLUGINS[plugin]['name'],
-            'route': PLUGINS[plugin]['route'],
-            'handler': handler,
-        }
-        plugin_list.append(plugin_entry)
 
 
 # Import configuration details
 WEB_PORT = GLOBAL['web_port']
 WEBHOOK_SECRET = GLOBAL['webhook_secret']
 
+# The secret for admin routes (eg, /admin/reload); Disabled if not set
+ADMIN_SECRET = GLOBAL.get('admin_secret', '')
+
+# Default largest request body, in bytes
+MAX_BODY = 4 * 1024 * 1024
+
 
 # Initialise a Flask app
+# Requests with a bigger body are refused (413) before it's read
 app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = REQUEST.get('max_body', MAX_BODY)
+
 
+# Start the process pool for decrypting chat messages (if enabled)
+# This forks the service, so it must be done before any threads start
+notifications.chats.start_pool()
 
-# Setup the Mist handler object
-load_plugins(plugin_list)
+
+# Load the plugins, indexed by route
+# Send SIGHUP (or POST to /admin/reload) to load them again
+registry.plugins.load_all()
+registry.plugins.watch_signal()
 print(termcolor.colored(f"Plugins: {plugin_list}", "cyan"))
 
+# Reload plugin config files when they change
+watcher.files.start()
+
 
 # Authenticate with Microsoft (for teams)
-print('Calling client_auth')
+# The token cache is tried first, so a restart doesn't need a user
+#   to log in; If it can't be used, the browser opens to log in
+# This is done before the spool is replayed, so replayed alerts can be sent
+print('Logging in to Microsoft')
 azure = azureauth.AzureAuth()
-azure.client_auth()
+azure.login()
+
+
+# Start sending alert digests (if enabled in config.yaml)
+digest.alerts.start()
+
+
+# Start writing events to the database in batches
+sql.writer.start()
+
+
+# Load the newest events into memory, for chat queries
+# This is done before any webhooks are queued, so events from new and
+#   replayed webhooks are added after the older ones from the database
+recent.events.warm(sql.pool)
+
+
+# Open the spool, and find webhooks that weren't handled last time
+webhook_spool = None
+pending = []
+if SPOOL.get('enabled', True):
+    webhook_spool = spool.Spool()
+    pending = webhook_spool.open()
+
+
+# Start the webhook queue
+# Webhooks are acknowledged as soon as they're queued,
+#   and worker threads pass them to the plugins
+# Spooled webhooks are queued by a background thread, so startup doesn't
+#   wait for room in the queue
+# They wait for a valid token (eg, while a user logs in), so they
+#   aren't marked as done without their alerts being sent
+events = ingest.EventQueue(spool=webhook_spool, ready=tokenstore.valid)
+events.start()
+events.replay(pending, plugin_list)
+
+
+# Roll up and purge old events in the background
+maintenance.job.start(sql.pool)
+
+
+# Open a connection to the Graph API, ready for the first message
+teamschat.warm_up()
+
+
+# Parse the encryption keys now, so the first chat message doesn't wait
+crypto.keys.load()
+
+
+# Start the workers that decrypt and answer chat messages
+notifications.chats.start()
 
 
 # Subscribe to the group chat, so we can see when people send messages
 # The callback URL needs to be ready for this to work,
-#   so this is run as a separate thread
-thread = threading.Thread(target=teamschat.subscribe)
-thread.start()
+#   so this runs in the scheduler thread, and is retried until it works
+teamschat.schedule_refresh()
+
+
+# Run token refreshes, subscription renewals, and other background jobs
+scheduler.jobs.start()
 
 
 # Test URL - Used to confirm the service is running
@@ -114,6 +165,60 @@ def test():
     return message
 
 
+# Readiness URL - Returns 200 once there's a valid Graph API token
+# Until then, alerts can't be sent to Teams (503)
+@app.route("/ready")
+def ready():
+    if not tokenstore.valid():
+        return {'ready': False}, 503
+
+    token = tokenstore.get_token()
+    return {'ready': True, 'token_expires': token['expires_at']}
+
+
+# Status URL - Queue depth and counters, for monitoring
+@app.route("/status")
+def status():
+    stats = {
+        'queue': events.status(),
+        'graph': teamschat.graph_sender.status(),
+        'digest': digest.alerts.status(),
+        'sql': sql.writer.status(),
+        'recent': recent.events.status(),
+        'keys': crypto.keys.status(),
+        'chat': notifications.chats.status(),
+        'maintenance': maintenance.job.status(),
+        'plugins': registry.plugins.status(),
+        'watcher': watcher.files.status(),
+        'scheduler': scheduler.jobs.status(),
+    }
+    if webhook_spool:
+        stats['spool'] = webhook_spool.status()
+
+    # Hit counts for each plugin's filters, to find rules that never match
+    stats['filters'] = {
+        plugin['route']: plugin['handler'].filter.status()
+        for plugin in plugin_list
+        if hasattr(plugin['handler'], 'filter')
+    }
+
+    # Config files that couldn't be loaded (the last good config is used)
+    stats['config_errors'] = {
+        plugin['route']: plugin['handler'].config_error
+        for plugin in plugin_list
+        if getattr(plugin['handler'], 'config_error', None)
+    }
+
+    # Duplicate event counts for each plugin
+    stats['dedup'] = {
+        plugin['route']: plugin['handler'].dedup.status()
+        for plugin in plugin_list
+        if getattr(plugin['handler'], 'dedup', None)
+    }
+
+    return stats
+
+
 # Callback URL; Used for MS Identity authentication
 # When a user authenticates, a code is returned here
 @app.route("/callback", methods=['GET'])
@@ -122,8 +227,9 @@ def callback():
     if client_code == '':
         return ('There has been a problem retrieving the client code')
     else:
-        # Get the token from Microsoft
-        azure.get_token(client_code)
+        # Get the token from Microsoft, then subscribe straight away
+        if azure.get_token(client_code):
+            scheduler.jobs.run_now('subscription')
 
         return ('Thankyou for authenticating, this window can be closed')
 
@@ -139,20 +245,71 @@ def webhook_handler(handler):
 
     # Get the plugin handler module to decide what to do with the request
     # The class must include a 'handle_event' and 'authenticate' method
-    for plugin in plugin_list:
-        # Confirm that a route exists for this plugin
-        if handler == plugin['route']:
-            # Authenticate the webhook
-            if plugin['handler'].authenticate(request=request, plugin=plugin):
-                # If authenticated, send this to the handler
-                # print(termcolor.colored(request.headers, "cyan"))
-                plugin['handler'].handle_event(raw_response=request.json,
-                                               src=source_ip)
+    # This request keeps this entry, even if the plugin is reloaded
+    plugin = registry.plugins.get(handler)
+    if plugin is None:
+        registry.plugins.count('(unknown)', 'requests')
+        return ('Invalid path')
+
+    route = plugin['route']
+    registry.plugins.count(route, 'requests')
+
+    # Read the body once; Authentication, the spool, and the plugin
+    #   all use this copy
+    webhook = ingest.Webhook(
+        request.headers,
+        request.get_data(cache=False),
+        source_ip
+    )
+
+    # Authenticate the webhook
+    if not plugin['handler'].authenticate(request=webhook, plugin=plugin):
+        registry.plugins.count(route, 'unauthenticated')
+
+        # Return a positive response
+        return ('Webhook received')
+
+    # Parse the body once it's known to be genuine
+    try:
+        body = webhook.parse()
+    except ValueError:
+        registry.plugins.count(route, 'invalid')
+        return ('Invalid JSON', 400)
+
+    # If authenticated, queue this for the handler
+    # The response is sent before the handler runs
+    if not events.put(plugin, body, source_ip, webhook.raw):
+        registry.plugins.count(route, 'busy')
+
+        # The sender will retry with the same signature;
+        #   Don't reject that as a replay
+        plugin['handler'].verifier.release(webhook)
+        print(termcolor.colored(
+            f"Webhook queue full, rejected a webhook for "
+            f"{plugin['name']}",
+            "red"))
+        return ('Webhook queue full', 503)
 
-            # Return a positive response
-            return ('Webhook received')
+    # Return a positive response
+    registry.plugins.count(route, 'accepted')
+    return ('Webhook received', 202)
 
-    return ('Invalid path')
+
+# Admin - Load plugins again, without a restart
+# Reloads all plugins, or just the one for the given route
+@app.route('/admin/reload', methods=['POST'])
+@app.route('/admin/reload/<route>', methods=['POST'])
+def reload_plugins(route=None):
+    sent = request.headers.get('X-Admin-Secret', '')
+    if not ADMIN_SECRET or \
+            not hmac.compare_digest(sent.encode(), ADMIN_SECRET.encode()):
+        return ('Forbidden', 403)
+
+    results = registry.plugins.reload(route)
+    if route is not None and route not in results:
+        return ({'error': f"No plugin for /{route} in config.yaml"}, 404)
+
+    return (results, 200 if all(results.values()) else 500)
 
 
 # GraphAPI - Listens for change notifications
@@ -169,44 +326,21 @@ def chat():
 
     # Or, is this a webhook
     else:
-        # Extract the values we need from the webhook
-        body_value = request.json['value']
-        encrypted_session_key = body_value[0]['encryptedContent']['dataKey']
-        signature = body_value[0]['encryptedContent']['dataSignature']
-        data = body_value[0]['encryptedContent']['data']
-
-        # Decrypt the symmetric key
-        decrypted_symmetric_key = crypto.rsa_decrypt(encrypted_session_key)
-
-        # Validate the signature - Tamper prevention
-        if crypto.validate(decrypted_symmetric_key, data, signature):
-            # Decrypt the message
-            decrypted_payload = crypto.aes_decrypt(
-                decrypted_symmetric_key,
-                data
-            )
-
-            # Get key fields from the message, and parse it
-            name = decrypted_payload['from']['user']['displayName']
-            message = decrypted_payload['body']['content']
-            parse_chats.parse(message=message, sender=name)
-
-            # message = message.replace("<p>", "").replace("</p>", "")
-
-            # # Confirm it's not the chatbot itself generating the message
-            # if name != GLOBAL['chatbot_name']:
-            #     if 'hi' in message:
-            #         teamschat.send_chat("hi")
-            #     elif 'tell me a joke' in message:
-            #         teamschat.send_chat("I don't know any jokes")
-            #     else:
-            #         print(f"{name} says {message}")
-
-        else:
-            print("Validation failed")
-            print("Data may have been tampered with")
-
-        return ('received')
+        # Graph may send several notifications in one request
+        try:
+            body = codec.json.loads(request.get_data(cache=False))
+        except ValueError:
+            body = None
+        if not isinstance(body, dict) or \
+                not isinstance(body.get('value'), list):
+            return Response('Invalid notification', status=400)
+
+        # Queue every item; Workers decrypt and parse them,
+        #   so Graph gets a response within its time limit
+        if notifications.chats.put(body['value']) is False:
+            return Response('Busy', status=503)
+
+        return Response('received', status=202)
 
 
 # Start the Flask app